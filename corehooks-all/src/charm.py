@@ -24,6 +24,9 @@ import shutil
 import sys
 
 import ops
+from charms.corehooks_all.v0 import systemd_extras
+from charms.corehooks_all.v0.rolling_restart import RollingRestart
+from charms.operator_libs_linux.v1 import systemd
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +36,19 @@ EMOJI_GREEN_DOT = "\U0001F7E2"
 EMOJI_RED_DOT = "\U0001F534"
 EMOJI_PACKAGE = "\U0001F4E6"
 
+# Eager hello: N instances of a template unit, hello@1.service ... hello@N.service. systemd
+# puts all instances of a template in one slice, which holds their combined resource usage.
+HELLO_TEMPLATE = "hello@.service"
+HELLO_INSTANCES = "hello@*.service"
+HELLO_SLICE = "system-hello.slice"
+
+# On-demand hello: the socket systemd listens on, and the service template run per connection.
+GREETING_SOCKET = "hello-greeting.socket"
+GREETING_SERVICE = "hello-greeting@.service"
+
+# Number of most recent hello journal entries kept when checking it for errors.
+JOURNAL_ENTRIES = 20
+
 
 class CorehooksAllCharm(ops.CharmBase):
     """Charm the hello service with all core hooks."""
@@ -53,7 +69,24 @@ class CorehooksAllCharm(ops.CharmBase):
         self.framework.observe(self.on.collect_metrics, self._on_collect_metrics)
         self.framework.observe(self.on.upgrade_charm, self._on_upgrade_charm)
 
-        self._stored.set_default(message=self.config["message"])
+        self._stored.set_default(
+            message=self.config["message"],
+            cgroup_sample={},
+            journal_cursor="",
+            activation=None,
+            port=None,
+            instances=None,
+        )
+
+        # Restarts are handed out by the leader over the "restart" peer relation, so that
+        # an application wide config change never takes out all units at the same time.
+        self._rolling_restart = RollingRestart(
+            self,
+            relation_name="restart",
+            restart=self._restart_hello,
+            healthy=self._hello_is_active,
+            max_concurrent=self.config["max_concurrent_restarts"],
+        )
 
 
     def _on_install(self, event):
@@ -70,10 +103,20 @@ class CorehooksAllCharm(ops.CharmBase):
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
         logger.info(f"Installing hello {EMOJI_PACKAGE}")
-        os.system('apt install -y hello')
+        try:
+            systemd_extras.run_in_scope(
+                ["apt-get", "install", "-y", "hello"], **systemd_extras.LOW_PRIORITY_SCOPE
+            )
+        except systemd.SystemdError as e:
+            logger.error(f"Installing hello failed: {e}")
+
+        # Install the unit file template for the hello instances (one-shot services)
+        shutil.copyfile(f"templates/etc/systemd/system/{HELLO_TEMPLATE}",
+                        f"/etc/systemd/system/{HELLO_TEMPLATE}")
 
-        # Install unit file for hello (one-shot service)
-        shutil.copyfile('templates/etc/systemd/system/hello.service', '/etc/systemd/system/hello.service')
+        # Install the unit file for on-demand hello, run once for every connection to its socket.
+        shutil.copyfile(f"templates/etc/systemd/system/{GREETING_SERVICE}",
+                        f"/etc/systemd/system/{GREETING_SERVICE}")
 
         # (re)config hello.
         self._reconfig_hello(restart=False)
@@ -91,9 +134,22 @@ class CorehooksAllCharm(ops.CharmBase):
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
-        if self.config["message"] != self._stored.message:
+        message_changed = self.config["message"] != self._stored.message
+        if message_changed or self.config["instances"] != self._stored.instances:
+            # New instances need their environment file too.
             self._stored.message = self.config["message"]
-            self._reconfig_hello(restart=self.config["restart_on_reconfig"])
+            self._reconfig_hello(restart=message_changed and self.config["restart_on_reconfig"])
+
+        if not self._apply_resource_limits():
+            return
+
+        # The start hook does the first activation.
+        if self._stored.activation is not None and (
+            (self.config["activation"], self.config["port"], self.config["instances"])
+            != (self._stored.activation, self._stored.port, self._stored.instances)
+        ):
+            if not self._apply_activation():
+                return
 
         self._on_update_status(event)
 
@@ -102,8 +158,8 @@ class CorehooksAllCharm(ops.CharmBase):
             Start your service here, possibly defer (wait) until conditions are OK.
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
-        logger.info(f"{EMOJI_GREEN_DOT} Starting the hello service...")
-        os.system('systemctl start hello.service')
+        if not self._apply_activation():
+            return
 
         # Calling update_status gives quick feedback when deploying starts up.
         self._on_update_status(event)
@@ -130,16 +186,66 @@ class CorehooksAllCharm(ops.CharmBase):
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
-        if not os.system('systemctl is-active hello.service') == 0:
-            logger.info("hello service is not running.")
-            self.unit.status = ops.MaintenanceStatus("Inactive.")
+        errors = self._read_hello_journal()
+        journal = f" {errors} errors since last check." if errors else ""
+
+        if self._rolling_restart.state != "idle":
+            logger.info(f"hello service restart is {self._rolling_restart.state}.")
+            self.unit.status = ops.MaintenanceStatus(
+                f"Restart {self._rolling_restart.state}.{journal}"
+            )
+        elif self._stored.activation == "on-demand":
+            if systemd.service_running(GREETING_SOCKET):
+                self.unit.status = ops.ActiveStatus(f"Listening on {self._stored.port}.{journal}")
+            else:
+                logger.info(f"{GREETING_SOCKET} is not running.")
+                self.unit.status = ops.MaintenanceStatus("Inactive." + journal)
         else:
-            logger.info(f"hello service is running.")
-            self.unit.status = ops.ActiveStatus("Running.")
+            # One systemctl call for all the instances.
+            running = systemd_extras.services_running(*self._hello_units())
+            up = sum(running.values())
+            summary = f"{up}/{len(running)} running."
+            logger.info(f"hello instances {summary}")
+            if up < len(running):
+                self.unit.status = ops.MaintenanceStatus(summary + journal)
+            else:
+                sample, rates = self._sample_hello_usage()
+                usage = f" Memory {sample.memory_current / 2**20:.1f} MiB." if sample else ""
+                if rates:
+                    usage += f" CPU {rates['cpu_percent']:.1f}%."
+                self.unit.status = ops.ActiveStatus(summary + usage + journal)
 
     def _on_upgrade_charm(self, event):
+        """
+        Install the unit files of the new charm revision.
+
+        Earlier revisions ran a single hello.service, which is replaced by the hello@.service
+        instances. They never activated hello, so that is done here: config-changed only
+        re-applies an activation when its config changes.
+        """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
+        for unit in (HELLO_TEMPLATE, GREETING_SERVICE):
+            shutil.copyfile(f"templates/etc/systemd/system/{unit}", f"/etc/systemd/system/{unit}")
+
+        if os.path.exists('/etc/systemd/system/hello.service'):
+            logger.info("Replacing hello.service with hello@.service instances.")
+            try:
+                systemd.service_disable("--now", "hello.service")
+            except systemd.SystemdError as e:
+                logger.error(f"Stopping hello.service failed: {e}")
+            systemd_extras.remove_unit(
+                'hello.service', dropin=systemd_extras.RESOURCE_LIMITS_DROPIN
+            )
+            systemd_extras.remove_unit('hello.service')
+        systemd.daemon_reload()
+
+        if self._stored.activation is None:
+            # The instances need their environment files too.
+            self._reconfig_hello(restart=False)
+            if self._apply_activation():
+                self._on_update_status(event)
+
     def _on_stop(self, event):
         """
         Bring down your service, possibly defer until all systems are good to go similar to start hook.
@@ -147,7 +253,15 @@ class CorehooksAllCharm(ops.CharmBase):
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
         logger.info(f"{EMOJI_RED_DOT} Stopping the hello service...")
-        os.system('systemctl stop hello.service')
+        try:
+            if self._stored.activation == "on-demand":
+                # Stops listening, every connection already ran its own hello.
+                systemd.service_stop(GREETING_SOCKET)
+            else:
+                # Stops all the hello instances at once.
+                systemd.service_stop(HELLO_INSTANCES)
+        except systemd.SystemdError as e:
+            logger.error(f"Stopping hello failed: {e}")
 
 
     def _on_remove(self, event):
@@ -161,31 +275,208 @@ class CorehooksAllCharm(ops.CharmBase):
         logger.info(f"Removing hello {EMOJI_PACKAGE}")
         os.system('apt -y remove --purge hello')
 
+        for unit in (GREETING_SOCKET, GREETING_SERVICE, HELLO_TEMPLATE):
+            systemd_extras.remove_unit(unit)
+            # The drop-ins, e.g. the resource limits.
+            shutil.rmtree(f"/etc/systemd/system/{unit}.d", ignore_errors=True)
+        for i in range(1, (self._stored.instances or 0) + 1):
+            if os.path.exists(f"/etc/default/hello-{i}"):
+                os.remove(f"/etc/default/hello-{i}")
+        try:
+            systemd.daemon_reload()
+        except systemd.SystemdError as e:
+            logger.error(f"Reloading systemd failed: {e}")
+
 
     def _on_collect_metrics(self, event):
         """
         This runs every 5 minutes - if metrics are defined in metrics.yaml.
 
-        We don't implement any metrics this in this charm. See the metrics charm for a working example.
+        Adds the resource usage of the hello instances, read from their cgroup. See the metrics
+        charm for more on metrics.
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
+        sample, rates = self._sample_hello_usage()
+        if not sample:
+            return
+
+        # Convert to int, see the metrics charm.
+        metrics = {"hello_memory_bytes": int(sample.memory_current)}
+        if rates:
+            metrics["hello_cpu_percent"] = int(rates["cpu_percent"])
+            metrics["hello_io_read_bytes_per_sec"] = int(rates["io_read_bytes_per_sec"])
+            metrics["hello_io_write_bytes_per_sec"] = int(rates["io_write_bytes_per_sec"])
+        event.add_metrics(metrics)
+
 
     def _reconfig_hello(self, restart=False):
         """
-        Reconfigures the startup parameters of hello.service by modifying the /etc/default/hello file.
-        Reloads systemd daemons.
+        Reconfigures the startup parameters of hello by modifying the /etc/default/hello file, and
+        the /etc/default/hello-N file of every instance. Reloads systemd daemons.
 
-        Optionally, restart the service.
+        Optionally, restart the service. The restart waits for a token from the leader,
+        see the rolling_restart library.
         """
         logger.info(f"{EMOJI_MESSAGE} Configuring hello message: {self._stored.message}")
         with open('/etc/default/hello', 'w') as f:
             f.write(f"CUSTOM_ARGS=\\'{self._stored.message}\\'")
+        for i in range(1, self.config["instances"] + 1):
+            with open(f"/etc/default/hello-{i}", 'w') as f:
+                f.write(f"CUSTOM_ARGS=\\'{self._stored.message} (instance {i})\\'")
         os.system('systemctl daemon-reload')
 
         if restart:
-            logger.info(f"{EMOJI_GREEN_DOT} Restarting hello.")
-            os.system('systemctl restart hello.service')
+            self._rolling_restart.request_restart()
+
+    def _apply_resource_limits(self):
+        """
+        Applies the resource limits from the charm config to every hello instance.
+
+        The limits go into a systemd drop-in of hello@.service and are set on the running
+        instances right away,
+        except for LimitNOFILE which needs a (rolling) restart. On-demand hello gets the same
+        drop-in for hello-greeting@.service, which applies from the next connection on.
+
+        Returns False if the limits are invalid.
+        """
+        limits = systemd_extras.resource_limits_from_config(self.config)
+        try:
+            if systemd_extras.service_set_resource_limits(
+                HELLO_TEMPLATE, limits, instances=self._hello_units()
+            ):
+                self._rolling_restart.request_restart()
+            systemd_extras.service_set_resource_limits(GREETING_SERVICE, limits)
+        except systemd.SystemdError as e:
+            logger.error(f"Applying resource limits {limits} failed: {e}")
+            self.unit.status = ops.BlockedStatus("Invalid resource limits, see debug-log.")
+            return False
+        return True
+
+    def _sample_hello_usage(self):
+        """
+        Reads the resource usage of all the hello instances straight from the cgroup of their
+        slice, no processes are spawned.
+
+        Rates are computed against the sample of the previous call, kept in self._stored.
+
+        Returns (sample, rates), or (None, {}) if there is no cgroup to read.
+        """
+        try:
+            sample = systemd_extras.service_cgroup_stats(HELLO_SLICE)
+        except systemd.SystemdError as e:
+            logger.debug(f"No resource usage for hello: {e}")
+            return None, {}
+
+        rates = {}
+        if self._stored.cgroup_sample:
+            previous = systemd_extras.CgroupStats.from_dict(dict(self._stored.cgroup_sample))
+            rates = sample.rates(previous)
+        self._stored.cgroup_sample = sample.as_dict()
+        return sample, rates
+
+    def _read_hello_journal(self):
+        """
+        Reads the journal entries of the hello instances logged since the previous call, continuing
+        from the cursor kept in self._stored. Only the last few entries are kept in memory.
+
+        Returns the number of new entries with priority error or worse, which are also logged.
+        The first call only finds where the journal ends, older entries are not counted.
+        """
+        cursor = self._stored.journal_cursor or None
+        reader = systemd_extras.JournalReader(
+            HELLO_INSTANCES, cursor=cursor, max_entries=JOURNAL_ENTRIES
+        )
+        try:
+            reader.read()
+        except systemd.SystemdError as e:
+            logger.debug(f"Could not read the hello journal: {e}")
+            return 0
+        self._stored.journal_cursor = reader.cursor or ""
+
+        for entry in reader.entries if cursor else ():
+            if entry["priority"] <= systemd_extras.PRIORITY_ERR:
+                logger.warning(f"hello: {entry['message']}")
+        return reader.errors
+
+    def _apply_activation(self):
+        """
+        Starts hello the way the activation config says.
+
+        eager: start the configured number of hello instances, and stop any left over from a
+        larger count.
+        on-demand: let systemd listen on the configured port with hello-greeting.socket. It runs
+        hello for every connection, so nothing runs until a client connects.
+
+        Returns False if hello could not be started.
+        """
+        activation = self.config["activation"]
+        port = self.config["port"]
+        instances = self.config["instances"]
+        if instances < 1:
+            self.unit.status = ops.BlockedStatus(f"Invalid instances: {instances}.")
+            return False
+        try:
+            if activation == "on-demand":
+                logger.info(f"{EMOJI_GREEN_DOT} Starting hello on-demand, listening on {port}...")
+                socket = systemd_extras.render_socket_unit(
+                    str(port), description="hello greeting", accept=True
+                )
+                if systemd_extras.install_unit(GREETING_SOCKET, socket):
+                    systemd.daemon_reload()
+                    # Takes a changed port into use.
+                    if systemd.service_running(GREETING_SOCKET):
+                        systemd.service_restart(GREETING_SOCKET)
+                systemd.service_enable("--now", GREETING_SOCKET)
+                systemd.service_stop(HELLO_INSTANCES)
+            elif activation == "eager":
+                logger.info(f"{EMOJI_GREEN_DOT} Starting {instances} hello instances...")
+                os.system(f"systemctl disable --now {GREETING_SOCKET}")
+                if systemd_extras.remove_unit(GREETING_SOCKET):
+                    systemd.daemon_reload()
+                stale = self._hello_units(self._stored.instances or 0)[instances:]
+                if stale:
+                    systemd.service_stop(*stale)
+                    for i in range(instances + 1, self._stored.instances + 1):
+                        if os.path.exists(f"/etc/default/hello-{i}"):
+                            os.remove(f"/etc/default/hello-{i}")
+                systemd.service_start(*self._hello_units(instances))
+            else:
+                self.unit.status = ops.BlockedStatus(f"Invalid activation: {activation}.")
+                return False
+        except systemd.SystemdError as e:
+            logger.error(f"Starting hello {activation} failed: {e}")
+            self.unit.status = ops.BlockedStatus(f"Starting hello {activation} failed.")
+            return False
+
+        self._stored.activation = activation
+        self._stored.port = port
+        self._stored.instances = instances
+        return True
+
+    def _hello_units(self, instances=None):
+        """The unit names of the hello instances, by default as many as configured."""
+        if instances is None:
+            instances = self.config["instances"]
+        return [f"hello@{i}.service" for i in range(1, instances + 1)]
+
+    def _restart_hello(self):
+        """Restart hello, called by the rolling restart once this unit holds a token."""
+        if self._stored.activation == "on-demand":
+            # Every connection runs a new hello, which reads the new config.
+            return
+        logger.info(f"{EMOJI_GREEN_DOT} Restarting the hello instances.")
+        try:
+            systemd.service_restart(*self._hello_units())
+        except systemd.SystemdError as e:
+            # The restart token is held until the instances are active, see _hello_is_active.
+            logger.error(f"Restarting hello failed: {e}")
+
+    def _hello_is_active(self):
+        """Health of hello, a restart token is only released once this is True."""
+        if self._stored.activation == "on-demand":
+            return systemd.service_running(GREETING_SOCKET)
+        return all(systemd_extras.services_running(*self._hello_units()).values())
 
 if __name__ == "__main__":
     ops.main(CorehooksAllCharm)
@@ -0,0 +1,31 @@
+# Copyright 2023 Erik Lönroth
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import unittest
+from pathlib import Path
+
+# The libraries owned by this charm, which are not published on Charmhub, and the charms of
+# this repository carrying a copy of them.
+CHARM_DIR = Path(__file__).resolve().parents[1]
+LIB_COPIES = {
+    "lib/charms/corehooks_all/v0/rolling_restart.py": ["observed"],
+    "lib/charms/corehooks_all/v0/systemd_extras.py": ["observed", "use-lib-charm"],
+}
+
+
+class TestLibCopies(unittest.TestCase):
+    def test_copies_match(self):
+        for lib, charms in LIB_COPIES.items():
+            for charm in charms:
+                if not (CHARM_DIR.parent / charm).is_dir():
+                    # The charm is not checked out next to this one.
+                    continue
+                copy = CHARM_DIR.parent / charm / lib
+                with self.subTest(lib=lib, charm=charm):
+                    self.assertEqual(
+                        copy.read_text(),
+                        (CHARM_DIR / lib).read_text(),
+                        f"{copy} differs from {lib}, copy it again",
+                    )
@@ -0,0 +1,158 @@
+# Copyright 2023 Erik Lönroth
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import json
+import unittest
+
+import ops
+from charms.corehooks_all.v0.rolling_restart import RollingRestart
+from ops.testing import Harness
+
+METADATA = """
+name: restarter
+peers:
+  restart:
+    interface: rolling_restart
+"""
+
+
+class RestarterCharm(ops.CharmBase):
+    max_concurrent = 1
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.restarts = 0
+        self.healthy = True
+        self.rolling_restart = RollingRestart(
+            self,
+            restart=self._restart,
+            healthy=lambda: self.healthy,
+            max_concurrent=self.max_concurrent,
+        )
+
+    def _restart(self):
+        self.restarts += 1
+
+
+class TestRollingRestart(unittest.TestCase):
+    def setUp(self):
+        RestarterCharm.max_concurrent = 1
+        self.harness = Harness(RestarterCharm, meta=METADATA)
+        self.addCleanup(self.harness.cleanup)
+
+    def begin(self, leader=True, peers=2):
+        self.harness.set_leader(leader)
+        self.relation_id = self.harness.add_relation("restart", "restarter")
+        for i in range(1, peers + 1):
+            self.harness.add_relation_unit(self.relation_id, f"restarter/{i}")
+        self.harness.begin()
+
+    def granted(self):
+        data = self.harness.get_relation_data(self.relation_id, "restarter")
+        return json.loads(data.get("granted", "[]"))
+
+    def state(self, unit="restarter/0"):
+        return self.harness.get_relation_data(self.relation_id, unit).get("state", "idle")
+
+    def request_from_peer(self, unit):
+        self.harness.update_relation_data(self.relation_id, unit, {"state": "requested"})
+
+    def test_restarts_immediately_without_peer_relation(self):
+        self.harness.begin()
+        self.harness.charm.rolling_restart.request_restart()
+        self.assertEqual(self.harness.charm.restarts, 1)
+
+    def test_leader_grants_itself_and_releases_when_healthy(self):
+        self.begin()
+        self.harness.charm.rolling_restart.request_restart()
+        self.assertEqual(self.harness.charm.restarts, 1)
+        self.assertEqual(self.state(), "idle")
+        self.assertEqual(self.granted(), [])
+
+    def test_token_held_until_healthy(self):
+        self.begin()
+        self.harness.charm.healthy = False
+        self.harness.charm.rolling_restart.request_restart()
+        self.assertEqual(self.state(), "restarting")
+        self.assertEqual(self.granted(), ["restarter/0"])
+
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.state(), "restarting")
+
+        self.harness.charm.healthy = True
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.state(), "idle")
+        self.assertEqual(self.granted(), [])
+
+    def test_max_concurrent_limits_tokens(self):
+        self.begin(peers=3)
+        self.harness.charm.healthy = False
+        self.harness.charm.rolling_restart.request_restart()
+        self.request_from_peer("restarter/2")
+        self.request_from_peer("restarter/1")
+        self.assertEqual(self.granted(), ["restarter/0"])
+
+        # The leader's token goes to the waiting unit with the lowest number.
+        self.harness.charm.healthy = True
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.granted(), ["restarter/1"])
+
+        self.harness.update_relation_data(self.relation_id, "restarter/1", {"state": "idle"})
+        self.assertEqual(self.granted(), ["restarter/2"])
+
+    def test_max_concurrent_above_one(self):
+        RestarterCharm.max_concurrent = 2
+        self.begin(peers=3)
+        for unit in ("restarter/1", "restarter/2", "restarter/3"):
+            self.request_from_peer(unit)
+        self.assertEqual(self.granted(), ["restarter/1", "restarter/2"])
+
+        self.harness.update_relation_data(self.relation_id, "restarter/1", {"state": "idle"})
+        self.assertEqual(self.granted(), ["restarter/2", "restarter/3"])
+
+    def test_departed_unit_releases_its_token(self):
+        self.begin(peers=2)
+        self.request_from_peer("restarter/1")
+        self.request_from_peer("restarter/2")
+        self.assertEqual(self.granted(), ["restarter/1"])
+
+        self.harness.remove_relation_unit(self.relation_id, "restarter/1")
+        self.assertEqual(self.granted(), ["restarter/2"])
+
+    def test_follower_waits_for_token(self):
+        self.begin(leader=False)
+        self.harness.charm.rolling_restart.request_restart()
+        self.assertEqual(self.state(), "requested")
+        self.assertEqual(self.harness.charm.restarts, 0)
+
+        self.harness.update_relation_data(
+            self.relation_id, "restarter", {"granted": json.dumps(["restarter/0"])}
+        )
+        self.assertEqual(self.harness.charm.restarts, 1)
+        self.assertEqual(self.state(), "idle")
+
+    def test_request_while_restarting_restarts_again(self):
+        self.begin()
+        self.harness.charm.healthy = False
+        self.harness.charm.rolling_restart.request_restart()
+        self.harness.charm.rolling_restart.request_restart()
+        self.assertEqual(self.harness.charm.restarts, 1)
+
+        self.harness.charm.healthy = True
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.charm.restarts, 2)
+        self.assertEqual(self.state(), "idle")
+        self.assertNotIn(
+            "follow_up", self.harness.get_relation_data(self.relation_id, "restarter/0")
+        )
+
+    def test_request_while_requested_is_not_repeated(self):
+        self.begin(leader=False)
+        self.harness.charm.rolling_restart.request_restart()
+        self.harness.charm.rolling_restart.request_restart()
+        self.harness.update_relation_data(
+            self.relation_id, "restarter", {"granted": json.dumps(["restarter/0"])}
+        )
+        self.assertEqual(self.harness.charm.restarts, 1)
@@ -0,0 +1,439 @@
+# Copyright 2023 Erik Lönroth
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from charms.corehooks_all.v0 import systemd_extras
+from charms.operator_libs_linux.v1.systemd import SystemdError
+
+
+class SystemdTestCase(unittest.TestCase):
+    """Points the library at a temporary /etc/systemd/system and /run/systemd/system.control."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        for name, path in (
+            ("SYSTEMD_UNIT_DIR", self.tmp / "etc"),
+            ("SYSTEMD_RUNTIME_CONTROL_DIR", self.tmp / "run"),
+        ):
+            patcher = patch.object(systemd_extras, name, str(path))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for name in ("daemon_reload", "_systemctl", "services_running"):
+            patcher = patch.object(systemd_extras, name)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+        self.services_running.side_effect = lambda *units: {unit: True for unit in units}
+
+
+class TestResourceLimits(SystemdTestCase):
+    def dropin(self, unit="hello.service"):
+        return self.tmp / "etc" / f"{unit}.d" / systemd_extras.RESOURCE_LIMITS_DROPIN
+
+    def test_limits_are_written_and_set_live(self):
+        restart = systemd_extras.service_set_resource_limits(
+            "hello", {"CPUQuota": "50%", "MemoryMax": "512M"}
+        )
+
+        self.assertFalse(restart)
+        self.assertEqual(
+            self.dropin().read_text(),
+            "# Managed by the charm, do not edit.\n[Service]\nCPUQuota=50%\nMemoryMax=512M\n",
+        )
+        self.daemon_reload.assert_called_once()
+        self._systemctl.assert_called_once_with(
+            "set-property", "--runtime", "hello.service", "CPUQuota=50%", "MemoryMax=512M"
+        )
+
+    def test_unchanged_limits_do_nothing(self):
+        systemd_extras.service_set_resource_limits("hello", {"CPUQuota": "50%"})
+        self._systemctl.reset_mock()
+        self.daemon_reload.reset_mock()
+
+        self.assertFalse(systemd_extras.service_set_resource_limits("hello", {"CPUQuota": "50%"}))
+        self._systemctl.assert_not_called()
+        self.daemon_reload.assert_not_called()
+
+    def test_limit_nofile_needs_a_restart(self):
+        self.assertTrue(
+            systemd_extras.service_set_resource_limits("hello", {"LimitNOFILE": "4096"})
+        )
+        self._systemctl.assert_not_called()
+
+    def test_removed_limits_are_reset(self):
+        systemd_extras.service_set_resource_limits("hello", {"CPUQuota": "50%"})
+        self._systemctl.reset_mock()
+
+        systemd_extras.service_set_resource_limits("hello", {})
+        self.assertFalse(self.dropin().exists())
+        self._systemctl.assert_called_once_with(
+            "set-property", "--runtime", "hello.service", "CPUQuota="
+        )
+
+    def test_invalid_value_writes_nothing(self):
+        for limits in (
+            {"CPUQuota": "banana"},
+            {"CPUWeight": "0"},
+            {"IOWeight": "20000"},
+            {"MemoryMax": "1 GB"},
+            {"LimitNOFILE": "-1"},
+        ):
+            with self.subTest(limits=limits):
+                with self.assertRaises(SystemdError):
+                    systemd_extras.service_set_resource_limits("hello", limits)
+                self.assertFalse(self.dropin().exists())
+                self.daemon_reload.assert_not_called()
+
+    def test_invalid_value_fails_again_when_retried(self):
+        for _ in range(2):
+            with self.assertRaises(SystemdError):
+                systemd_extras.service_set_resource_limits("hello", {"CPUQuota": "banana"})
+
+    def test_failed_set_property_restores_the_dropin(self):
+        systemd_extras.service_set_resource_limits("hello", {"CPUQuota": "50%"})
+        previous = self.dropin().read_text()
+        self._systemctl.side_effect = SystemdError("set-property failed")
+
+        with self.assertRaises(SystemdError):
+            systemd_extras.service_set_resource_limits("hello", {"CPUQuota": "20%"})
+        self.assertEqual(self.dropin().read_text(), previous)
+
+        # The retry sees the limits as changed, and tries again.
+        with self.assertRaises(SystemdError):
+            systemd_extras.service_set_resource_limits("hello", {"CPUQuota": "20%"})
+
+    def test_stopped_instances_lose_their_runtime_dropins(self):
+        self.services_running.side_effect = None
+        self.services_running.return_value = {"w@1.service": True, "w@2.service": False}
+        stale = self.tmp / "run" / "w@2.service.d" / "50-CPUQuota.conf"
+        stale.parent.mkdir(parents=True)
+        stale.write_text("[Service]\nCPUQuota=10%\n")
+
+        systemd_extras.service_set_resource_limits(
+            "w@.service", {"CPUQuota": "50%"}, instances=["w@1.service", "w@2.service"]
+        )
+        self._systemctl.assert_called_once_with(
+            "set-property", "--runtime", "w@1.service", "CPUQuota=50%"
+        )
+        self.assertFalse(os.path.exists(stale))
+        self.assertEqual(self.daemon_reload.call_count, 2)
+
+    def test_limits_from_config(self):
+        config = {"cpu_quota": "50%", "memory_max": "", "limit_nofile": "4096", "port": 80}
+        self.assertEqual(
+            systemd_extras.resource_limits_from_config(config),
+            {"CPUQuota": "50%", "LimitNOFILE": "4096"},
+        )
+
+    def test_unsupported_property(self):
+        with self.assertRaises(SystemdError):
+            systemd_extras.service_set_resource_limits("hello", {"Nice": "10"})
+
+
+class TestRunInScope(unittest.TestCase):
+    def test_low_priority_scope(self):
+        with patch.object(systemd_extras.subprocess, "run") as run:
+            run.return_value = MagicMock(returncode=0, stdout="done\n")
+            output = systemd_extras.run_in_scope(
+                "apt-get install -y hello",
+                unit_name="install.scope",
+                **systemd_extras.LOW_PRIORITY_SCOPE,
+            )
+
+        self.assertEqual(output, "done\n")
+        self.assertEqual(
+            run.call_args.args[0],
+            [
+                "systemd-run",
+                "--scope",
+                "--quiet",
+                "--unit=install.scope",
+                "--property=CPUWeight=20",
+                "--property=IOWeight=20",
+                "--property=MemoryHigh=1073741824",
+                "--",
+                "apt-get",
+                "install",
+                "-y",
+                "hello",
+            ],
+        )
+
+    def test_failed_command(self):
+        with patch.object(systemd_extras.subprocess, "run") as run:
+            run.return_value = MagicMock(returncode=100, stdout="E: Unable to locate package\n")
+            with self.assertRaisesRegex(SystemdError, "Unable to locate package"):
+                systemd_extras.run_in_scope(["apt-get", "install", "-y", "nope"])
+
+
+class TestCgroupStats(unittest.TestCase):
+    """Reads a fake cgroup v2 hierarchy in a temporary directory."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        (self.root / "cgroup.controllers").write_text("cpu io memory pids\n")
+        patcher = patch.object(systemd_extras, "CGROUP_ROOT", tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        systemd_extras._cgroup_paths.clear()
+        self.addCleanup(systemd_extras._cgroup_paths.clear)
+
+    def cgroup(self, unit="hello.service", parent="system.slice"):
+        path = self.root / parent / unit
+        path.mkdir(parents=True)
+        (path / "cpu.stat").write_text("usage_usec 2500000\nuser_usec 2000000\n")
+        (path / "memory.current").write_text("10485760\n")
+        (path / "memory.stat").write_text("anon 8388608\nfile 2097152\n")
+        (path / "io.stat").write_text(
+            "8:0 rbytes=4096 wbytes=8192 rios=1 wios=2\n8:16 rbytes=1024 wbytes=0 rios=1 wios=0\n"
+        )
+        return path
+
+    def test_service_cgroup_stats(self):
+        self.cgroup()
+        stats = systemd_extras.service_cgroup_stats("hello")
+
+        self.assertEqual(stats.service_name, "hello.service")
+        self.assertEqual(stats.cpu_usage_usec, 2500000)
+        self.assertEqual(stats.memory_current, 10485760)
+        self.assertEqual(stats.memory_stat, {"anon": 8388608, "file": 2097152})
+        self.assertEqual(stats.io_read_bytes, 5120)
+        self.assertEqual(stats.io_write_bytes, 8192)
+
+    def test_missing_controllers_read_as_zero(self):
+        path = self.cgroup()
+        for name in ("memory.current", "memory.stat", "io.stat"):
+            (path / name).unlink()
+        stats = systemd_extras.service_cgroup_stats("hello.service")
+
+        self.assertEqual(stats.cpu_usage_usec, 2500000)
+        self.assertEqual(
+            (stats.memory_current, stats.memory_stat, stats.io_read_bytes, stats.io_write_bytes),
+            (0, {}, 0, 0),
+        )
+
+    def test_service_outside_system_slice(self):
+        path = self.cgroup("hello.service", "user.slice/user-1000.slice")
+        self.assertEqual(systemd_extras.service_cgroup_path("hello"), str(path))
+
+    def test_no_cgroup(self):
+        with self.assertRaisesRegex(SystemdError, "is it running"):
+            systemd_extras.service_cgroup_stats("hello")
+
+    def test_no_cgroup_v2(self):
+        (self.root / "cgroup.controllers").unlink()
+        self.cgroup()
+        with self.assertRaisesRegex(SystemdError, "No cgroup v2"):
+            systemd_extras.service_cgroup_stats("hello")
+
+    def test_as_dict_round_trip(self):
+        self.cgroup()
+        stats = systemd_extras.service_cgroup_stats("hello")
+        copy = systemd_extras.CgroupStats.from_dict(stats.as_dict())
+        self.assertEqual(copy.as_dict(), stats.as_dict())
+
+
+class TestCgroupRates(unittest.TestCase):
+    def sample(self, timestamp, cpu_usage_usec, io_read_bytes=0, io_write_bytes=0):
+        return systemd_extras.CgroupStats(
+            service_name="hello.service",
+            timestamp=timestamp,
+            cpu_usage_usec=cpu_usage_usec,
+            memory_current=0,
+            memory_stat={},
+            io_read_bytes=io_read_bytes,
+            io_write_bytes=io_write_bytes,
+        )
+
+    def test_rates(self):
+        before = self.sample(100.0, 1000000, io_read_bytes=0, io_write_bytes=4096)
+        after = self.sample(110.0, 6000000, io_read_bytes=10240, io_write_bytes=4096)
+        self.assertEqual(
+            after.rates(before),
+            {"cpu_percent": 50.0, "io_read_bytes_per_sec": 1024.0, "io_write_bytes_per_sec": 0.0},
+        )
+
+    def test_counter_reset_is_not_a_negative_rate(self):
+        # The service restarted between the samples, with a new cgroup.
+        before = self.sample(100.0, 9000000, io_read_bytes=10240)
+        after = self.sample(110.0, 1000000, io_read_bytes=0)
+        rates = after.rates(before)
+        self.assertEqual(rates["cpu_percent"], 0.0)
+        self.assertEqual(rates["io_read_bytes_per_sec"], 0.0)
+
+    def test_no_elapsed_time(self):
+        sample = self.sample(100.0, 1000000)
+        self.assertEqual(sample.rates(self.sample(100.0, 0))["cpu_percent"], 0.0)
+
+
+class TestJournalReader(unittest.TestCase):
+    """Streams fake `journalctl -o json` output."""
+
+    def setUp(self):
+        patcher = patch.object(systemd_extras.subprocess, "Popen")
+        self.popen = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(systemd_extras.subprocess, "run")
+        self.run = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def journal(self, *entries, returncode=0, stderr=""):
+        """Make the next `journalctl` print `entries`, as (cursor, priority, message)."""
+        proc = MagicMock(returncode=returncode)
+        proc.__enter__.return_value = proc
+        proc.stdout = [
+            json.dumps(
+                {
+                    "__CURSOR": cursor,
+                    "__REALTIME_TIMESTAMP": "1700000000000000",
+                    "PRIORITY": str(priority),
+                    "MESSAGE": message,
+                }
+            )
+            + "\n"
+            for cursor, priority, message in entries
+        ]
+        proc.stderr.read.return_value = stderr
+        self.popen.return_value = proc
+
+    def command(self):
+        return self.popen.call_args.args[0]
+
+    def test_first_read_is_history(self):
+        reader = systemd_extras.JournalReader("hello", max_entries=2)
+        self.journal(("c1", 3, "failed"), ("c2", 6, "started"))
+
+        self.assertEqual(reader.read(), 2)
+        self.assertEqual(
+            self.command(),
+            ["journalctl", "--unit=hello.service", "--output=json", "--lines=2"],
+        )
+        self.assertEqual(reader.cursor, "c2")
+        self.assertEqual(reader.priority_counts, {})
+        self.assertEqual(
+            list(reader.entries),
+            [
+                {"timestamp": 1700000000.0, "priority": 3, "message": "failed"},
+                {"timestamp": 1700000000.0, "priority": 6, "message": "started"},
+            ],
+        )
+
+    def test_reads_after_the_cursor_are_counted(self):
+        reader = systemd_extras.JournalReader("hello", cursor="c2", max_entries=2)
+        self.journal(("c3", 2, "crit"), ("c4", 3, "err"), ("c5", 6, "info"))
+
+        self.assertEqual(reader.read(), 3)
+        self.assertEqual(self.command()[-1], "--after-cursor=c2")
+        self.assertEqual(reader.cursor, "c5")
+        self.assertEqual(reader.priority_counts, {2: 1, 3: 1, 6: 1})
+        self.assertEqual(reader.errors, 2)
+        self.assertEqual([entry["message"] for entry in reader.entries], ["err", "info"])
+
+        self.journal(("c6", 3, "err"))
+        reader.read()
+        self.assertEqual(self.command()[-1], "--after-cursor=c5")
+        self.assertEqual(reader.priority_counts, {2: 1, 3: 2, 6: 1})
+
+    def test_nothing_new_keeps_the_cursor(self):
+        reader = systemd_extras.JournalReader("hello", cursor="c2")
+        self.journal()
+        self.assertEqual(reader.read(), 0)
+        self.assertEqual(reader.cursor, "c2")
+
+    def test_empty_history_starts_at_the_end_of_the_journal(self):
+        reader = systemd_extras.JournalReader("hello")
+        self.journal()
+        self.run.return_value = MagicMock(
+            returncode=0, stdout=json.dumps({"__CURSOR": "end"}) + "\n"
+        )
+
+        self.assertEqual(reader.read(), 0)
+        self.assertEqual(reader.cursor, "end")
+        self.assertEqual(self.run.call_args.args[0], ["journalctl", "--lines=1", "--output=json"])
+
+    def test_binary_message(self):
+        reader = systemd_extras.JournalReader("hello", cursor="c1")
+        self.journal(("c2", 6, list(b"caf\xc3\xa9 \xff")))
+        reader.read()
+        self.assertEqual(reader.entries[0]["message"], "café \ufffd")
+
+    def test_journalctl_failure(self):
+        reader = systemd_extras.JournalReader("hello", cursor="c1")
+        self.journal(returncode=1, stderr="Failed to seek to cursor")
+        with self.assertRaisesRegex(SystemdError, "Failed to seek to cursor"):
+            reader.read()
+
+
+class TestSocketUnits(SystemdTestCase):
+    def test_render_socket_unit(self):
+        self.assertEqual(
+            systemd_extras.render_socket_unit("8080", description="Greeting", accept=True),
+            "# Managed by the charm, do not edit.\n"
+            "[Unit]\n"
+            "Description=Greeting socket\n"
+            "\n"
+            "[Socket]\n"
+            "ListenStream=8080\n"
+            "Accept=yes\n"
+            "\n"
+            "[Install]\n"
+            "WantedBy=sockets.target\n",
+        )
+
+    def test_render_socket_unit_for_a_service(self):
+        self.assertEqual(
+            systemd_extras.render_socket_unit(
+                "10.0.0.1:8080", description="App", service="app-proxy.service", backlog=1024
+            ),
+            "# Managed by the charm, do not edit.\n"
+            "[Unit]\n"
+            "Description=App socket\n"
+            "\n"
+            "[Socket]\n"
+            "ListenStream=10.0.0.1:8080\n"
+            "Accept=no\n"
+            "Service=app-proxy.service\n"
+            "Backlog=1024\n"
+            "\n"
+            "[Install]\n"
+            "WantedBy=sockets.target\n",
+        )
+
+    def test_render_socket_proxy_unit(self):
+        self.assertEqual(
+            systemd_extras.render_socket_proxy_unit(
+                "127.0.0.1:18080", description="App", requires="app.service"
+            ),
+            "# Managed by the charm, do not edit.\n"
+            "[Unit]\n"
+            "Description=App socket proxy\n"
+            "Requires=app.service\n"
+            "After=app.service\n"
+            "\n"
+            "[Service]\n"
+            "ExecStart=/lib/systemd/systemd-socket-proxyd 127.0.0.1:18080\n",
+        )
+
+    def test_install_and_remove_unit(self):
+        content = systemd_extras.render_socket_unit("8080", description="App")
+        self.assertTrue(systemd_extras.install_unit("app.socket", content))
+        self.assertFalse(systemd_extras.install_unit("app.socket", content))
+        self.assertEqual((self.tmp / "etc" / "app.socket").read_text(), content)
+
+        self.assertTrue(systemd_extras.install_unit("app.socket", "[Socket]\n", dropin="10.conf"))
+        self.assertTrue((self.tmp / "etc" / "app.socket.d" / "10.conf").is_file())
+
+        self.assertTrue(systemd_extras.remove_unit("app.socket"))
+        self.assertFalse(systemd_extras.remove_unit("app.socket"))
+        self.assertTrue(systemd_extras.remove_unit("app.socket", dropin="10.conf"))
@@ -0,0 +1,201 @@
+# Copyright 2023 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""Rolling restarts of a workload, coordinated over a peer relation.
+
+Without coordination, every unit of an application restarts its workload in the same
+`config-changed` hook, which briefly takes the whole application out of service. This
+library hands out restart tokens through the leader, so that at most `max_concurrent`
+units restart at the same time, and a token is only returned once the restarted unit
+reports healthy again.
+
+The protocol only uses the peer relation databags:
+
+- Each unit publishes its own `state` in its unit databag: `idle`, `requested` or
+  `restarting`. A restart requested while the unit is `restarting` sets `follow_up`, and
+  the unit restarts once more, with the token it holds, as soon as it is healthy.
+- The leader publishes the JSON list of units currently holding a token under `granted`
+  in the application databag.
+
+Example usage:
+
+```python
+from charms.corehooks_all.v0.rolling_restart import RollingRestart
+
+class MyCharm(ops.CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._rolling_restart = RollingRestart(
+            self,
+            relation_name="restart",
+            restart=self._restart_workload,
+            healthy=self._workload_healthy,
+            max_concurrent=self.config["max_concurrent_restarts"],
+        )
+
+    def _on_config_changed(self, event):
+        ...
+        self._rolling_restart.request_restart()
+```
+
+This library is not published on Charmhub. corehooks-all owns it; the charms using it carry a
+copy of this file, copied by hand, which must stay identical to the one in corehooks-all.
+
+The peer relation must be declared in metadata.yaml:
+
+```yaml
+peers:
+  restart:
+    interface: rolling_restart
+```
+"""
+
+import json
+import logging
+from typing import Callable, List, Optional
+
+from ops.charm import CharmBase
+from ops.framework import Object
+from ops.model import Relation
+
+logger = logging.getLogger(__name__)
+
+# Not published on Charmhub, so there is no LIBID. Increment LIBPATCH on every change, and
+# copy the file to the charms using it.
+LIBAPI = 0
+LIBPATCH = 3
+
+DEFAULT_RELATION_NAME = "restart"
+
+STATE_KEY = "state"
+GRANTED_KEY = "granted"
+FOLLOW_UP_KEY = "follow_up"
+
+IDLE = "idle"
+REQUESTED = "requested"
+RESTARTING = "restarting"
+
+
+class RollingRestart(Object):
+    """Hand out restart tokens to the units of an application, at most K at a time."""
+
+    def __init__(
+        self,
+        charm: CharmBase,
+        restart: Callable[[], None],
+        healthy: Callable[[], bool],
+        relation_name: str = DEFAULT_RELATION_NAME,
+        max_concurrent: int = 1,
+    ):
+        """Create a RollingRestart instance.
+
+        Args:
+            charm: The `CharmBase` instance that is instantiating this object.
+            restart: Callable restarting the workload on this unit.
+            healthy: Callable reporting whether the workload on this unit is healthy.
+            relation_name: The name of the peer relation to coordinate over.
+            max_concurrent: The maximum number of units restarting at the same time.
+        """
+        super().__init__(charm, relation_name)
+        self._charm = charm
+        self._restart = restart
+        self._healthy = healthy
+        self._relation_name = relation_name
+        self._max_concurrent = max(1, int(max_concurrent))
+
+        events = self._charm.on[relation_name]
+        self.framework.observe(events.relation_changed, self._on_advance)
+        self.framework.observe(events.relation_departed, self._on_advance)
+        self.framework.observe(self._charm.on.leader_elected, self._on_advance)
+        # A restarted unit which was not yet healthy is re-checked periodically.
+        self.framework.observe(self._charm.on.update_status, self._on_advance)
+
+    @property
+    def _relation(self) -> Optional[Relation]:
+        return self.model.get_relation(self._relation_name)
+
+    @property
+    def state(self) -> str:
+        """Return the restart state of this unit."""
+        if not (relation := self._relation):
+            return IDLE
+        return relation.data[self._charm.unit].get(STATE_KEY, IDLE)
+
+    def request_restart(self) -> None:
+        """Ask the leader for a restart token; the workload restarts once it is granted.
+
+        Without a peer relation (e.g. before the unit has joined it) there is nobody
+        to coordinate with, so the workload is restarted straight away.
+        """
+        if not (relation := self._relation):
+            logger.info("No peer relation to coordinate over, restarting immediately.")
+            self._restart()
+            return
+
+        if self.state == RESTARTING:
+            # The running restart may have read the config before it changed.
+            logger.info("Restart in progress, requesting another one once it is done.")
+            relation.data[self._charm.unit][FOLLOW_UP_KEY] = "true"
+            return
+        if self.state != IDLE:
+            logger.debug(f"Restart already {self.state}, not requesting another one.")
+            return
+
+        logger.info("Requesting a restart token.")
+        relation.data[self._charm.unit][STATE_KEY] = REQUESTED
+        self._advance(relation)
+
+    def _on_advance(self, _):
+        if relation := self._relation:
+            self._advance(relation)
+
+    def _advance(self, relation: Relation) -> None:
+        """Move this unit, and as leader the whole application, through the protocol."""
+        if self._charm.unit.is_leader():
+            self._grant(relation)
+
+        state = relation.data[self._charm.unit].get(STATE_KEY, IDLE)
+        if state == REQUESTED and self._charm.unit.name in self._granted(relation):
+            logger.info("Restart token granted, restarting.")
+            relation.data[self._charm.unit][STATE_KEY] = state = RESTARTING
+            self._restart()
+
+        if state == RESTARTING:
+            if not self._healthy():
+                logger.info("Workload not healthy yet, holding on to the restart token.")
+                return
+            if relation.data[self._charm.unit].get(FOLLOW_UP_KEY):
+                logger.info("Workload healthy, restarting again for a follow-up request.")
+                del relation.data[self._charm.unit][FOLLOW_UP_KEY]
+                # The token is kept, the leader does not take it from a requesting unit.
+                relation.data[self._charm.unit][STATE_KEY] = REQUESTED
+                self._advance(relation)
+                return
+            logger.info("Workload healthy, releasing the restart token.")
+            relation.data[self._charm.unit][STATE_KEY] = IDLE
+            # The leader does not see its own databag changes as relation-changed events.
+            if self._charm.unit.is_leader():
+                self._advance(relation)
+
+    @staticmethod
+    def _granted(relation: Relation) -> List[str]:
+        return json.loads(relation.data[relation.app].get(GRANTED_KEY, "[]"))
+
+    def _grant(self, relation: Relation) -> None:
+        """Release the tokens of units that are done and grant free tokens in unit order."""
+        states = {
+            unit.name: relation.data[unit].get(STATE_KEY, IDLE)
+            for unit in (self._charm.unit, *relation.units)
+        }
+        current = self._granted(relation)
+        granted = [name for name in current if states.get(name) in (REQUESTED, RESTARTING)]
+        waiting = sorted(
+            (name for name, state in states.items() if state == REQUESTED and name not in granted),
+            key=lambda name: int(name.rsplit("/", 1)[1]),
+        )
+        free = self._max_concurrent - len(granted)
+        granted.extend(waiting[: max(0, free)])
+
+        if granted != current:
+            logger.info(f"Restart tokens held by: {granted or 'nobody'}")
+            relation.data[relation.app][GRANTED_KEY] = json.dumps(granted)
@@ -0,0 +1,1771 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+r"""## Overview.
+
+This library is the `cos_agent` library of the Grafana Agent charm,
+`charms.grafana_agent.v0.cos_agent`, extended with the features used by the observed charm:
+scrape options and labels, log files, recording rules, build-time packs, dashboards by digest,
+chunked payloads and config rendering. It stays compatible on the wire with that library in
+both directions: payload features are only used once the requirer lists them (see "Requirer
+features" below), and fields missing from a provider's payload take their defaults.
+
+It is not published on Charmhub, so it can't be fetched with `charmcraft fetch-lib`: the
+observed charm owns it, and charms using it carry a copy of this file, copied by hand.
+
+This library can be used to manage the cos_agent relation interface:
+
+- `COSAgentProvider`: Use in machine charms that need to have a workload's metrics
+  or logs scraped, or forward rule files or dashboards to Prometheus, Loki or Grafana through
+  the Grafana Agent machine charm.
+
+- `COSAgentConsumer`: Used in the Grafana Agent machine charm to manage the requirer side of
+  the `cos_agent` interface.
+
+- `COSAgentConfigRenderer`: Used with `COSAgentConsumer` to write the Grafana Agent config,
+  and reload the agent, only when the config changed.
+
+
+## COSAgentProvider Library Usage
+
+Grafana Agent machine Charmed Operator interacts with its clients using the cos_agent library.
+Charms seeking to send telemetry, must do so using the `COSAgentProvider` object from
+this charm library.
+
+Using the `COSAgentProvider` object only requires instantiating it,
+typically in the `__init__` method of your charm (the one which sends telemetry).
+
+The constructor of `COSAgentProvider` has only one required and thirteen optional parameters:
+
+```python
+    def __init__(
+        self,
+        charm: CharmType,
+        relation_name: str = DEFAULT_RELATION_NAME,
+        metrics_endpoints: Optional[List[_MetricsEndpointDict]] = None,
+        metrics_rules_dir: str = "./src/prometheus_alert_rules",
+        logs_rules_dir: str = "./src/loki_alert_rules",
+        recurse_rules_dirs: bool = False,
+        log_slots: Optional[List[str]] = None,
+        dashboard_dirs: Optional[List[str]] = None,
+        refresh_events: Optional[List] = None,
+        dashboard_compression_preset: int = lzma.PRESET_DEFAULT,
+        dashboard_compression_filters: Optional[List[Dict[str, Any]]] = None,
+        pack_path: str = DEFAULT_PACK_PATH,
+        recording_rules_dir: str = "./src/prometheus_recording_rules",
+        log_files: Optional[List[_LogFileDict]] = None,
+    ):
+```
+
+### Parameters
+
+- `charm`: The instance of the charm that instantiates `COSAgentProvider`, typically `self`.
+
+- `relation_name`: If your charmed operator uses a relation name other than `cos-agent` to use
+    the `cos_agent` interface, this is where you have to specify that.
+
+- `metrics_endpoints`: In this parameter you can specify the metrics endpoints that Grafana Agent
+    machine Charmed Operator will scrape. Besides `path` and `port`, an endpoint may set the
+    Prometheus scrape options `scrape_interval`, `scrape_timeout`, `sample_limit`, `label_limit`
+    and `honor_timestamps`, e.g. to scrape a high-cardinality endpoint less often.
+    To cut ingestion at the source, an endpoint may also set `metric_relabel_configs`, and
+    `keep_metrics` or `drop_metrics`: lists of regexes of the metric names to keep or drop.
+    The `labels` of an endpoint are added to every series scraped from it, e.g. to tell apart
+    several processes of the same workload.
+
+- `metrics_rules_dir`: The directory in which the Charmed Operator stores its metrics alert rules
+  files.
+
+- `logs_rules_dir`: The directory in which the Charmed Operator stores its logs alert rules files.
+
+- `recurse_rules_dirs`: This parameters set whether Grafana Agent machine Charmed Operator has to
+  search rules files recursively in the rules directories or not.
+
+- `log_slots`: Snap slots to connect to for scraping logs in the form ["snap-name:slot", ...].
+
+- `dashboard_dirs`: List of directories where the dashboards are stored in the Charmed Operator.
+
+- `refresh_events`: List of events on which to refresh relation data.
+
+- `dashboard_compression_preset`: The lzma preset the dashboards are compressed with, e.g.
+  `9 | lzma.PRESET_EXTREME` for the smallest databags at the expense of CPU time.
+
+- `dashboard_compression_filters`: An lzma filter chain to use instead of the preset, see
+  https://docs.python.org/3/library/lzma.html#filter-chain-specs.
+
+- `pack_path`: A pack of the rules and dashboards built with this library (see below).
+  If it exists, it is used instead of the rules and dashboard directories. Its dashboards are
+  compressed when the pack is built, so the compression parameters above do not apply to it.
+
+- `recording_rules_dir`: The directory in which the Charmed Operator stores its Prometheus
+  recording rules files. The juju topology is injected into them as into the alert rules, so
+  that dashboards and alert rules can query the cheaper, pre-aggregated series they record.
+
+- `log_files`: Log files for Grafana Agent to tail, as `{"path": glob, ...}`. Each file may set
+  `labels` added to its log lines, `keep_lines` or `drop_lines`: lists of regexes matched
+  anywhere in a line, and `rate_limit` (with an optional `rate_burst`): the lines per second
+  above which lines are dropped. Lines are filtered, then rate limited, by Grafana Agent.
+
+
+### Example 1 - Minimal instrumentation:
+
+In order to use this object the following should be in the `charm.py` file.
+
+```python
+from charms.observed.v0.cos_agent import COSAgentProvider
+...
+class TelemetryProviderCharm(CharmBase):
+    def __init__(self, *args):
+        ...
+        self._grafana_agent = COSAgentProvider(self)
+```
+
+### Example 2 - Full instrumentation:
+
+In order to use this object the following should be in the `charm.py` file.
+
+```python
+from charms.observed.v0.cos_agent import COSAgentProvider
+...
+class TelemetryProviderCharm(CharmBase):
+    def __init__(self, *args):
+        ...
+        self._grafana_agent = COSAgentProvider(
+            self,
+            relation_name="custom-cos-agent",
+            metrics_endpoints=[
+                {"path": "/metrics", "port": 9000},
+                {"path": "/metrics", "port": 9001},
+                {"path": "/metrics", "port": 9002, "scrape_interval": "5m", "sample_limit": 5000},
+                {"path": "/metrics", "port": 9003, "keep_metrics": ["myapp_.*", "process_.*"]},
+                {"path": "/metrics", "port": 9004, "labels": {"worker": "1"}},
+            ],
+            metrics_rules_dir="./src/alert_rules/prometheus",
+            logs_rules_dir="./src/alert_rules/loki",
+            recording_rules_dir="./src/recording_rules/prometheus",
+            recursive_rules_dir=True,
+            log_slots=["my-app:slot"],
+            log_files=[
+                {
+                    "path": "/var/log/my-app/*.log",
+                    "labels": {"service": "my-app"},
+                    "drop_lines": ["level=debug"],
+                    "rate_limit": 100,
+                },
+            ],
+            dashboard_dirs=["./src/dashboards_1", "./src/dashboards_2"],
+            refresh_events=["update-status", "upgrade-charm"],
+        )
+```
+
+### Packing rules and dashboards at build time
+
+Instead of reading, validating and compressing the rule and dashboard files at runtime, a charm
+can pack them when it is built. The pack is a single JSON file with the rule files (validated
+when packed, and loaded with the juju topology at runtime) and the compressed dashboards, and
+the digest of both.
+For example in charmcraft.yaml:
+
+```yaml
+parts:
+  charm:
+    override-build: |
+      craftctl default
+      cd $CRAFT_PART_INSTALL
+      PYTHONPATH=lib:venv python3 -m charms.observed.v0.cos_agent pack \
+          --metrics-rules-dir src/prometheus_alert_rules \
+          --logs-rules-dir src/loki_alert_rules \
+          --recording-rules-dir src/prometheus_recording_rules \
+          --dashboard-dir src/grafana_dashboards \
+          --output src/cos_agent_pack.json
+```
+
+Invalid rule files or dashboards fail the build. Note that a pack left in the source tree takes
+precedence over the directories, so do not commit it. The dashboards are compressed with the
+`--preset` or `--filters` (a JSON filter chain, filter ids by name) given to `pack`, e.g.
+`--filters '[{"id": "FILTER_LZMA2", "preset": 9}]'`, and the compression parameters of
+`COSAgentProvider` are ignored.
+
+### Requirer features
+
+Requirers list the payload features they support under `features` in their unit databag of the
+`cos_agent` relation (see `REQUIRER_FEATURES`). Providers only use a feature the requirer
+lists, and otherwise send the payload that every requirer reads: inline dashboards, under a
+single databag key.
+
+### Dashboards
+
+Dashboards are addressed by content: the leader unit of the principal application publishes
+every dashboard once in the application databag, keyed by its digest, and each unit only
+sends the digests in its unit databag. Grafana Agent units forward the digests to their peers
+and publish each dashboard in peer data only if no peer did so yet, so the data exchanged no
+longer grows with the number of principal units. This needs the `dashboard_digests` feature;
+requirers resolve inline `dashboards` as before.
+
+### Large payloads
+
+With the `chunks` feature, data larger than `DATABAG_CHUNK_SIZE` is split into chunks stored
+under `<key>-0`, `<key>-1`, ..., with the digests of the chunks listed under `<key>-manifest`.
+Data is split on record boundaries, e.g. one rule group or dashboard per chunk, and only
+chunks whose content changed are rewritten. Smaller data stays under the single key.
+
+## COSAgentConsumer Library Usage
+
+This object may be used by any Charmed Operator which gathers telemetry data by
+implementing the consumer side of the `cos_agent` interface.
+For instance Grafana Agent machine Charmed Operator.
+
+For this purpose the charm needs to instantiate the `COSAgentConsumer` object with one mandatory
+and two optional arguments.
+
+### Parameters
+
+- `charm`: A reference to the parent (Grafana Agent machine) charm.
+
+- `relation_name`: The name of the relation that the charm uses to interact
+  with its clients that provides telemetry data using the `COSAgentProvider` object.
+
+  If provided, this relation name must match a provided relation in metadata.yaml with the
+  `cos_agent` interface.
+  The default value of this argument is "cos-agent".
+
+- `refresh_events`: List of events on which to refresh relation data.
+
+- `dashboards_cache_path`: File in which decompressed dashboards are kept across hooks, by
+  digest. Defaults to `.cos_agent_dashboards.json` in the charm directory. It holds the
+  dashboards currently in peer data, the others are dropped.
+
+
+### Example 1 - Minimal instrumentation:
+
+In order to use this object the following should be in the `charm.py` file.
+
+```python
+from charms.observed.v0.cos_agent import COSAgentConsumer
+...
+class GrafanaAgentMachineCharm(GrafanaAgentCharm)
+    def __init__(self, *args):
+        ...
+        self._cos = COSAgentRequirer(self)
+```
+
+
+### Example 2 - Full instrumentation:
+
+In order to use this object the following should be in the `charm.py` file.
+
+```python
+from charms.observed.v0.cos_agent import COSAgentConsumer
+...
+class GrafanaAgentMachineCharm(GrafanaAgentCharm)
+    def __init__(self, *args):
+        ...
+        self._cos = COSAgentRequirer(
+            self,
+            relation_name="cos-agent-consumer",
+            refresh_events=["update-status", "upgrade-charm"],
+        )
+```
+
+### Rendering the agent config
+
+`COSAgentConfigRenderer` writes the Grafana Agent config built from the requirer data to a
+file, and reloads the agent, only if the config changed: the rendered config is compared
+with the file on disk. If the reload fails, the previous file is put back, so that the next
+update reloads again. It updates the config on every `data_changed` event, and whenever
+`update()` is called, e.g. when the charm's own config changed.
+
+```python
+        self._cos = COSAgentRequirer(self)
+        self._renderer = COSAgentConfigRenderer(
+            self._cos,
+            "/etc/grafana-agent.yaml",
+            reload=lambda: systemd.service_reload("grafana-agent"),
+            build=self._agent_config,
+        )
+
+    def _agent_config(self, renderer: COSAgentConfigRenderer) -> Dict[str, Any]:
+        config = renderer.default_config()
+        config["metrics"]["global"] = {"remote_write": self._remote_write_configs}
+        return config
+```
+
+Without `build`, the config only has the scrape configs of the principal, as
+`metrics.configs` and `logs.configs`.
+
+### Data changed events
+
+`COSAgentRequirer` emits `data_changed` only when the data of a principal application
+changed, which is tracked per application by digest in stored state. `event.changes` maps
+each changed application to the changed categories: `metrics_alert_rules`, `log_alert_rules`,
+`metrics_recording_rules`, `dashboards`, `metrics_scrape_jobs`, `log_slots` and `log_files`.
+An application that went away is listed with all the categories it had.
+
+```python
+    def _on_cos_data_changed(self, event):
+        if "dashboards" in event.categories:
+            self._update_dashboards()
+        if event.categories & {"metrics_alert_rules", "log_alert_rules"}:
+            self._update_alert_rules(event.apps)
+        if "metrics_recording_rules" in event.categories:
+            self._update_recording_rules(event.apps)
+```
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import lzma
+import os
+import sys
+import tempfile
+from collections import namedtuple
+from itertools import chain
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    ClassVar,
+    Dict,
+    List,
+    MutableMapping,
+    Optional,
+    Set,
+    Type,
+    Union,
+)
+
+import pydantic
+import yaml
+from cosl import JujuTopology
+from cosl.rules import AlertRules, RecordingRules, Rules
+from ops.charm import RelationChangedEvent, RelationEvent
+from ops.framework import EventBase, EventSource, Object, ObjectEvents, StoredState
+from ops.model import Relation, Unit
+from ops.testing import CharmType
+
+if TYPE_CHECKING:
+    try:
+        from typing import TypedDict
+
+        class _MetricsEndpointRequired(TypedDict):
+            path: str
+            port: int
+
+        class _MetricsEndpointDict(_MetricsEndpointRequired, total=False):
+            scrape_interval: str
+            scrape_timeout: str
+            sample_limit: int
+            label_limit: int
+            honor_timestamps: bool
+            metric_relabel_configs: List[Dict[str, Any]]
+            keep_metrics: List[str]
+            drop_metrics: List[str]
+            labels: Dict[str, str]
+
+        class _LogFileRequired(TypedDict):
+            path: str
+
+        class _LogFileDict(_LogFileRequired, total=False):
+            labels: Dict[str, str]
+            keep_lines: List[str]
+            drop_lines: List[str]
+            rate_limit: float
+            rate_burst: int
+
+    except ModuleNotFoundError:
+        _MetricsEndpointDict = dict
+        _LogFileDict = dict
+
+# Not published on Charmhub, so there is no LIBID. Increment LIBPATCH on every change.
+LIBAPI = 0
+LIBPATCH = 4
+
+PYDEPS = ["cosl", "pydantic"]
+
+DEFAULT_RELATION_NAME = "cos-agent"
+DEFAULT_PEER_RELATION_NAME = "peers"
+DEFAULT_METRICS_ENDPOINT = {
+    "path": "/metrics",
+    "port": 80,
+}
+# Optional metrics endpoint keys, passed through to the scrape job configs as they are.
+SCRAPE_JOB_OPTIONS = (
+    "scrape_interval",
+    "scrape_timeout",
+    "sample_limit",
+    "label_limit",
+    "honor_timestamps",
+)
+# Metrics endpoint keys with regexes of the metric names to keep or drop, and their actions.
+METRIC_NAME_FILTERS = {"keep_metrics": "keep", "drop_metrics": "drop"}
+DEFAULT_PACK_PATH = "./src/cos_agent_pack.json"
+PACK_VERSION = 3
+# The suffixes of the rule files read by `Rules.add_path`.
+RULE_FILE_SUFFIXES = (".rule", ".rules", ".yml", ".yaml")
+DEFAULT_DASHBOARDS_CACHE_FILE = ".cos_agent_dashboards.json"
+# Databag values larger than this are split into chunks. See `_write_chunked`.
+DATABAG_CHUNK_SIZE = 64 * 1024
+# Unit databag key of the cos_agent relation, where the requirer lists its features.
+FEATURES_KEY = "features"
+# The requirer reassembles chunked payloads.
+FEATURE_CHUNKS = "chunks"
+# The requirer resolves dashboard digests against the dashboards in the app databag.
+FEATURE_DASHBOARD_DIGESTS = "dashboard_digests"
+REQUIRER_FEATURES = [FEATURE_CHUNKS, FEATURE_DASHBOARD_DIGESTS]
+
+logger = logging.getLogger(__name__)
+SnapEndpoint = namedtuple("SnapEndpoint", "owner, name")
+
+
+class GrafanaDashboard(str):
+    """Grafana Dashboard encoded json; lzma-compressed."""
+
+    # Bytes read from a dashboard file at a time; a multiple of 3, for incremental base64.
+    READ_SIZE: ClassVar[int] = 48 * 1024
+
+    @property
+    def digest(self) -> str:
+        """Return the content address of the encoded dashboard."""
+        return hashlib.sha256(self.encode("utf-8")).hexdigest()
+
+    # TODO Replace this with a custom type when pydantic v2 released (end of 2023 Q1?)
+    # https://github.com/pydantic/pydantic/issues/4887
+    @staticmethod
+    def _serialize(
+        raw_json: Union[str, bytes],
+        preset: int = lzma.PRESET_DEFAULT,
+        filters: Optional[List[Dict[str, Any]]] = None,
+    ) -> "GrafanaDashboard":
+        if not isinstance(raw_json, bytes):
+            raw_json = raw_json.encode("utf-8")
+        compressed = lzma.compress(raw_json, **GrafanaDashboard._compression(preset, filters))
+        encoded = base64.b64encode(compressed).decode("utf-8")
+        return GrafanaDashboard(encoded)
+
+    @staticmethod
+    def _serialize_file(
+        path: Union[str, Path],
+        preset: int = lzma.PRESET_DEFAULT,
+        filters: Optional[List[Dict[str, Any]]] = None,
+    ) -> "GrafanaDashboard":
+        """Serialize a dashboard file, streaming it through the compressor and base64.
+
+        Only the encoded result is held in memory in full, never the raw or compressed file.
+        """
+        compressor = lzma.LZMACompressor(**GrafanaDashboard._compression(preset, filters))
+        encoded: List[str] = []
+        pending = b""
+
+        def encode(compressed: bytes, final: bool = False):
+            nonlocal pending
+            pending += compressed
+            # base64 encodes 3 bytes at a time; keep the rest for the next chunk.
+            cut = len(pending) if final else len(pending) - len(pending) % 3
+            encoded.append(base64.b64encode(pending[:cut]).decode("utf-8"))
+            pending = pending[cut:]
+
+        with open(path, "rb") as f:
+            while chunk := f.read(GrafanaDashboard.READ_SIZE):
+                encode(compressor.compress(chunk))
+        encode(compressor.flush(), final=True)
+        return GrafanaDashboard("".join(encoded))
+
+    @staticmethod
+    def _compression(preset: int, filters: Optional[List[Dict[str, Any]]]) -> Dict[str, Any]:
+        # The xz format takes either a preset or a filter chain.
+        return {"filters": filters} if filters else {"preset": preset}
+
+    def _deserialize(self) -> Dict:
+        return json.loads(self._decompress())
+
+    def _decompress(self) -> str:
+        return lzma.decompress(base64.b64decode(self.encode("utf-8"))).decode()
+
+    def __repr__(self):
+        """Return string representation of self."""
+        return "<GrafanaDashboard>"
+
+
+def _digest(data: Any) -> str:
+    """Return a digest of JSON serializable data."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _write_chunked(
+    databag: MutableMapping[str, str],
+    key: str,
+    payload: str,
+    chunk_size: Optional[int] = DATABAG_CHUNK_SIZE,
+) -> None:
+    """Write a payload under a databag key, split into chunks if it is larger than `chunk_size`.
+
+    With no `chunk_size`, the payload is never split.
+
+    Chunks go under `<key>-0`, `<key>-1`, ..., and the list of their digests under
+    `<key>-manifest`. A JSON payload is split on record boundaries, see `_json_records`, so
+    that a record changing size does not move the records after it to other chunks. Only keys
+    whose value changed are written, so that a change rewrites the changed chunks only, and
+    identical data does not trigger relation-changed on the remote.
+    """
+    manifest_key = f"{key}-manifest"
+    old_count = len(json.loads(databag.get(manifest_key) or "[]"))
+
+    # An empty value removes a key.
+    if chunk_size is None or len(payload) <= chunk_size:
+        updates = {key: payload, manifest_key: ""}
+        chunks = []
+    else:
+        try:
+            records = _json_records(json.loads(payload), chunk_size)
+        except ValueError:
+            records = [payload]
+        # Records larger than a chunk are split at fixed offsets.
+        chunks = [
+            record[i : i + chunk_size]
+            for record in records
+            for i in range(0, len(record), chunk_size)
+        ]
+        updates = {f"{key}-{i}": chunk for i, chunk in enumerate(chunks)}
+        updates[manifest_key] = json.dumps([_chunk_digest(chunk) for chunk in chunks])
+        updates[key] = ""
+    updates.update((f"{key}-{i}", "") for i in range(len(chunks), old_count))
+
+    for k, value in updates.items():
+        if databag.get(k, "") != value:
+            databag[k] = value
+
+
+def _json_records(data: Any, chunk_size: int) -> List[str]:
+    """Serialize data as JSON, split after every item of the containers larger than a chunk.
+
+    Containers which fit in a chunk are kept whole, so a large payload is split into e.g. one
+    rule group or dashboard per record, with the JSON between items at the start of a record.
+
+    Returns:
+        The records, which joined are the JSON of `data`.
+    """
+    records: List[str] = []
+    current: List[str] = []
+
+    def emit(value: Any) -> bool:
+        """Serialize a value into `current`, and return whether it was split into records."""
+        text = json.dumps(value)
+        if len(text) <= chunk_size or not isinstance(value, (dict, list)):
+            current.append(text)
+            return False
+
+        if isinstance(value, dict):
+            opening, closing = "{", "}"
+            items = [(f"{json.dumps(k)}: ", v) for k, v in value.items()]
+        else:
+            opening, closing = "[", "]"
+            items = [("", v) for v in value]
+        current.append(opening)
+        for i, (prefix, item) in enumerate(items):
+            current.append(", " + prefix if i else prefix)
+            # An item which was split already ended its last record.
+            if not emit(item):
+                records.append("".join(current))
+                current.clear()
+        current.append(closing)
+        return True
+
+    emit(data)
+    if records:
+        records[-1] += "".join(current)
+    else:
+        records.append("".join(current))
+    return records
+
+
+def _read_chunked(databag: MutableMapping[str, str], key: str) -> Optional[str]:
+    """Read a payload written with `_write_chunked`, reassembling and verifying its chunks.
+
+    Returns None if there is no payload, or a chunk does not match its digest.
+    """
+    if not (manifest := databag.get(f"{key}-manifest")):
+        return databag.get(key)
+
+    chunks = []
+    for i, digest in enumerate(json.loads(manifest)):
+        chunk = databag.get(f"{key}-{i}", "")
+        if _chunk_digest(chunk) != digest:
+            logger.warning(f"chunk {i} of {key!r} does not match its digest; skipping for now...")
+            return None
+        chunks.append(chunk)
+    return "".join(chunks)
+
+
+def _chunk_digest(chunk: str) -> str:
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
+
+class _DashboardsCache:
+    """Decompressed dashboards by digest, kept in a file across hooks.
+
+    The file is only read when a dashboard is first looked up. It is not limited in size, but
+    only keeps the dashboards in use, see `retain`, so that every dashboard in use is a hit.
+    """
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._entries: Optional[Dict[str, str]] = None
+        self._saved: Set[str] = set()
+
+    def get(self, dashboard: GrafanaDashboard, digest: Optional[str] = None) -> Dict:
+        """Return the content of an encoded dashboard, decompressing it only if not cached."""
+        entries = self._load()
+        digest = digest or dashboard.digest
+        if digest not in entries:
+            entries[digest] = dashboard._decompress()
+        # Parsed for every caller, so that nobody can modify the cached content.
+        return json.loads(entries[digest])
+
+    def retain(self, digests: Set[str]) -> None:
+        """Drop the dashboards whose digest is not in `digests`."""
+        entries = self._load()
+        for digest in entries.keys() - digests:
+            del entries[digest]
+
+    def save(self) -> None:
+        """Write the cache back to its file, if any dashboard was added or dropped."""
+        if self._entries is None or self._entries.keys() == self._saved:
+            return
+        tmp_path = self._path.with_name(self._path.name + ".tmp")
+        try:
+            tmp_path.write_text(json.dumps(self._entries))
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            logger.debug(f"could not save the dashboards cache to {self._path}: {e}")
+            return
+        self._saved = set(self._entries)
+
+    def _load(self) -> Dict[str, str]:
+        if self._entries is None:
+            try:
+                self._entries = dict(json.loads(self._path.read_text()))
+            except (OSError, ValueError):
+                # Missing or corrupt: start over.
+                self._entries = {}
+            self._saved = set(self._entries)
+        return self._entries
+
+
+class CosAgentProviderUnitData(pydantic.BaseModel):
+    """Unit databag model for `cos-agent` relation."""
+
+    # The following entries are the same for all units of the same principal.
+    # Note that the same grafana agent subordinate may be related to several apps.
+    # this needs to make its way to the gagent leader
+    metrics_alert_rules: dict
+    log_alert_rules: dict
+    # Not sent by providers using charms.grafana_agent.v0.cos_agent.
+    metrics_recording_rules: dict = {}
+    # Inline dashboards, unless the requirer supports FEATURE_DASHBOARD_DIGESTS. Then the
+    # digests are sent, and the leader publishes the dashboards in the app databag under
+    # DASHBOARDS_KEY.
+    dashboards: List[GrafanaDashboard]
+    dashboard_digests: Optional[List[str]] = None
+
+    # The following entries may vary across units of the same principal app.
+    # this data does not need to be forwarded to the gagent leader
+    metrics_scrape_jobs: List[Dict]
+    log_slots: List[str]
+    # Not sent by providers using charms.grafana_agent.v0.cos_agent.
+    log_files: List[Dict] = []
+
+    # when this whole datastructure is dumped into a databag, it will be nested under this key.
+    # while not strictly necessary (we could have it 'flattened out' into the databag),
+    # this simplifies working with the model.
+    KEY: ClassVar[str] = "config"
+    # App databag key of the JSON mapping of dashboard digests to encoded dashboards.
+    DASHBOARDS_KEY: ClassVar[str] = "dashboards"
+
+
+class CosAgentPeersUnitData(pydantic.BaseModel):
+    """Unit databag model for `cluster` cos-agent machine charm peer relation."""
+
+    # We need the principal unit name and relation metadata to be able to render identifiers
+    # (e.g. topology) on the leader side, after all the data moves into peer data (the grafana
+    # agent leader can only see its own principal, because it is a subordinate charm).
+    principal_unit_name: str
+    principal_relation_id: str
+    principal_relation_name: str
+
+    # The only data that is forwarded to the leader is data that needs to go into the app databags
+    # of the outgoing o11y relations.
+    metrics_alert_rules: Optional[dict]
+    log_alert_rules: Optional[dict]
+    metrics_recording_rules: Optional[dict] = None
+    dashboards: Optional[List[GrafanaDashboard]]
+    # Dashboards by digest; each one is published once, by any peer, under DASHBOARDS_KEY.
+    dashboard_digests: Optional[List[str]] = None
+
+    # when this whole datastructure is dumped into a databag, it will be nested under this key.
+    # while not strictly necessary (we could have it 'flattened out' into the databag),
+    # this simplifies working with the model.
+    KEY: ClassVar[str] = "config"
+    # Unit databag key of the JSON mapping of dashboard digests to encoded dashboards.
+    DASHBOARDS_KEY: ClassVar[str] = "dashboards"
+
+    @property
+    def app_name(self) -> str:
+        """Parse out the app name from the unit name.
+
+        TODO: Switch to using `model_post_init` when pydantic v2 is released?
+          https://github.com/pydantic/pydantic/issues/1729#issuecomment-1300576214
+        """
+        return self.principal_unit_name.split("/")[0]
+
+
+class COSAgentProvider(Object):
+    """Integration endpoint wrapper for the provider side of the cos_agent interface."""
+
+    _stored = StoredState()
+
+    def __init__(
+        self,
+        charm: CharmType,
+        relation_name: str = DEFAULT_RELATION_NAME,
+        metrics_endpoints: Optional[List["_MetricsEndpointDict"]] = None,
+        metrics_rules_dir: str = "./src/prometheus_alert_rules",
+        logs_rules_dir: str = "./src/loki_alert_rules",
+        recurse_rules_dirs: bool = False,
+        log_slots: Optional[List[str]] = None,
+        dashboard_dirs: Optional[List[str]] = None,
+        refresh_events: Optional[List] = None,
+        dashboard_compression_preset: int = lzma.PRESET_DEFAULT,
+        dashboard_compression_filters: Optional[List[Dict[str, Any]]] = None,
+        pack_path: str = DEFAULT_PACK_PATH,
+        recording_rules_dir: str = "./src/prometheus_recording_rules",
+        log_files: Optional[List["_LogFileDict"]] = None,
+    ):
+        """Create a COSAgentProvider instance.
+
+        Args:
+            charm: The `CharmBase` instance that is instantiating this object.
+            relation_name: The name of the relation to communicate over.
+            metrics_endpoints: List of endpoints in the form [{"path": path, "port": port}, ...],
+                optionally with the scrape options in `SCRAPE_JOB_OPTIONS`.
+            metrics_rules_dir: Directory where the metrics rules are stored.
+            logs_rules_dir: Directory where the logs rules are stored.
+            recurse_rules_dirs: Whether to recurse into rule paths.
+            log_slots: Snap slots to connect to for scraping logs
+                in the form ["snap-name:slot", ...].
+            dashboard_dirs: Directory where the dashboards are stored.
+            refresh_events: List of events on which to refresh relation data.
+            dashboard_compression_preset: The lzma preset to compress the dashboards with.
+            dashboard_compression_filters: An lzma filter chain to use instead of the preset.
+            pack_path: A pack of rules and dashboards, used instead of the directories.
+            recording_rules_dir: Directory where the metrics recording rules are stored.
+            log_files: List of log files in the form [{"path": glob}, ...], optionally with
+                labels, line filters and a rate limit.
+        """
+        super().__init__(charm, relation_name)
+        metrics_endpoints = metrics_endpoints or [DEFAULT_METRICS_ENDPOINT]
+        dashboard_dirs = dashboard_dirs or ["./src/grafana_dashboards"]
+
+        self._charm = charm
+        self._relation_name = relation_name
+        self._metrics_endpoints = metrics_endpoints
+        self._metrics_rules = metrics_rules_dir
+        self._logs_rules = logs_rules_dir
+        self._recording_rules = recording_rules_dir
+        self._recursive = recurse_rules_dirs
+        self._log_slots = log_slots or []
+        self._log_files = log_files or []
+        self._dashboard_dirs = dashboard_dirs
+        self._dashboard_preset = dashboard_compression_preset
+        self._dashboard_filters = dashboard_compression_filters
+        self._pack_path = Path(pack_path)
+        self._refresh_events = refresh_events or [self._charm.on.config_changed]
+
+        # The rules and dashboards computed from the charm's files, cached across hooks
+        # until the files or the topology change. See `_content`.
+        self._stored.set_default(content_fingerprint="", content="")
+        # The databag payloads, with and without dashboard digests, built at most once per
+        # event. See `_payload`.
+        self._payload_json: Dict[bool, str] = {}
+
+        events = self._charm.on[relation_name]
+        self.framework.observe(events.relation_joined, self._on_refresh)
+        self.framework.observe(events.relation_changed, self._on_refresh)
+        for event in self._refresh_events:
+            self.framework.observe(event, self._on_refresh)
+        # A new leader takes over publishing the dashboards in the app databag.
+        self.framework.observe(self._charm.on.leader_elected, self._on_refresh)
+
+    def _on_refresh(self, event):
+        """Trigger the class to update relation data."""
+        # Within one event, the payload only depends on the requirer's features.
+        self._payload_json = {}
+        if isinstance(event, RelationEvent):
+            relations = [event.relation]
+        else:
+            relations = self._charm.model.relations[self._relation_name]
+
+        for relation in relations:
+            # Before a principal is related to the grafana-agent subordinate, we'd get
+            # ModelError: ERROR cannot read relation settings: unit "zk/2": settings not found
+            # Add a guard to make sure it doesn't happen.
+            if relation.data and self._charm.unit in relation.data:
+                features = self._requirer_features(relation)
+                digests = FEATURE_DASHBOARD_DIGESTS in features
+                chunk_size = DATABAG_CHUNK_SIZE if FEATURE_CHUNKS in features else None
+                # Subordinate relations can communicate only over unit data.
+                databag = relation.data[self._charm.unit]
+                _write_chunked(
+                    databag, CosAgentProviderUnitData.KEY, self._payload(digests), chunk_size
+                )
+
+                if self._charm.unit.is_leader():
+                    # The dashboards are the same for all units, so only the leader sends them.
+                    # An empty value removes them, for a requirer which does not resolve digests.
+                    dashboards = ""
+                    if digests:
+                        dashboards = json.dumps(self._content["dashboards"], sort_keys=True)
+                    _write_chunked(
+                        relation.data[self._charm.app],
+                        CosAgentProviderUnitData.DASHBOARDS_KEY,
+                        dashboards,
+                        chunk_size,
+                    )
+
+    @staticmethod
+    def _requirer_features(relation: Relation) -> Set[str]:
+        """Return the features that all the requirer units of a relation support."""
+        features: Optional[Set[str]] = None
+        for unit in relation.units:
+            unit_features = set(json.loads(relation.data[unit].get(FEATURES_KEY) or "[]"))
+            features = unit_features if features is None else features & unit_features
+        return features or set()
+
+    def _payload(self, digests: bool) -> str:
+        """Return the unit databag payload, with dashboard digests or inline dashboards.
+
+        Each variant is built on first use only, however many relations are handled in this
+        event.
+        """
+        if digests not in self._payload_json:
+            content = self._content
+            dashboards = content["dashboards"]
+            data = CosAgentProviderUnitData(
+                metrics_alert_rules=content["metrics_alert_rules"],
+                log_alert_rules=content["log_alert_rules"],
+                metrics_recording_rules=content["metrics_recording_rules"],
+                dashboards=[] if digests else [dashboards[d] for d in sorted(dashboards)],
+                dashboard_digests=sorted(dashboards) if digests else None,
+                metrics_scrape_jobs=self._scrape_jobs,
+                log_slots=self._log_slots,
+                log_files=self._log_file_jobs,
+            )
+            self._payload_json[digests] = data.json()
+        return self._payload_json[digests]
+
+    @property
+    def _scrape_jobs(self) -> List[Dict]:
+        """Return a prometheus_scrape-like data structure for jobs."""
+        job_name_prefix = self._charm.app.name
+        return [
+            {"job_name": f"{job_name_prefix}_{key}", **endpoint}
+            for key, endpoint in enumerate(self._metrics_endpoints)
+        ]
+
+    @property
+    def _log_file_jobs(self) -> List[Dict]:
+        """Return the log files, named like the scrape jobs."""
+        job_name_prefix = self._charm.app.name
+        return [
+            {"job_name": f"{job_name_prefix}_logs_{key}", **log_file}
+            for key, log_file in enumerate(self._log_files)
+        ]
+
+    @property
+    def _content(self) -> Dict[str, Any]:
+        """Return the rules and dashboards, rebuilt only if their files changed.
+
+        Building them parses every rule file and compresses every dashboard. The result is
+        kept in stored state, keyed by a fingerprint of the files, so unchanged charm content
+        only costs a stat() per file.
+        """
+        fingerprint = self._content_fingerprint()
+        if fingerprint == self._stored.content_fingerprint:
+            return json.loads(self._stored.content)
+
+        logger.debug("Rule or dashboard files changed; rebuilding the cos-agent payload.")
+        if not (content := self._packed_content()):
+            content = {
+                "metrics_alert_rules": self._metrics_alert_rules,
+                "log_alert_rules": self._log_alert_rules,
+                "metrics_recording_rules": self._metrics_recording_rules,
+                "dashboards": {dashboard.digest: dashboard for dashboard in self._dashboards},
+            }
+        self._stored.content = json.dumps(content)
+        self._stored.content_fingerprint = fingerprint
+        return content
+
+    def _content_fingerprint(self) -> str:
+        """Fingerprint the rule and dashboard files (or their pack) by path, size and mtime.
+
+        The topology is included too, because it is injected into the rules.
+        """
+        files = []
+        if self._pack_path.is_file():
+            sources = [(str(self._pack_path), False)]
+        else:
+            rules_dirs = [self._metrics_rules, self._logs_rules, self._recording_rules]
+            sources = [(d, self._recursive) for d in rules_dirs]
+            sources.extend((d, False) for d in self._dashboard_dirs)
+        for source, recursive in sources:
+            path = Path(source)
+            paths = [path] if path.is_file() else path.glob("**/*" if recursive else "*")
+            for file in sorted(paths):
+                stat = file.stat()
+                files.append((str(file), stat.st_size, stat.st_mtime_ns))
+
+        topology = JujuTopology.from_charm(self._charm).as_dict()
+        compression = [self._dashboard_preset, self._dashboard_filters]
+        # The library version is included, in case the cached content changes shape.
+        key = json.dumps([LIBPATCH, files, topology, compression], sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _packed_content(self) -> Optional[Dict[str, Any]]:
+        """Return the rules and dashboards from the pack, if there is a valid one."""
+        try:
+            pack = json.loads(self._pack_path.read_bytes())
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.error(f"invalid pack {self._pack_path}: {e}; reading the directories instead")
+            return None
+
+        digest = pack.pop("digest", None)
+        if pack.get("version") != PACK_VERSION or digest != _digest(pack):
+            logger.error(f"pack {self._pack_path} is corrupt; reading the directories instead")
+            return None
+
+        content = {
+            "metrics_alert_rules": self._load_packed_rules(pack["metrics_alert_rules"], "promql"),
+            "log_alert_rules": self._load_packed_rules(pack["log_alert_rules"], "logql"),
+            "metrics_recording_rules": self._load_packed_rules(
+                pack["metrics_recording_rules"], "promql", RecordingRules
+            ),
+            "dashboards": pack["dashboards"],
+        }
+        if self._dashboard_preset != lzma.PRESET_DEFAULT or self._dashboard_filters:
+            logger.warning(
+                f"the dashboards of pack {self._pack_path} were compressed when it was built; "
+                "ignoring dashboard_compression_preset and dashboard_compression_filters"
+            )
+        return content
+
+    def _load_packed_rules(
+        self,
+        files: Dict[str, str],
+        query_type: str,
+        rules_class: Type[Rules] = AlertRules,
+    ) -> Dict:
+        """Load packed rule files with the juju topology, as if read from the rules directory.
+
+        The files are written to a temporary directory with their relative paths, so that
+        `Rules.add_path` names their groups as it would have in the charm's rules directory.
+        """
+        rules = rules_class(query_type=query_type, topology=JujuTopology.from_charm(self._charm))
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, text in files.items():
+                path = Path(tmp, name)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(text)
+            rules.add_path(tmp, recursive=True)
+        return rules.as_dict()
+
+    @property
+    def _metrics_alert_rules(self) -> Dict:
+        """Use (for now) the prometheus_scrape AlertRules to initialize this."""
+        alert_rules = AlertRules(
+            query_type="promql", topology=JujuTopology.from_charm(self._charm)
+        )
+        alert_rules.add_path(self._metrics_rules, recursive=self._recursive)
+        return alert_rules.as_dict()
+
+    @property
+    def _log_alert_rules(self) -> Dict:
+        """Use (for now) the loki_push_api AlertRules to initialize this."""
+        alert_rules = AlertRules(query_type="logql", topology=JujuTopology.from_charm(self._charm))
+        alert_rules.add_path(self._logs_rules, recursive=self._recursive)
+        return alert_rules.as_dict()
+
+    @property
+    def _metrics_recording_rules(self) -> Dict:
+        """Return the recording rules, with the juju topology injected as in the alert rules."""
+        recording_rules = RecordingRules(
+            query_type="promql", topology=JujuTopology.from_charm(self._charm)
+        )
+        recording_rules.add_path(self._recording_rules, recursive=self._recursive)
+        return recording_rules.as_dict()
+
+    @property
+    def _dashboards(self) -> List[GrafanaDashboard]:
+        dashboards: List[GrafanaDashboard] = []
+        for d in self._dashboard_dirs:
+            for path in Path(d).glob("*"):
+                dashboard = GrafanaDashboard._serialize_file(
+                    path, self._dashboard_preset, self._dashboard_filters
+                )
+                dashboards.append(dashboard)
+        return dashboards
+
+
+class COSAgentDataChanged(EventBase):
+    """Event emitted by `COSAgentRequirer` when relation data changes."""
+
+    def __init__(self, handle, changes: Optional[Dict[str, List[str]]] = None):
+        super().__init__(handle)
+        # The changed categories of data, by principal app name.
+        self.changes: Dict[str, List[str]] = changes or {}
+
+    @property
+    def apps(self) -> Set[str]:
+        """Return the names of the principal apps whose data changed."""
+        return set(self.changes)
+
+    @property
+    def categories(self) -> Set[str]:
+        """Return the categories of data that changed, for any app."""
+        return set(chain.from_iterable(self.changes.values()))
+
+    def snapshot(self) -> Dict:
+        """Save the changes, for a deferred event."""
+        return {"changes": self.changes}
+
+    def restore(self, snapshot: Dict) -> None:
+        """Restore the changes of a deferred event."""
+        self.changes = snapshot["changes"]
+
+
+class COSAgentRequirerEvents(ObjectEvents):
+    """`COSAgentRequirer` events."""
+
+    data_changed = EventSource(COSAgentDataChanged)
+
+
+class COSAgentRequirer(Object):
+    """Integration endpoint wrapper for the Requirer side of the cos_agent interface."""
+
+    on = COSAgentRequirerEvents()
+    _stored = StoredState()
+
+    def __init__(
+        self,
+        charm: CharmType,
+        *,
+        relation_name: str = DEFAULT_RELATION_NAME,
+        peer_relation_name: str = DEFAULT_PEER_RELATION_NAME,
+        refresh_events: Optional[List[str]] = None,
+        dashboards_cache_path: Optional[Union[str, Path]] = None,
+    ):
+        """Create a COSAgentRequirer instance.
+
+        Args:
+            charm: The `CharmBase` instance that is instantiating this object.
+            relation_name: The name of the relation to communicate over.
+            peer_relation_name: The name of the peer relation to communicate over.
+            refresh_events: List of events on which to refresh relation data.
+            dashboards_cache_path: File to keep decompressed dashboards in across hooks.
+        """
+        super().__init__(charm, relation_name)
+        self._charm = charm
+        self._relation_name = relation_name
+        self._peer_relation_name = peer_relation_name
+        self._refresh_events = refresh_events or [self._charm.on.config_changed]
+
+        # Peer databags parsed at most once per event: the data of every principal app, and the
+        # dashboards published by every unit. Cleared when this unit writes its own.
+        self._peer_data_index: Optional[Dict[str, CosAgentPeersUnitData]] = None
+        self._peer_dashboards_index: Optional[Dict[str, Dict[str, str]]] = None
+        # The principal unit's data, parsed at most once per event; a list once parsed.
+        self._principal_data_index: Optional[List[CosAgentProviderUnitData]] = None
+        self._dashboards_cache = _DashboardsCache(
+            Path(dashboards_cache_path or self._charm.charm_dir / DEFAULT_DASHBOARDS_CACHE_FILE),
+        )
+        # Digests of the data last announced with data_changed, by app and category.
+        self._stored.set_default(data_digests="{}")
+
+        events = self._charm.on[relation_name]
+        self.framework.observe(
+            events.relation_joined, self._on_relation_data_changed
+        )  # TODO: do we need this?
+        self.framework.observe(events.relation_changed, self._on_relation_data_changed)
+        for event in self._refresh_events:
+            self.framework.observe(event, self.trigger_refresh)
+
+        # Peer relation events
+        # A peer relation is needed as it is the only mechanism for exchanging data across
+        # subordinate units.
+        # self.framework.observe(
+        #     self.on[self._peer_relation_name].relation_joined, self._on_peer_relation_joined
+        # )
+        peer_events = self._charm.on[peer_relation_name]
+        self.framework.observe(peer_events.relation_changed, self._on_peer_relation_changed)
+        self.framework.observe(peer_events.relation_departed, self._on_peer_relation_changed)
+
+    @property
+    def peer_relation(self) -> Optional["Relation"]:
+        """Helper function for obtaining the peer relation object.
+
+        Returns: peer relation object
+        (NOTE: would return None if called too early, e.g. during install).
+        """
+        return self.model.get_relation(self._peer_relation_name)
+
+    def _on_peer_relation_changed(self, _):
+        self._invalidate_peer_index()
+        # A peer that left, or stopped publishing a dashboard, may have been the only one
+        # publishing a dashboard this unit's principal needs.
+        self._publish_dashboards()
+
+        # Peer data is used for forwarding data from principal units to the grafana agent
+        # subordinate leader, for updating the app data of the outgoing o11y relations.
+        if self._charm.unit.is_leader():
+            self._emit_data_changed()
+
+    def _on_relation_data_changed(self, event: RelationChangedEvent):
+        self._invalidate_peer_index()
+        # Tells the provider which payloads this requirer reads.
+        databag = event.relation.data[self._charm.unit]
+        if databag.get(FEATURES_KEY) != (features := json.dumps(REQUIRER_FEATURES)):
+            databag[FEATURES_KEY] = features
+
+        # Peer data is the only means of communication between subordinate units.
+        if not self.peer_relation:
+            event.defer()
+            return
+
+        cos_agent_relation = event.relation
+        if not event.unit:
+            # The principal's leader changed the dashboards in the app databag.
+            self._publish_dashboards()
+            self._emit_data_changed()
+            return
+        if not cos_agent_relation.data.get(event.unit):
+            return
+        principal_unit = event.unit
+
+        # Coherence check
+        units = cos_agent_relation.units
+        if len(units) > 1:
+            # should never happen
+            raise ValueError(
+                f"unexpected error: subordinate relation {cos_agent_relation} "
+                f"should have exactly one unit"
+            )
+
+        raw = _read_chunked(cos_agent_relation.data[principal_unit], CosAgentProviderUnitData.KEY)
+        if not raw:
+            return
+        provider_data = CosAgentProviderUnitData(**json.loads(raw))
+
+        # Copy data from the principal relation to the peer relation, so the leader could
+        # follow up.
+        # Save the originating unit name, so it could be used for topology later on by the leader.
+        data = CosAgentPeersUnitData(  # peer relation databag model
+            principal_unit_name=event.unit.name,
+            principal_relation_id=str(event.relation.id),
+            principal_relation_name=event.relation.name,
+            metrics_alert_rules=provider_data.metrics_alert_rules,
+            log_alert_rules=provider_data.log_alert_rules,
+            metrics_recording_rules=provider_data.metrics_recording_rules,
+            dashboards=provider_data.dashboards,
+            dashboard_digests=provider_data.dashboard_digests,
+        )
+        self.peer_relation.data[self._charm.unit][data.KEY] = data.json()
+        self._invalidate_peer_index()
+        self._publish_dashboards()
+
+        # Emitted for changes in the peer data too, even though only the leader uses them.
+        self._emit_data_changed()
+
+    def _publish_dashboards(self) -> None:
+        """Publish the principal's dashboards in peer data, unless a peer already did.
+
+        Dashboards this unit published before are kept for as long as its principal uses
+        them, so that two units never both withdraw the same dashboard.
+        """
+        relation = self.peer_relation
+        if not relation or not (principal_data := self._principal_unit_data):
+            return
+
+        wanted = set(principal_data.dashboard_digests or ())
+        databag = relation.data[self._charm.unit]
+        current = json.loads(databag.get(CosAgentPeersUnitData.DASHBOARDS_KEY, "{}"))
+        published = {digest: blob for digest, blob in current.items() if digest in wanted}
+
+        if missing := wanted - published.keys() - self._peer_dashboards(own=False).keys():
+            principal_relation = next(iter(self._principal_relations))
+            blobs = json.loads(
+                _read_chunked(
+                    principal_relation.data[principal_relation.app],
+                    CosAgentProviderUnitData.DASHBOARDS_KEY,
+                )
+                or "{}"
+            )
+            published.update((digest, blobs[digest]) for digest in missing if digest in blobs)
+
+        if published != current:
+            databag[CosAgentPeersUnitData.DASHBOARDS_KEY] = json.dumps(published, sort_keys=True)
+            self._invalidate_peer_index()
+
+    def _peer_dashboards(self, own: bool = True) -> Dict[str, str]:
+        """Return the encoded dashboards published in peer data, by digest."""
+        if self._peer_dashboards_index is None:
+            self._index_peer_data()
+
+        dashboards: Dict[str, str] = {}
+        for unit_name, published in (self._peer_dashboards_index or {}).items():
+            if own or unit_name != self._charm.unit.name:
+                dashboards.update(published)
+        return dashboards
+
+    def _invalidate_peer_index(self) -> None:
+        """Forget the parsed peer data, at a new event or after this unit changed its own."""
+        self._peer_data_index = None
+        self._peer_dashboards_index = None
+        self._principal_data_index = None
+
+    def _index_peer_data(self) -> None:
+        """Parse every peer databag once, keeping the data of every principal app once."""
+        self._peer_data_index = {}
+        self._peer_dashboards_index = {}
+        relation = self.peer_relation
+
+        # Ensure that whatever context we're running this in, we take the necessary precautions:
+        if not relation or not relation.data or not relation.app:
+            return
+
+        for unit in chain((self._charm.unit,), relation.units):
+            if not (databag := relation.data.get(unit)):
+                logger.info(f"peer {unit} has not set its primary data yet; skipping for now...")
+                continue
+
+            if raw := databag.get(CosAgentPeersUnitData.DASHBOARDS_KEY):
+                self._peer_dashboards_index[unit.name] = json.loads(raw)
+
+            if not (raw := databag.get(CosAgentPeersUnitData.KEY)):
+                logger.info(f"peer {unit} has not set its primary data yet; skipping for now...")
+                continue
+
+            data = CosAgentPeersUnitData(**json.loads(raw))
+            # Only collect every principal app once.
+            self._peer_data_index.setdefault(data.app_name, data)
+
+    def trigger_refresh(self, _):
+        """Trigger a refresh of relation data."""
+        self._invalidate_peer_index()
+        self._emit_data_changed()
+
+    def _emit_data_changed(self) -> None:
+        """Emit `data_changed` with the apps and categories that changed since the last one."""
+        digests = self._data_digests()
+        previous = json.loads(self._stored.data_digests)
+
+        changes: Dict[str, List[str]] = {}
+        for app_name in digests.keys() | previous.keys():
+            new, old = digests.get(app_name, {}), previous.get(app_name, {})
+            changed = [c for c in new.keys() | old.keys() if new.get(c) != old.get(c)]
+            if changed:
+                changes[app_name] = sorted(changed)
+
+        if not changes:
+            logger.debug("cos-agent data unchanged; not emitting data_changed")
+            return
+        self._stored.data_digests = json.dumps(digests, sort_keys=True)
+        self.on.data_changed.emit(changes)
+
+    def _data_digests(self) -> Dict[str, Dict[str, str]]:
+        """Return a digest of every category of data, by principal app name."""
+        digests: Dict[str, Dict[str, str]] = {}
+        published = self._peer_dashboards()
+        for data in self._gather_peer_data():  # type: CosAgentPeersUnitData
+            # A dashboard only counts once it can be resolved.
+            dashboards = [GrafanaDashboard(d).digest for d in data.dashboards or ()]
+            dashboards.extend(d for d in data.dashboard_digests or () if d in published)
+            digests[data.app_name] = {
+                "metrics_alert_rules": _digest(data.metrics_alert_rules),
+                "log_alert_rules": _digest(data.log_alert_rules),
+                "metrics_recording_rules": _digest(data.metrics_recording_rules or {}),
+                "dashboards": _digest(sorted(dashboards)),
+            }
+
+        # The scrape jobs and log slots are those of this unit's principal only.
+        if (unit := self._principal_unit) and (data := self._principal_unit_data):
+            digests.setdefault(unit.app.name, {}).update(
+                metrics_scrape_jobs=_digest(data.metrics_scrape_jobs),
+                log_slots=_digest(data.log_slots),
+                log_files=_digest(data.log_files),
+            )
+        return digests
+
+    @property
+    def _principal_unit(self) -> Optional[Unit]:
+        """Return the principal unit for a relation.
+
+        Assumes that the relation is of type subordinate.
+        Relies on the fact that, for subordinate relations, the only remote unit visible to
+        *this unit* is the principal unit that this unit is attached to.
+        """
+        if relations := self._principal_relations:
+            # Technically it's a list, but for subordinates there can only be one relation
+            principal_relation = next(iter(relations))
+            if units := principal_relation.units:
+                # Technically it's a list, but for subordinates there can only be one
+                return next(iter(units))
+
+        return None
+
+    @property
+    def _principal_relations(self):
+        # Technically it's a list, but for subordinates there can only be one.
+        return self._charm.model.relations[self._relation_name]
+
+    @property
+    def _principal_unit_data(self) -> Optional[CosAgentProviderUnitData]:
+        """Return the principal unit's data, parsed at most once per event.
+
+        Assumes that the relation is of type subordinate.
+        Relies on the fact that, for subordinate relations, the only remote unit visible to
+        *this unit* is the principal unit that this unit is attached to.
+        """
+        if self._principal_data_index is None:
+            self._principal_data_index = []
+            if relations := self._principal_relations:
+                # Technically it's a list, but for subordinates there can only be one relation
+                principal_relation = next(iter(relations))
+                if units := principal_relation.units:
+                    # Technically it's a list, but for subordinates there can only be one
+                    unit = next(iter(units))
+                    databag = principal_relation.data[unit]
+                    if raw := _read_chunked(databag, CosAgentProviderUnitData.KEY):
+                        data = CosAgentProviderUnitData(**json.loads(raw))
+                        self._principal_data_index.append(data)
+
+        return next(iter(self._principal_data_index), None)
+
+    def _gather_peer_data(self) -> List[CosAgentPeersUnitData]:
+        """Collect data from the peers.
+
+        Returns a trimmed-down list of CosAgentPeersUnitData, one per principal app.
+        """
+        if self._peer_data_index is None:
+            self._index_peer_data()
+        return list((self._peer_data_index or {}).values())
+
+    @property
+    def metrics_alerts(self) -> Dict[str, Any]:
+        """Fetch metrics alerts."""
+        return self._rules_by_identifier("metrics_alert_rules")
+
+    @property
+    def metrics_recording_rules(self) -> Dict[str, Any]:
+        """Fetch metrics recording rules."""
+        return self._rules_by_identifier("metrics_recording_rules")
+
+    def _rules_by_identifier(self, field: str) -> Dict[str, Any]:
+        """Return one of the rules fields of the peer data, by topology identifier."""
+        rules_by_identifier = {}
+
+        # `_gather_peer_data` returns every principal app once.
+        for data in self._gather_peer_data():  # type: CosAgentPeersUnitData
+            if rules := getattr(data, field):
+                app_name = data.app_name
+                # This is only used for naming the file, so be as specific as we can be
+                identifier = JujuTopology(
+                    model=self._charm.model.name,
+                    model_uuid=self._charm.model.uuid,
+                    application=app_name,
+                    # For the topology unit, we could use `data.principal_unit_name`, but that unit
+                    # name may not be very stable: `_gather_peer_data` de-duplicates by app name so
+                    # the exact unit name that turns up first in the iterator may vary from time to
+                    # time. So using the grafana-agent unit name instead.
+                    unit=self._charm.unit.name,
+                ).identifier
+
+                rules_by_identifier[identifier] = rules
+
+        return rules_by_identifier
+
+    @property
+    def metrics_jobs(self) -> List[Dict]:
+        """Parse the relation data contents and extract the metrics jobs."""
+        scrape_jobs = []
+        if data := self._principal_unit_data:
+            jobs = data.metrics_scrape_jobs
+            if jobs:
+                for job in jobs:
+                    static_config = {"targets": [f"localhost:{job['port']}"]}
+                    if labels := job.get("labels"):
+                        static_config["labels"] = labels
+                    job_config = {
+                        "job_name": job["job_name"],
+                        "metrics_path": job["path"],
+                        "static_configs": [static_config],
+                    }
+                    job_config.update((k, job[k]) for k in SCRAPE_JOB_OPTIONS if k in job)
+                    if relabel_configs := self._metric_relabel_configs(job):
+                        job_config["metric_relabel_configs"] = relabel_configs
+                    scrape_jobs.append(job_config)
+
+        return scrape_jobs
+
+    @staticmethod
+    def _metric_relabel_configs(job: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Return the metric relabel configs of a job, with the keep/drop lists rendered."""
+        relabel_configs = list(job.get("metric_relabel_configs") or ())
+        for key, action in METRIC_NAME_FILTERS.items():
+            if regexes := job.get(key):
+                relabel_configs.append(
+                    {
+                        "source_labels": ["__name__"],
+                        # Prometheus anchors the regex, so each one matches whole names.
+                        "regex": _any_of(regexes),
+                        "action": action,
+                    }
+                )
+        return relabel_configs
+
+    @property
+    def snap_log_endpoints(self) -> List[SnapEndpoint]:
+        """Fetch logging endpoints exposed by related snaps."""
+        plugs = []
+        if data := self._principal_unit_data:
+            targets = data.log_slots
+            if targets:
+                for target in targets:
+                    if target in plugs:
+                        logger.warning(
+                            f"plug {target} already listed. "
+                            "The same snap is being passed from multiple "
+                            "endpoints; this should not happen."
+                        )
+                    else:
+                        plugs.append(target)
+
+        endpoints = []
+        for plug in plugs:
+            if ":" not in plug:
+                logger.error(f"invalid plug definition received: {plug}. Ignoring...")
+            else:
+                endpoint = SnapEndpoint(*plug.split(":"))
+                endpoints.append(endpoint)
+        return endpoints
+
+    @property
+    def log_file_jobs(self) -> List[Dict]:
+        """Parse the relation data contents and extract the log file scrape jobs.
+
+        The jobs are in the Promtail scrape config format of the Grafana Agent logs configs.
+        """
+        jobs = []
+        if data := self._principal_unit_data:
+            for log_file in data.log_files:
+                labels = {
+                    **(log_file.get("labels") or {}),
+                    "job": log_file["job_name"],
+                    "__path__": log_file["path"],
+                }
+                job_config = {
+                    "job_name": log_file["job_name"],
+                    "static_configs": [{"targets": ["localhost"], "labels": labels}],
+                }
+                if pipeline_stages := self._log_pipeline_stages(log_file):
+                    job_config["pipeline_stages"] = pipeline_stages
+                jobs.append(job_config)
+
+        return jobs
+
+    @staticmethod
+    def _log_pipeline_stages(log_file: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Return the pipeline stages of a log file: its line filters, then its rate limit."""
+        stages: List[Dict[str, Any]] = []
+        if regexes := log_file.get("keep_lines"):
+            stages.append(
+                {
+                    "match": {
+                        # Drops the lines that match none of the regexes.
+                        "selector": f'{{job="{log_file["job_name"]}"}} !~ `{_any_of(regexes)}`',
+                        "action": "drop",
+                        "drop_counter_reason": "keep_lines",
+                    }
+                }
+            )
+        if regexes := log_file.get("drop_lines"):
+            stages.append(
+                {"drop": {"expression": _any_of(regexes), "drop_counter_reason": "drop_lines"}}
+            )
+        if rate_limit := log_file.get("rate_limit"):
+            burst = log_file.get("rate_burst") or max(int(rate_limit), 1)
+            stages.append({"limit": {"rate": rate_limit, "burst": burst, "drop": True}})
+        return stages
+
+    @property
+    def logs_alerts(self) -> Dict[str, Any]:
+        """Fetch log alerts."""
+        return self._rules_by_identifier("log_alert_rules")
+
+    @property
+    def dashboards(self) -> List[Dict[str, str]]:
+        """Fetch dashboards as encoded content.
+
+        Dashboards are assumed not to vary across units of the same primary. They are only
+        decompressed if not found in the dashboards cache, by digest. The cache is left with
+        these dashboards only.
+        """
+        dashboards: List[Dict[str, str]] = []
+        in_use: Set[str] = set()
+        published = self._peer_dashboards()
+
+        # `_gather_peer_data` returns every principal app once.
+        for data in self._gather_peer_data():  # type: CosAgentPeersUnitData
+            app_name = data.app_name
+
+            # Providers send the dashboards inline to requirers which do not resolve digests.
+            inline = [GrafanaDashboard(d) for d in data.dashboards or ()]
+            encoded_dashboards = [(dashboard, dashboard.digest) for dashboard in inline]
+            for digest in data.dashboard_digests or ():
+                if digest not in published:
+                    logger.debug(f"dashboard {digest} of {app_name} not published yet; skipping")
+                    continue
+                encoded_dashboards.append((GrafanaDashboard(published[digest]), digest))
+
+            for encoded_dashboard, digest in encoded_dashboards:
+                in_use.add(digest)
+                content = self._dashboards_cache.get(encoded_dashboard, digest)
+
+                title = content.get("title", "no_title")
+
+                dashboards.append(
+                    {
+                        "relation_id": data.principal_relation_id,
+                        # We have the remote charm name - use it for the identifier
+                        "charm": f"{data.principal_relation_name}-{app_name}",
+                        "content": content,
+                        "title": title,
+                    }
+                )
+
+        self._dashboards_cache.retain(in_use)
+        self._dashboards_cache.save()
+        return dashboards
+
+
+class COSAgentConfigRenderer(Object):
+    """Writes the Grafana Agent config built from `COSAgentRequirer` data, if it changed."""
+
+    def __init__(
+        self,
+        requirer: COSAgentRequirer,
+        path: Union[str, Path],
+        *,
+        reload: Callable[[], Any],
+        build: Optional[Callable[["COSAgentConfigRenderer"], Dict[str, Any]]] = None,
+    ):
+        """Create a COSAgentConfigRenderer instance.
+
+        Args:
+            requirer: The `COSAgentRequirer` whose data goes into the config.
+            path: The agent config file.
+            reload: Called to reload the agent, after the config file changed.
+            build: Returns the whole agent config, typically extending `default_config()`.
+                Defaults to `default_config`.
+        """
+        super().__init__(requirer, "config-renderer")
+        self._requirer = requirer
+        self._path = Path(path)
+        self._reload = reload
+        self._build = build or COSAgentConfigRenderer.default_config
+        self.framework.observe(requirer.on.data_changed, self._on_data_changed)
+
+    def _on_data_changed(self, _) -> None:
+        self.update()
+
+    def default_config(self) -> Dict[str, Any]:
+        """Return the agent config with the scrape configs of the principal only."""
+        return {
+            "metrics": {
+                "configs": [{"name": "cos-agent", "scrape_configs": self._requirer.metrics_jobs}]
+            },
+            "logs": {
+                "configs": [
+                    {"name": "cos-agent", "scrape_configs": self._requirer.log_file_jobs}
+                ]
+            },
+        }
+
+    def render(self) -> str:
+        """Return the agent config file content, with sorted keys for stable digests."""
+        return yaml.safe_dump(self._build(self), sort_keys=True)
+
+    def update(self) -> bool:
+        """Write the config and reload the agent, if the config differs from the file's.
+
+        If the reload raises, the previous file is put back, so that the retried hook writes
+        the config and reloads again.
+
+        Returns:
+            Whether the config changed.
+        """
+        rendered = self.render().encode("utf-8")
+        try:
+            previous: Optional[bytes] = self._path.read_bytes()
+        except FileNotFoundError:
+            previous = None
+        if rendered == previous:
+            logger.debug(f"agent config {self._path} unchanged; not reloading")
+            return False
+
+        self._write(rendered)
+        try:
+            self._reload()
+        except Exception:
+            logger.warning(f"reloading the agent failed; restoring the previous {self._path}")
+            if previous is None:
+                self._path.unlink()
+            else:
+                self._write(previous)
+            raise
+        return True
+
+    def _write(self, content: bytes) -> None:
+        """Replace the config file atomically."""
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._path.with_name(self._path.name + ".tmp")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, self._path)
+
+
+def _any_of(regexes: List[str]) -> str:
+    """Return a regex matching any of the regexes."""
+    return "|".join(f"(?:{regex})" for regex in regexes)
+
+
+def _pack_rules(
+    rules_dir: str,
+    query_type: str,
+    recursive: bool,
+    rules_class: Type[Rules] = AlertRules,
+) -> Dict[str, str]:
+    """Read and validate the rule files in a directory, keyed by their path in it."""
+    root = Path(rules_dir)
+    if root.is_file():
+        root, files = root.parent, [root]
+    elif root.is_dir():
+        paths = root.glob("**/*" if recursive else "*")
+        files = [path for path in paths if path.is_file() and path.suffix in RULE_FILE_SUFFIXES]
+    else:
+        files = []
+
+    packed = {}
+    for file in sorted(files):
+        rules = rules_class(query_type=query_type)
+        rules.add_path(file)
+        if not rules.groups:
+            raise ValueError(f"invalid {query_type} {rules.rule_type} rules file: {file}")
+        packed[file.relative_to(root).as_posix()] = file.read_text()
+    return packed
+
+
+def pack(
+    output: str,
+    metrics_rules_dir: str = "./src/prometheus_alert_rules",
+    logs_rules_dir: str = "./src/loki_alert_rules",
+    dashboard_dirs: Optional[List[str]] = None,
+    recurse_rules_dirs: bool = False,
+    dashboard_compression_preset: int = lzma.PRESET_DEFAULT,
+    recording_rules_dir: str = "./src/prometheus_recording_rules",
+    dashboard_compression_filters: Optional[List[Dict[str, Any]]] = None,
+) -> str:
+    """Pack the rules and dashboards of a charm into one file, for `COSAgentProvider`.
+
+    Args:
+        output: The path of the pack to write, see `DEFAULT_PACK_PATH`.
+        metrics_rules_dir: Directory where the metrics rules are stored.
+        logs_rules_dir: Directory where the logs rules are stored.
+        dashboard_dirs: Directories where the dashboards are stored.
+        recurse_rules_dirs: Whether to recurse into rule paths.
+        dashboard_compression_preset: The lzma preset to compress the dashboards with.
+        recording_rules_dir: Directory where the metrics recording rules are stored.
+        dashboard_compression_filters: An lzma filter chain to use instead of the preset.
+
+    Returns:
+        The digest of the pack.
+
+    Raises:
+        ValueError: if a rule file or a dashboard is invalid.
+    """
+    dashboards = {}
+    for d in dashboard_dirs or ["./src/grafana_dashboards"]:
+        for path in sorted(Path(d).glob("*")):
+            try:
+                json.loads(path.read_bytes())
+            except ValueError as e:
+                raise ValueError(f"invalid dashboard {path}: {e}") from e
+            dashboard = GrafanaDashboard._serialize_file(
+                path, dashboard_compression_preset, dashboard_compression_filters
+            )
+            dashboards[dashboard.digest] = dashboard
+
+    pack = {
+        "version": PACK_VERSION,
+        "metrics_alert_rules": _pack_rules(metrics_rules_dir, "promql", recurse_rules_dirs),
+        "log_alert_rules": _pack_rules(logs_rules_dir, "logql", recurse_rules_dirs),
+        "metrics_recording_rules": _pack_rules(
+            recording_rules_dir, "promql", recurse_rules_dirs, RecordingRules
+        ),
+        "dashboards": dashboards,
+    }
+    pack["digest"] = digest = _digest(pack)
+    Path(output).write_text(json.dumps(pack, sort_keys=True))
+    return digest
+
+
+def _filter_chain(value: str) -> List[Dict[str, Any]]:
+    """Parse a JSON lzma filter chain, in which filter ids may be given by name."""
+    filters = json.loads(value)
+    for spec in filters:
+        if isinstance(spec.get("id"), str):
+            spec["id"] = getattr(lzma, spec["id"])
+    return filters
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Tools for the cos_agent library.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    pack_parser = commands.add_parser("pack", help=pack.__doc__.splitlines()[0])
+    pack_parser.add_argument("--output", default=DEFAULT_PACK_PATH)
+    pack_parser.add_argument("--metrics-rules-dir", default="./src/prometheus_alert_rules")
+    pack_parser.add_argument("--logs-rules-dir", default="./src/loki_alert_rules")
+    pack_parser.add_argument("--recording-rules-dir", default="./src/prometheus_recording_rules")
+    pack_parser.add_argument("--dashboard-dir", action="append", dest="dashboard_dirs")
+    pack_parser.add_argument("--recursive", action="store_true")
+    pack_parser.add_argument("--preset", type=int, default=lzma.PRESET_DEFAULT)
+    pack_parser.add_argument("--filters", type=_filter_chain)
+    args = parser.parse_args()
+
+    try:
+        packed = pack(
+            args.output,
+            metrics_rules_dir=args.metrics_rules_dir,
+            logs_rules_dir=args.logs_rules_dir,
+            dashboard_dirs=args.dashboard_dirs,
+            recurse_rules_dirs=args.recursive,
+            dashboard_compression_preset=args.preset,
+            recording_rules_dir=args.recording_rules_dir,
+            dashboard_compression_filters=args.filters,
+        )
+    except ValueError as e:
+        sys.exit(f"error: {e}")
+    print(f"packed {args.output}: {packed}")
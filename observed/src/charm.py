@@ -1,31 +1,85 @@
 #!/usr/bin/env python3
 
+import json
+import logging
 import os
-import subprocess as sp
 
 import ops
-from charms.grafana_agent.v0.cos_agent import COSAgentProvider
+from charms.corehooks_all.v0 import systemd_extras
+from charms.corehooks_all.v0.rolling_restart import RollingRestart
+from charms.observed.v0.cos_agent import COSAgentProvider
+from charms.operator_libs_linux.v1 import systemd
+
+logger = logging.getLogger(__name__)
 
 EMOJI_GREEN_DOT = "\U0001F7E2"
 
+MICROSAMPLE_SNAP = "microsample"
+MICROSAMPLE_SERVICE = "snap.microsample.microsample.service"
+
+# On-demand microsample: systemd holds the listening socket and proxies connections to
+# microsample on localhost, starting it on the first connection.
+PROXY_SOCKET = "microsample-proxy.socket"
+PROXY_SERVICE = "microsample-proxy.service"
+READY_DROPIN = "60-charm-wait-for-port.conf"
+READY_TEMPLATE = """# Managed by the charm, do not edit.
+[Service]
+# Connections are queued in the socket until microsample accepts them.
+ExecStartPost=/bin/bash -c \\
+    'until (exec 3<>/dev/tcp/127.0.0.1/{port}) 2>/dev/null; do sleep 0.1; done'
+TimeoutStartSec=60
+"""
+
+
 class ObservedCharm(ops.CharmBase):
 
+    _stored = ops.StoredState()
+
     def __init__(self, *args):
         super().__init__(*args)
+        # The number of microsample workers installed, the config set on each of their snaps,
+        # the activation applied last, and whether a changed snap config still needs a restart.
+        self._stored.set_default(
+            workers=1, snap_config="{}", activation=None, restart_pending=False,
+        )
+        # The bind address, looked up at most once per dispatch.
+        self._bind_address = None
         
         # Define data to send to grafana-agent and 
         # provide paths to dashboards + alert-rules.
-        # The COSAgentProvider is added to the source tree from
+        # The COSAgentProvider is this charm's extension of the one from
         #     charmcraft fetch-lib charms.grafana_agent.v0.cos_agent
+        # in lib/charms/observed/v0/cos_agent.py, which is not published on Charmhub.
         # Changes to the rules/dashboards will be updated automatically if the charm
         # is updated.
         
         self._grafana_agent = COSAgentProvider(
-            self, metrics_endpoints=[
-                {"path": "/metrics", "port": self.config.get('port')},
-            ],
+            self, metrics_endpoints=self._metrics_endpoints(),
             metrics_rules_dir="./src/alert_rules/prometheus",
-            logs_rules_dir="./src/alert_rules/loki"
+            logs_rules_dir="./src/alert_rules/loki",
+            # The per unit call rate, recorded once instead of being computed by every query,
+            # for requirers which forward recording rules.
+            recording_rules_dir="./src/recording_rules/prometheus",
+            # microsample logs to the journal, and from there to syslog. Only its own lines
+            # are sent to Loki, labelled, and at most 100 per second per unit.
+            log_files=[
+                {
+                    "path": "/var/log/syslog",
+                    "labels": {"service": "microsample"},
+                    "keep_lines": [r" microsample(_\d+)?\.microsample\["],
+                    "rate_limit": 100,
+                },
+            ],
+        )
+
+        # Restart microsample on a few units at a time only, with the rolling_restart library
+        # copied by hand from corehooks-all.
+        self._rolling_restart = RollingRestart(
+            self,
+            relation_name="restart",
+            restart=self._restart_microsample,
+            healthy=self._microsample_is_active,
+            max_concurrent=self.config.get('max_concurrent_restarts'),
         )
 
         # Observe core Juju events
@@ -34,32 +88,215 @@ class ObservedCharm(ops.CharmBase):
         self.framework.observe(self.on.upgrade_charm, self._on_upgrade_charm)
 
 
+    def _metrics_endpoints(self):
+        # One endpoint per worker, labelled with its number, from the first port on.
+        workers, port = self.config.get('workers'), self.config.get('port')
+        return [
+            # The dashboards and alert rules only use the microsample_* series,
+            # everything else is dropped at scrape time.
+            {
+                "path": "/metrics",
+                "port": int(port) + worker,
+                "keep_metrics": ["microsample_.*"],
+                "labels": {"worker": str(worker)},
+            }
+            for worker in range(max(workers, 1))
+        ]
+
+    def _get_bind_address(self):
+        # The address of the cos-agent binding: the network grafana-agent scrapes microsample
+        # on, also on machines with several NICs.
+        if self._bind_address is None:
+            binding = self.model.get_binding("cos-agent")
+            if binding and binding.network.bind_address:
+                self._bind_address = str(binding.network.bind_address)
+        return self._bind_address
+
+    def _worker_snaps(self, workers=None):
+        # The first worker is the microsample snap, the others its parallel instances.
+        workers = self.config.get('workers') if workers is None else workers
+        return [MICROSAMPLE_SNAP] + [f"{MICROSAMPLE_SNAP}_{i}" for i in range(1, workers)]
+
+    def _worker_services(self):
+        return [f"snap.{snap}.microsample.service" for snap in self._worker_snaps()]
+
     def _on_install(self, theevent):
         # Install from configured channel
         channel = self.config.get('channel')
         self.unit.status = ops.MaintenanceStatus("Installing microsample snap")
-        os.system(f"snap install microsample --{channel}")
+        if not self._install_microsample(channel):
+            return
         self.unit.status = ops.ActiveStatus(EMOJI_GREEN_DOT + " Ready")
 
 
     def _on_config_changed(self, theevent):
-        # Get port & private address
+        # Get port & bind address
         port = self.config.get('port')
-        cmd = "unit-get private-address"
-        
-        address = sp.check_output(cmd.split(), 
-                                  stdin = None, stderr = None, 
-                                  shell = False, universal_newlines = True)
-    
-        # Set config for the snap and restart.
-        os.system(f"snap set microsample address={address}")
-        os.system(f"snap set microsample port={port}")
-        os.system("systemctl restart snap.microsample.microsample")
+        address = self._get_bind_address()
+        if not address:
+            self.unit.status = ops.WaitingStatus("Waiting for the cos-agent bind address")
+            theevent.defer()
+            return
+
+        if self.config.get('activation') == "on-demand":
+            # systemd listens on the port, microsample only on localhost behind it.
+            address, port = "127.0.0.1", self.config.get('backend_port')
+
+        if not self._apply_workers():
+            return
+
+        # Set config for the snaps, with one call per snap and only if it changed, and restart
+        # only then. Workers listen on consecutive ports.
+        snaps = self._worker_snaps()
+        applied = {
+            snap: config
+            for snap, config in json.loads(self._stored.snap_config).items() if snap in snaps
+        }
+        for worker, snap in enumerate(snaps):
+            config = f"address={address} port={int(port) + worker}"
+            if applied.get(snap) == config:
+                continue
+            if os.system(f"snap set {snap} {config}") != 0:
+                logger.error(f"Setting {config} on {snap} failed")
+                self.unit.status = ops.BlockedStatus(f"Failed to configure {snap}")
+                return
+            applied[snap] = config
+            # Kept until the restart is requested, also if the activation below fails.
+            self._stored.restart_pending = True
+        self._stored.snap_config = json.dumps(applied)
+        if not self._apply_activation():
+            return
+        if self._stored.restart_pending:
+            self._rolling_restart.request_restart()
+            self._stored.restart_pending = False
+
+        if not self._apply_resource_limits():
+            return
+
+        # Clears a status left by an earlier, deferred or failed, config-changed.
+        self.unit.status = ops.ActiveStatus(EMOJI_GREEN_DOT + " Ready")
+
+    def _apply_resource_limits(self):
+        # Limits go into a systemd drop-in and are set on the running service without a
+        # restart, only LimitNOFILE needs one. Returns False if they could not be applied.
+        limits = systemd_extras.resource_limits_from_config(self.config)
+        try:
+            restart = False
+            for service in self._worker_services():
+                restart |= systemd_extras.service_set_resource_limits(service, limits)
+            if restart:
+                self._rolling_restart.request_restart()
+        except systemd.SystemdError as e:
+            logger.error(f"Applying resource limits {limits} failed: {e}")
+            self.unit.status = ops.BlockedStatus("Invalid resource limits, see debug-log")
+            return False
+        return True
+
+    def _apply_workers(self):
+        # Installs the parallel instances of the snap for the workers beyond the first, and
+        # removes those no longer needed.
+        workers = self.config.get('workers')
+        if workers < 1:
+            self.unit.status = ops.BlockedStatus(f"Invalid workers: {workers}")
+            return False
+        if workers > 1 and self.config.get('activation') != "eager":
+            self.unit.status = ops.BlockedStatus("More than one worker needs activation=eager")
+            return False
+
+        if workers > 1:
+            os.system("snap set system experimental.parallel-instances=true")
+        channel = self.config.get('channel')
+        for snap in self._worker_snaps()[self._stored.workers:]:
+            self.unit.status = ops.MaintenanceStatus(f"Installing {snap} snap")
+            if not self._install_microsample(channel, snap):
+                return False
+        for snap in self._worker_snaps(self._stored.workers)[workers:]:
+            os.system(f"snap remove --purge {snap}")
+        self._stored.workers = workers
+        return True
+
+    def _apply_activation(self):
+        # eager: microsample is started by snapd and listens on the port itself.
+        # on-demand: systemd listens on the port, and starts microsample (behind a proxy) on
+        # the first connection. Connections queue in the socket while microsample restarts.
+        activation = self.config.get('activation')
+        try:
+            if activation == "on-demand":
+                backend = f"127.0.0.1:{self.config.get('backend_port')}"
+                socket = systemd_extras.render_socket_unit(
+                    str(self.config.get('port')), description="microsample"
+                )
+                proxy = systemd_extras.render_socket_proxy_unit(
+                    backend, description="microsample", requires=MICROSAMPLE_SERVICE
+                )
+                ready = READY_TEMPLATE.format(port=self.config.get('backend_port'))
+                changed = systemd_extras.install_unit(PROXY_SOCKET, socket)
+                changed |= systemd_extras.install_unit(PROXY_SERVICE, proxy)
+                changed |= systemd_extras.install_unit(
+                    MICROSAMPLE_SERVICE, ready, dropin=READY_DROPIN
+                )
+                if changed:
+                    systemd.daemon_reload()
+                    # Takes a changed port into use.
+                    if systemd.service_running(PROXY_SOCKET):
+                        systemd.service_restart(PROXY_SOCKET)
+                if changed or self._stored.activation != activation:
+                    # From now on the proxy starts microsample, not snapd.
+                    os.system("snap stop --disable microsample")
+                systemd.service_enable("--now", PROXY_SOCKET)
+            elif activation == "eager":
+                os.system(f"systemctl disable --now {PROXY_SOCKET} {PROXY_SERVICE}")
+                removed = systemd_extras.remove_unit(PROXY_SOCKET)
+                removed |= systemd_extras.remove_unit(PROXY_SERVICE)
+                removed |= systemd_extras.remove_unit(
+                    MICROSAMPLE_SERVICE, dropin=READY_DROPIN
+                )
+                if removed:
+                    systemd.daemon_reload()
+                os.system(f"snap start --enable {' '.join(self._worker_snaps())}")
+            else:
+                self.unit.status = ops.BlockedStatus(f"Invalid activation: {activation}")
+                return False
+        except systemd.SystemdError as e:
+            logger.error(f"Starting microsample {activation} failed: {e}")
+            self.unit.status = ops.BlockedStatus(f"Starting microsample {activation} failed")
+            return False
+        self._stored.activation = activation
+        return True
+
+    def _restart_microsample(self):
+        # Called by the rolling restart once this unit holds a restart token.
+        if self.config.get('activation') == "on-demand":
+            # Not running yet is fine, microsample then starts on the next connection.
+            os.system(f"systemctl try-restart {MICROSAMPLE_SERVICE}")
+        else:
+            os.system(f"systemctl restart {' '.join(self._worker_services())}")
+
+    def _microsample_is_active(self):
+        # The restart token is handed back once this is True.
+        if self.config.get('activation') == "on-demand":
+            return systemd.service_running(PROXY_SOCKET)
+        return all(systemd_extras.services_running(*self._worker_services()).values())
+
+    def _install_microsample(self, channel, snap=MICROSAMPLE_SNAP):
+        # Note that snapd does the heavy lifting, the scope mostly covers the snap client.
+        # Parallel instances (microsample_1, ...) install the same snap under another name.
+        try:
+            systemd_extras.run_in_scope(
+                f"snap install {snap} --{channel}", **systemd_extras.LOW_PRIORITY_SCOPE
+            )
+        except systemd.SystemdError as e:
+            logger.error(f"Installing {snap} failed: {e}")
+            self.unit.status = ops.BlockedStatus(f"Failed to install {snap} snap")
+            return False
+        return True
 
     def _on_upgrade_charm(self, theevent):
         # Upgrade triggers an install.
         channel = self.config.get('channel')
-        os.system(f"snap install microsample --{channel}")
+        for snap in self._worker_snaps(self._stored.workers):
+            if not self._install_microsample(channel, snap):
+                return
 
         # Set workload version
         self.unit.set_workload_version("1.0")
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+"""Benchmark the cos_agent library with ops.testing.Harness, at the scale of large models.
+
+For every combination of principal apps, units per app and dashboards per app, measures the
+wall time and peak memory of a provider `config-changed` hook, with and without its content
+cached from an earlier hook, and of the requirer views (`metrics_alerts`, `logs_alerts`,
+`dashboards`, ...) in a new hook, and the bytes in the databags. The peak memory of an
+uncached provider hook is mostly the lzma compressor's dictionary.
+
+Only the public surface of the library and of Harness is used, so that the same benchmark
+runs against other revisions of the library, e.g. the upstream one:
+
+    charmcraft fetch-lib charms.grafana_agent.v0.cos_agent
+    python3 tests/benchmarks/cos_agent_scale.py --library charms.grafana_agent.v0.cos_agent
+
+Features the library does not have (dashboards by digest, recording rules, the dashboards
+cache, ...) are detected and left out. Every measurement runs in a new Harness, as every hook
+runs in a new charm instance. Harness takes time quadratic in the number of peer units to set
+up the peer relation; that is not measured, but dominates the run time at thousands of units.
+
+The results are written as JSON. Run from the charm directory:
+
+    python3 tests/benchmarks/cos_agent_scale.py
+    python3 tests/benchmarks/cos_agent_scale.py --apps 1,100 --units 1,20 --dashboards 30
+"""
+
+import argparse
+import base64
+import importlib
+import inspect
+import itertools
+import json
+import lzma
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import ops
+from ops.testing import Harness
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "lib"))
+
+# The library under test, see --library.
+cos_agent = None
+
+PROVIDER_META = """
+name: principal
+provides:
+  cos-agent: {interface: cos_agent}
+"""
+REQUIRER_META = """
+name: grafana-agent
+subordinate: true
+requires:
+  cos-agent: {interface: cos_agent, scope: container}
+peers:
+  peers: {interface: grafana_agent_replica}
+"""
+REQUIRER_VIEWS = ("metrics_alerts", "metrics_recording_rules", "logs_alerts", "dashboards")
+
+
+def dashboard(app, index, panels=20):
+    """Return a synthetic dashboard of a few KiB, unique to the app."""
+    return {
+        "title": f"{app} dashboard {index}",
+        "uid": f"{app}-{index}",
+        "panels": [
+            {
+                "id": panel,
+                "title": f"{app} panel {panel}",
+                "type": "timeseries",
+                "gridPos": {"h": 8, "w": 12, "x": 12 * (panel % 2), "y": 8 * (panel // 2)},
+                "targets": [
+                    {
+                        "expr": f'rate({app}_requests_total{{juju_unit=~"$juju_unit"}}[5m])',
+                        "legendFormat": "{{juju_unit}}",
+                        "refId": "A",
+                    }
+                ],
+            }
+            for panel in range(panels)
+        ],
+    }
+
+
+def encoded_dashboard(app, index):
+    """Return a dashboard as sent in relation data: lzma compressed, then base64 encoded."""
+    return base64.b64encode(lzma.compress(json.dumps(dashboard(app, index)).encode())).decode()
+
+
+def alert_rules(app, query_type):
+    """Return synthetic alert rules as sent in relation data."""
+    expr = f'rate({app}_errors_total[5m]) > 1' if query_type == "promql" else (
+        f'count_over_time({{service="{app}"}} |= `error` [1m]) > 0'
+    )
+    return {
+        "groups": [
+            {
+                "name": f"m_00000000_{app}_{query_type}_alerts",
+                "rules": [
+                    {
+                        "alert": f"{app}Alert{rule}",
+                        "expr": expr,
+                        "for": "5m",
+                        "labels": {"severity": "warning", "juju_application": app},
+                    }
+                    for rule in range(3)
+                ],
+            }
+        ]
+    }
+
+
+def supported(func, **kwargs):
+    """Return the keyword arguments which func accepts."""
+    parameters = inspect.signature(func).parameters
+    return {key: value for key, value in kwargs.items() if key in parameters}
+
+
+class ProviderCharm(ops.CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.cos = cos_agent.COSAgentProvider(
+            self,
+            metrics_endpoints=[{"path": "/metrics", "port": 8080}],
+            **supported(
+                cos_agent.COSAgentProvider,
+                metrics_rules_dir="./src/alert_rules/prometheus",
+                logs_rules_dir="./src/alert_rules/loki",
+                recording_rules_dir="./src/recording_rules/prometheus",
+                dashboard_dirs=[self.dashboard_dir],
+                pack_path="/nonexistent",
+            ),
+        )
+
+
+class RequirerCharm(ops.CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.cos = cos_agent.COSAgentRequirer(
+            self,
+            **supported(
+                cos_agent.COSAgentRequirer, dashboards_cache_path=self.dashboards_cache_path
+            ),
+        )
+
+
+def measure(setup, func):
+    """Return the wall time (ms) and peak memory (KiB) of func, each from a separate run.
+
+    Every run calls func with a new Harness from `setup`, which is not measured.
+    """
+    harness = setup()
+    start = time.perf_counter()
+    func(harness)
+    wall_ms = (time.perf_counter() - start) * 1000
+    harness.cleanup()
+
+    harness = setup()
+    tracemalloc.start()
+    func(harness)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    harness.cleanup()
+    return {"wall_ms": round(wall_ms, 3), "peak_kib": round(peak / 1024, 1)}
+
+
+def databag_bytes(harness, relation_id, entities):
+    return sum(
+        len(key) + len(value)
+        for entity in entities
+        for key, value in harness.get_relation_data(relation_id, entity).items()
+    )
+
+
+def bench_provider(dashboards, tmp):
+    """Measure the config-changed hook of a leader provider, with and without its cache."""
+    dashboard_dir = tmp / f"provider-{dashboards}"
+    dashboard_dir.mkdir()
+    for index in range(dashboards):
+        (dashboard_dir / f"{index}.json").write_text(json.dumps(dashboard("principal", index)))
+    ProviderCharm.dashboard_dir = str(dashboard_dir)
+    # The payload features of the requirer, for libraries which negotiate them.
+    features = getattr(cos_agent, "REQUIRER_FEATURES", None)
+
+    def setup():
+        harness = Harness(ProviderCharm, meta=PROVIDER_META)
+        harness.set_model_name("bench")
+        harness.set_leader(True)
+        relation_id = harness.add_relation("cos-agent", "grafana-agent")
+        harness.add_relation_unit(relation_id, "grafana-agent/0")
+        if features:
+            harness.update_relation_data(
+                relation_id, "grafana-agent/0", {cos_agent.FEATURES_KEY: json.dumps(features)}
+            )
+        harness.begin()
+        return harness
+
+    def setup_cached():
+        harness = setup()
+        harness.charm.on.config_changed.emit()
+        return harness
+
+    def config_changed(harness):
+        harness.charm.on.config_changed.emit()
+
+    harness = setup_cached()
+    relation_id = harness.model.get_relation("cos-agent").id
+    bytes_sent = databag_bytes(harness, relation_id, ["principal/0", "principal"])
+    harness.cleanup()
+    return {
+        "provider_refresh": measure(setup, config_changed),
+        "provider_refresh_cached": measure(setup_cached, config_changed),
+        "provider_databag_bytes": bytes_sent,
+    }
+
+
+def peer_databags(apps, units, dashboards):
+    """Return the peer databags of one grafana-agent unit per principal unit, by unit name."""
+    peers_data = cos_agent.CosAgentPeersUnitData
+    # Dashboards are sent once per app, by digest, or inline by every unit.
+    by_digest = "dashboard_digests" in peers_data.__fields__
+    databags = {}
+    agent_units = itertools.count()
+    for app_index in range(apps):
+        app = f"app{app_index}"
+        blobs = [encoded_dashboard(app, index) for index in range(dashboards)]
+        fields = {
+            "metrics_alert_rules": alert_rules(app, "promql"),
+            "log_alert_rules": alert_rules(app, "logql"),
+            "dashboards": blobs,
+        }
+        if by_digest:
+            published = {cos_agent.GrafanaDashboard(blob).digest: blob for blob in blobs}
+            fields.update(dashboards=[], dashboard_digests=sorted(published))
+        for unit_index in range(units):
+            data = peers_data(
+                principal_unit_name=f"{app}/{unit_index}",
+                principal_relation_id=str(app_index),
+                principal_relation_name="cos-agent",
+                **fields,
+            )
+            databag = {data.KEY: data.json()}
+            if by_digest and unit_index == 0:
+                # One unit per app publishes the app's dashboards.
+                databag[data.DASHBOARDS_KEY] = json.dumps(published, sort_keys=True)
+            databags[f"grafana-agent/{next(agent_units)}"] = databag
+    return databags
+
+
+def bench_requirer(apps, units, dashboards, tmp):
+    """Measure the requirer views on the leader, with one grafana-agent unit per principal."""
+    databags = peer_databags(apps, units, dashboards)
+    cache_path = tmp / f"cache-{apps}-{units}-{dashboards}.json"
+    RequirerCharm.dashboards_cache_path = cache_path
+
+    def setup():
+        # The databags are filled in before `begin`, so that no events are emitted.
+        harness = Harness(RequirerCharm, meta=REQUIRER_META)
+        harness.set_model_name("bench")
+        harness.set_leader(True)
+        peer_id = harness.add_relation("peers", "grafana-agent")
+        for unit, databag in databags.items():
+            # This unit's own databag is there already; the others are its peers.
+            if unit != "grafana-agent/0":
+                harness.add_relation_unit(peer_id, unit)
+            harness.update_relation_data(peer_id, unit, databag)
+        harness.begin()
+        return harness
+
+    def setup_uncached():
+        cache_path.unlink(missing_ok=True)
+        return setup()
+
+    def setup_cached():
+        # The dashboards cache, if any, is filled in by an earlier hook.
+        harness = setup_uncached()
+        harness.charm.cos.dashboards
+        harness.cleanup()
+        return setup()
+
+    def view(name):
+        return lambda harness: getattr(harness.charm.cos, name)
+
+    results = {
+        name: measure(setup_uncached, view(name))
+        for name in REQUIRER_VIEWS
+        if hasattr(cos_agent.COSAgentRequirer, name)
+    }
+    results["dashboards_cached"] = measure(setup_cached, view("dashboards"))
+    harness = setup()
+    peer_id = harness.model.get_relation("peers").id
+    results["peer_databag_bytes"] = databag_bytes(harness, peer_id, list(databags))
+    harness.cleanup()
+    return results
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main():
+    global cos_agent
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--library", default="charms.observed.v0.cos_agent")
+    parser.add_argument("--apps", default="1,10,50", type=int_list)
+    parser.add_argument("--units", default="1,10", type=int_list)
+    parser.add_argument("--dashboards", default="1,10,30", type=int_list)
+    parser.add_argument("--output", default="cos_agent_scale.json", type=Path)
+    args = parser.parse_args()
+    cos_agent = importlib.import_module(args.library)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        provider = {d: bench_provider(d, tmp) for d in args.dashboards}
+        for apps, units, dashboards in itertools.product(args.apps, args.units, args.dashboards):
+            result = {"apps": apps, "units_per_app": units, "dashboards_per_app": dashboards}
+            result.update(provider[dashboards])
+            result.update(bench_requirer(apps, units, dashboards, tmp))
+            results.append(result)
+            print(
+                f"{apps:>4} apps {units:>3} units {dashboards:>3} dashboards: "
+                f"refresh {result['provider_refresh']['wall_ms']:>9.1f} ms, "
+                f"dashboards {result['dashboards']['wall_ms']:>9.1f} ms, "
+                f"peer data {result['peer_databag_bytes'] / 1024:>10.1f} KiB",
+                flush=True,
+            )
+
+    args.output.write_text(
+        json.dumps(
+            {
+                "library": args.library,
+                "libpatch": getattr(cos_agent, "LIBPATCH", None),
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+    print(f"\nwrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+"""Compare lzma presets for the dashboards sent over the cos_agent relation.
+
+For every preset, reports the size of the encoded dashboards (what ends up in the databags),
+and the CPU time to serialize and deserialize them. For dashboards of a few KiB, the CPU time
+of the higher presets is mostly spent setting up their large dictionaries.
+
+Run from the charm directory:
+
+    python3 tests/benchmarks/dashboard_compression.py
+    python3 tests/benchmarks/dashboard_compression.py --repeat 50 --dashboards ./dashboards
+"""
+
+import argparse
+import lzma
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "lib"))
+
+from charms.observed.v0.cos_agent import GrafanaDashboard  # noqa: E402
+
+PRESETS = {
+    "0": 0,
+    "1": 1,
+    "3": 3,
+    "6 (default)": lzma.PRESET_DEFAULT,
+    "9": 9,
+    "9e": 9 | lzma.PRESET_EXTREME,
+}
+
+
+def cpu_time(func, repeat):
+    """Return the CPU time of one call of func, in milliseconds, averaged over repeat calls."""
+    start = time.process_time()
+    for _ in range(repeat):
+        func()
+    return (time.process_time() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dashboards", default="src/grafana_dashboards", type=Path)
+    parser.add_argument("--repeat", default=20, type=int)
+    args = parser.parse_args()
+
+    paths = sorted(p for p in args.dashboards.glob("*") if p.is_file())
+    if not paths:
+        parser.error(f"no dashboards found in {args.dashboards}")
+    raw_size = sum(p.stat().st_size for p in paths)
+    print(f"{len(paths)} dashboards, {raw_size} bytes of JSON, {args.repeat} runs each\n")
+
+    print(f"{'preset':<12} {'encoded bytes':>14} {'ratio':>7} {'serialize ms':>13} "
+          f"{'deserialize ms':>15}")
+    for name, preset in PRESETS.items():
+        encoded = [GrafanaDashboard._serialize_file(p, preset) for p in paths]
+        size = sum(len(e) for e in encoded)
+        serialize = cpu_time(
+            lambda: [GrafanaDashboard._serialize_file(p, preset) for p in paths], args.repeat
+        )
+        deserialize = cpu_time(lambda: [e._deserialize() for e in encoded], args.repeat)
+        print(f"{name:<12} {size:>14} {size / raw_size:>7.2f} {serialize:>13.2f} "
+              f"{deserialize:>15.2f}")
+
+
+if __name__ == "__main__":
+    main()
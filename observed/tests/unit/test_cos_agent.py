@@ -0,0 +1,678 @@
+# Copyright 2023 Erik Lönroth
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import json
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import ops
+from charms.observed.v0.cos_agent import (
+    FEATURES_KEY,
+    REQUIRER_FEATURES,
+    COSAgentConfigRenderer,
+    COSAgentDataChanged,
+    COSAgentProvider,
+    COSAgentRequirer,
+    CosAgentProviderUnitData,
+    GrafanaDashboard,
+    _read_chunked,
+    _write_chunked,
+    pack,
+)
+from ops.testing import Harness
+
+REQUIRER_METADATA = """
+name: grafana-agent
+subordinate: true
+requires:
+  cos-agent: {interface: cos_agent, scope: container}
+peers:
+  peers: {interface: grafana_agent_replica}
+"""
+
+PROVIDER_METADATA = """
+name: observed
+provides:
+  cos-agent: {interface: cos_agent}
+"""
+CHARM_DIR = Path(__file__).resolve().parents[2]
+
+
+class RecordingDatabag(dict):
+    """A databag which records the keys written to it."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.written = []
+
+    def __setitem__(self, key, value):
+        self.written.append(key)
+        if value:
+            super().__setitem__(key, value)
+        else:
+            # An empty value removes the key, as in relation data.
+            self.pop(key, None)
+
+
+class TestChunking(unittest.TestCase):
+    def test_small_payload_stays_under_one_key(self):
+        databag = RecordingDatabag()
+        _write_chunked(databag, "config", "x" * 10, chunk_size=10)
+        self.assertEqual(databag, {"config": "x" * 10})
+        self.assertEqual(_read_chunked(databag, "config"), "x" * 10)
+
+    def test_large_payload_is_split(self):
+        databag = RecordingDatabag()
+        payload = "abc" * 10
+        _write_chunked(databag, "config", payload, chunk_size=8)
+
+        self.assertNotIn("config", databag)
+        self.assertEqual(len(json.loads(databag["config-manifest"])), 4)
+        self.assertEqual(databag["config-3"], payload[24:])
+        self.assertEqual(_read_chunked(databag, "config"), payload)
+
+    def test_only_changed_chunks_are_written(self):
+        databag = RecordingDatabag()
+        payload = "a" * 8 + "b" * 8 + "c" * 8
+        _write_chunked(databag, "config", payload, chunk_size=8)
+        databag.written.clear()
+
+        _write_chunked(databag, "config", payload[:8] + "B" * 8 + payload[16:], chunk_size=8)
+        self.assertEqual(sorted(databag.written), ["config-1", "config-manifest"])
+
+        databag.written.clear()
+        _write_chunked(databag, "config", payload[:8] + "B" * 8 + payload[16:], chunk_size=8)
+        self.assertEqual(databag.written, [])
+
+    def test_shrinking_back_to_one_key_removes_the_chunks(self):
+        databag = RecordingDatabag()
+        _write_chunked(databag, "config", "x" * 30, chunk_size=8)
+        _write_chunked(databag, "config", "small", chunk_size=8)
+        self.assertEqual(databag, {"config": "small"})
+        self.assertEqual(_read_chunked(databag, "config"), "small")
+
+    def test_fewer_chunks_removes_the_rest(self):
+        databag = RecordingDatabag()
+        _write_chunked(databag, "config", "x" * 30, chunk_size=8)
+        _write_chunked(databag, "config", "y" * 12, chunk_size=8)
+        self.assertEqual(sorted(databag), ["config-0", "config-1", "config-manifest"])
+        self.assertEqual(_read_chunked(databag, "config"), "y" * 12)
+
+    def test_digest_mismatch_reads_nothing(self):
+        databag = RecordingDatabag()
+        _write_chunked(databag, "config", "x" * 30, chunk_size=8)
+        # A chunk written before the manifest caught up, as seen by the remote.
+        dict.__setitem__(databag, "config-1", "z" * 8)
+        with self.assertLogs("charms.observed.v0.cos_agent", "WARNING"):
+            self.assertIsNone(_read_chunked(databag, "config"))
+
+    def test_no_chunk_size_never_splits(self):
+        databag = RecordingDatabag()
+        _write_chunked(databag, "config", "x" * 30, chunk_size=None)
+        self.assertEqual(databag, {"config": "x" * 30})
+
+    def test_missing_payload(self):
+        self.assertIsNone(_read_chunked({}, "config"))
+
+    def test_json_is_split_on_record_boundaries(self):
+        databag = RecordingDatabag()
+        payload = {"groups": [{"name": name, "rules": ["x" * 20]} for name in "abcd"], "v": 1}
+        _write_chunked(databag, "config", json.dumps(payload), chunk_size=80)
+
+        manifest = json.loads(databag["config-manifest"])
+        chunks = [databag[f"config-{i}"] for i in range(len(manifest))]
+        self.assertEqual(
+            chunks,
+            [
+                '{"groups": [{"name": "a", "rules": ["xxxxxxxxxxxxxxxxxxxx"]}',
+                ', {"name": "b", "rules": ["xxxxxxxxxxxxxxxxxxxx"]}',
+                ', {"name": "c", "rules": ["xxxxxxxxxxxxxxxxxxxx"]}',
+                ', {"name": "d", "rules": ["xxxxxxxxxxxxxxxxxxxx"]}',
+                '], "v": 1}',
+            ],
+        )
+        self.assertEqual(json.loads(_read_chunked(databag, "config")), payload)
+
+    def test_record_changing_length_only_rewrites_its_chunk(self):
+        databag = RecordingDatabag()
+        payload = {"groups": [{"name": name, "rules": ["x" * 20]} for name in "abcd"]}
+        _write_chunked(databag, "config", json.dumps(payload), chunk_size=80)
+        databag.written.clear()
+
+        payload["groups"][1]["rules"].append("y")
+        _write_chunked(databag, "config", json.dumps(payload), chunk_size=80)
+        self.assertEqual(sorted(databag.written), ["config-1", "config-manifest"])
+        self.assertEqual(json.loads(_read_chunked(databag, "config")), payload)
+
+    def test_record_larger_than_a_chunk_is_split(self):
+        databag = RecordingDatabag()
+        payload = {"dashboards": ["a" * 10, "b" * 120, "c" * 10]}
+        _write_chunked(databag, "config", json.dumps(payload), chunk_size=50)
+
+        # The large dashboard takes 3 chunks, the others one each.
+        self.assertEqual(len(json.loads(databag["config-manifest"])), 5)
+        self.assertEqual(json.loads(_read_chunked(databag, "config")), payload)
+
+
+class RequirerCharm(ops.CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.cos = COSAgentRequirer(self, dashboards_cache_path=self.dashboards_cache_path)
+        self.changes = []
+        self.framework.observe(self.cos.on.data_changed, self._on_data_changed)
+
+    def _on_data_changed(self, event):
+        self.changes.append(event.changes)
+
+
+class ProviderCharm(ops.CharmBase):
+    # Set by the tests: the COSAgentProvider keyword arguments.
+    provider_kwargs = {}
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.cos = COSAgentProvider(self, **self.provider_kwargs)
+
+
+class ProviderTestCase(unittest.TestCase):
+    """Copies the rules and dashboards of this charm to a temporary directory."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        src = CHARM_DIR / "src"
+        for source, name in (
+            ("alert_rules/prometheus", "metrics_rules"),
+            ("alert_rules/prometheus", "metrics_rules/nested"),
+            ("alert_rules/loki", "logs_rules"),
+            ("recording_rules/prometheus", "recording_rules"),
+            ("grafana_dashboards", "dashboards"),
+        ):
+            shutil.copytree(src / source, self.tmp / name)
+        self.dirs = {
+            "metrics_rules_dir": str(self.tmp / "metrics_rules"),
+            "logs_rules_dir": str(self.tmp / "logs_rules"),
+            "recording_rules_dir": str(self.tmp / "recording_rules"),
+            "dashboard_dirs": [str(self.tmp / "dashboards")],
+            "recurse_rules_dirs": True,
+        }
+        ProviderCharm.provider_kwargs = {**self.dirs, "pack_path": str(self.tmp / "pack.json")}
+
+    def relate(self, leader=False, features=None):
+        """Relate a provider unit to a grafana-agent unit listing `features`, if any."""
+        harness = Harness(ProviderCharm, meta=PROVIDER_METADATA)
+        self.addCleanup(harness.cleanup)
+        # The topology, and so the rule group names, include the model uuid.
+        harness.set_model_info("cos", "3a6c6ac4-70a5-4a52-8cd1-6a1c6c9e5a9f")
+        harness.set_leader(leader)
+        harness.begin()
+        relation_id = harness.add_relation("cos-agent", "grafana-agent")
+        harness.add_relation_unit(relation_id, "grafana-agent/0")
+        if features is not None:
+            harness.update_relation_data(
+                relation_id, "grafana-agent/0", {FEATURES_KEY: json.dumps(features)}
+            )
+        return harness, relation_id
+
+    @staticmethod
+    def provider_data(harness, relation_id) -> dict:
+        """Return the unit databag payload of the provider."""
+        data = harness.get_relation_data(relation_id, harness.charm.unit.name)
+        return json.loads(_read_chunked(data, CosAgentProviderUnitData.KEY))
+
+
+class TestPack(ProviderTestCase):
+    def test_packed_payload_equals_the_directories_payload(self):
+        from_dirs = self.provider_data(*self.relate())
+        pack(str(self.tmp / "pack.json"), **self.dirs)
+        from_pack = self.provider_data(*self.relate())
+
+        self.assertEqual(from_pack, from_dirs)
+        self.assertEqual(len(from_pack["metrics_alert_rules"]["groups"]), 2)
+        self.assertEqual(len(from_pack["log_alert_rules"]["groups"]), 1)
+        self.assertEqual(len(from_pack["metrics_recording_rules"]["groups"]), 1)
+
+    def test_invalid_rule_file_fails_the_pack(self):
+        (self.tmp / "logs_rules" / "broken.rule").write_text("groups: [")
+        with self.assertRaisesRegex(ValueError, "invalid logql alert rules file: .*broken.rule"):
+            pack(str(self.tmp / "pack.json"), **self.dirs)
+        self.assertFalse((self.tmp / "pack.json").exists())
+
+
+class TestProviderContent(ProviderTestCase):
+    def setUp(self):
+        super().setUp()
+        serialize_file = GrafanaDashboard._serialize_file
+        patcher = patch.object(GrafanaDashboard, "_serialize_file", wraps=serialize_file)
+        self.serialize_file = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unchanged_files_are_not_read_again(self):
+        harness, relation_id = self.relate()
+        self.assertEqual(self.serialize_file.call_count, 2)
+        payload = self.provider_data(harness, relation_id)
+
+        harness.charm.on.config_changed.emit()
+        self.assertEqual(self.serialize_file.call_count, 2)
+        self.assertEqual(self.provider_data(harness, relation_id), payload)
+
+    def test_changed_file_rebuilds_the_content(self):
+        harness, relation_id = self.relate()
+        dashboard = {"title": "Changed", "panels": []}
+        (self.tmp / "dashboards" / "microsample_dashboard.json").write_text(json.dumps(dashboard))
+
+        harness.charm.on.config_changed.emit()
+        self.assertEqual(self.serialize_file.call_count, 4)
+        dashboards = self.provider_data(harness, relation_id)["dashboards"]
+        self.assertIn(dashboard, [GrafanaDashboard(d)._deserialize() for d in dashboards])
+
+    def test_changed_rule_file_rebuilds_the_content(self):
+        harness, relation_id = self.relate()
+        rules = {"groups": [{"name": "up", "rules": [{"alert": "Down", "expr": "up == 0"}]}]}
+        (self.tmp / "logs_rules" / "microsample_loki.rule").write_text(json.dumps(rules))
+
+        harness.charm.on.config_changed.emit()
+        groups = self.provider_data(harness, relation_id)["log_alert_rules"]["groups"]
+        self.assertEqual([rule["alert"] for rule in groups[0]["rules"]], ["Down"])
+
+
+class TestProviderWrites(ProviderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.written = []
+        set_item = ops.model.RelationDataContent.__setitem__
+
+        def record(databag, key, value):
+            self.written.append(key)
+            set_item(databag, key, value)
+
+        patcher = patch.object(ops.model.RelationDataContent, "__setitem__", record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unchanged_payload_is_not_written(self):
+        harness, _ = self.relate(leader=True, features=REQUIRER_FEATURES)
+        self.assertIn(CosAgentProviderUnitData.KEY, self.written)
+        self.assertIn(CosAgentProviderUnitData.DASHBOARDS_KEY, self.written)
+
+        self.written.clear()
+        harness.charm.on.config_changed.emit()
+        self.assertEqual(self.written, [])
+
+    def test_payload_is_built_once_per_event(self):
+        harness, relation_id = self.relate()
+        other_id = harness.add_relation("cos-agent", "grafana-agent-2")
+        harness.add_relation_unit(other_id, "grafana-agent-2/0")
+
+        built = []
+        to_json = CosAgentProviderUnitData.json
+
+        def record(data, *args, **kwargs):
+            built.append(data)
+            return to_json(data, *args, **kwargs)
+
+        with patch.object(CosAgentProviderUnitData, "json", record):
+            harness.charm.on.config_changed.emit()
+        self.assertEqual(len(built), 1)
+        self.assertEqual(
+            self.provider_data(harness, other_id), self.provider_data(harness, relation_id)
+        )
+
+    def test_dashboards_are_published_by_digest(self):
+        harness, relation_id = self.relate(leader=True, features=REQUIRER_FEATURES)
+        payload = self.provider_data(harness, relation_id)
+        app_data = harness.get_relation_data(relation_id, harness.charm.app.name)
+        published = json.loads(_read_chunked(app_data, CosAgentProviderUnitData.DASHBOARDS_KEY))
+
+        self.assertEqual(payload["dashboards"], [])
+        self.assertEqual(sorted(payload["dashboard_digests"]), sorted(published))
+        for digest, dashboard in published.items():
+            self.assertEqual(GrafanaDashboard(dashboard).digest, digest)
+
+    def test_dashboards_are_inline_for_requirers_without_digests(self):
+        harness, relation_id = self.relate(leader=True)
+        payload = self.provider_data(harness, relation_id)
+        app_data = harness.get_relation_data(relation_id, harness.charm.app.name)
+
+        self.assertEqual(len(payload["dashboards"]), 2)
+        self.assertIsNone(payload["dashboard_digests"])
+        self.assertNotIn(CosAgentProviderUnitData.DASHBOARDS_KEY, app_data)
+
+    def test_only_the_leader_publishes_dashboards(self):
+        harness, relation_id = self.relate(features=REQUIRER_FEATURES)
+        self.assertEqual(len(self.provider_data(harness, relation_id)["dashboard_digests"]), 2)
+        self.assertNotIn(CosAgentProviderUnitData.DASHBOARDS_KEY, self.written)
+
+
+class RequirerTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        RequirerCharm.dashboards_cache_path = self.tmp / "dashboards.json"
+        self.harness = self.begin()
+        self.relation_id = None
+
+    def begin(self):
+        """Start a requirer unit, as in a new hook if there is already one."""
+        harness = Harness(RequirerCharm, meta=REQUIRER_METADATA)
+        self.addCleanup(harness.cleanup)
+        harness.add_relation("peers", "grafana-agent")
+        harness.begin()
+        return harness
+
+    def relate(self, **provider_data):
+        """Relate to the principal, or update its data if already related."""
+        data = CosAgentProviderUnitData(
+            metrics_alert_rules=provider_data.pop("metrics_alert_rules", {}),
+            log_alert_rules=provider_data.pop("log_alert_rules", {}),
+            dashboards=provider_data.pop("dashboards", []),
+            metrics_scrape_jobs=provider_data.pop("metrics_scrape_jobs", []),
+            log_slots=[],
+            **provider_data,
+        )
+        if self.relation_id is None:
+            self.relation_id = self.harness.add_relation("cos-agent", "observed")
+            self.harness.add_relation_unit(self.relation_id, "observed/0")
+        self.harness.update_relation_data(self.relation_id, "observed/0", {data.KEY: data.json()})
+        return data
+
+
+class TestRecordingRules(ProviderTestCase):
+    def test_recording_rules_carry_the_topology(self):
+        payload = self.provider_data(*self.relate())
+        [group] = payload["metrics_recording_rules"]["groups"]
+        [rule] = group["rules"]
+
+        self.assertTrue(group["name"].startswith("cos_3a6c6ac4_observed_"))
+        self.assertEqual(rule["record"], "juju_unit:microsample_calls:rate2m")
+        self.assertEqual(rule["labels"]["juju_application"], "observed")
+
+    def test_no_recording_rules(self):
+        shutil.rmtree(self.tmp / "recording_rules")
+        payload = self.provider_data(*self.relate())
+        self.assertEqual(payload["metrics_recording_rules"], {})
+
+
+class TestRequirerJobs(RequirerTestCase):
+    def test_metrics_jobs(self):
+        self.relate(
+            metrics_scrape_jobs=[
+                {"job_name": "observed_0", "path": "/metrics", "port": 8080},
+                {
+                    "job_name": "observed_1",
+                    "path": "/metrics",
+                    "port": 8081,
+                    "scrape_interval": "30s",
+                    "labels": {"worker": "1"},
+                    "keep_metrics": ["microsample_.*", "up"],
+                    "drop_metrics": ["microsample_debug_.*"],
+                },
+            ]
+        )
+        self.assertEqual(
+            self.harness.charm.cos.metrics_jobs,
+            [
+                {
+                    "job_name": "observed_0",
+                    "metrics_path": "/metrics",
+                    "static_configs": [{"targets": ["localhost:8080"]}],
+                },
+                {
+                    "job_name": "observed_1",
+                    "metrics_path": "/metrics",
+                    "static_configs": [
+                        {"targets": ["localhost:8081"], "labels": {"worker": "1"}}
+                    ],
+                    "scrape_interval": "30s",
+                    "metric_relabel_configs": [
+                        {
+                            "source_labels": ["__name__"],
+                            "regex": "(?:microsample_.*)|(?:up)",
+                            "action": "keep",
+                        },
+                        {
+                            "source_labels": ["__name__"],
+                            "regex": "(?:microsample_debug_.*)",
+                            "action": "drop",
+                        },
+                    ],
+                },
+            ],
+        )
+
+    def test_log_file_jobs(self):
+        self.relate(
+            log_files=[
+                {"job_name": "observed_logs_0", "path": "/var/log/app/*.log"},
+                {
+                    "job_name": "observed_logs_1",
+                    "path": "/var/log/syslog",
+                    "labels": {"service": "microsample"},
+                    "keep_lines": ["microsample"],
+                    "drop_lines": ["DEBUG"],
+                    "rate_limit": 100,
+                },
+            ]
+        )
+        self.assertEqual(
+            self.harness.charm.cos.log_file_jobs,
+            [
+                {
+                    "job_name": "observed_logs_0",
+                    "static_configs": [
+                        {
+                            "targets": ["localhost"],
+                            "labels": {"job": "observed_logs_0", "__path__": "/var/log/app/*.log"},
+                        }
+                    ],
+                },
+                {
+                    "job_name": "observed_logs_1",
+                    "static_configs": [
+                        {
+                            "targets": ["localhost"],
+                            "labels": {
+                                "service": "microsample",
+                                "job": "observed_logs_1",
+                                "__path__": "/var/log/syslog",
+                            },
+                        }
+                    ],
+                    "pipeline_stages": [
+                        {
+                            "match": {
+                                "selector": '{job="observed_logs_1"} !~ `(?:microsample)`',
+                                "action": "drop",
+                                "drop_counter_reason": "keep_lines",
+                            }
+                        },
+                        {"drop": {"expression": "(?:DEBUG)", "drop_counter_reason": "drop_lines"}},
+                        {"limit": {"rate": 100, "burst": 100, "drop": True}},
+                    ],
+                },
+            ],
+        )
+
+    def test_no_principal(self):
+        self.assertEqual(self.harness.charm.cos.metrics_jobs, [])
+        self.assertEqual(self.harness.charm.cos.log_file_jobs, [])
+
+
+class TestRequirerDashboards(RequirerTestCase):
+    def setUp(self):
+        super().setUp()
+        original = GrafanaDashboard._decompress
+        patcher = patch.object(
+            GrafanaDashboard, "_decompress", autospec=True, side_effect=original
+        )
+        self.decompress = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dashboards = [
+            GrafanaDashboard._serialize(json.dumps({"title": title})) for title in ("A", "B")
+        ]
+
+    def titles(self, harness=None):
+        return sorted(d["title"] for d in (harness or self.harness).charm.cos.dashboards)
+
+    def test_dashboards_are_decompressed_once(self):
+        self.relate(dashboards=self.dashboards)
+        self.assertEqual(self.titles(), ["A", "B"])
+        self.assertEqual(self.titles(), ["A", "B"])
+        self.assertEqual(self.decompress.call_count, 2)
+
+    def test_cache_is_kept_across_hooks(self):
+        data = self.relate(dashboards=self.dashboards)
+        self.titles()
+
+        # A new hook, reading the same relation data.
+        harness = self.begin()
+        relation_id = harness.add_relation("cos-agent", "observed")
+        harness.add_relation_unit(relation_id, "observed/0")
+        harness.update_relation_data(relation_id, "observed/0", {data.KEY: data.json()})
+        self.assertEqual(self.titles(harness), ["A", "B"])
+        self.assertEqual(self.decompress.call_count, 2)
+
+    def test_cache_keeps_the_dashboards_in_use(self):
+        self.relate(dashboards=self.dashboards)
+        self.titles()
+        self.relate(dashboards=self.dashboards[:1])
+        self.assertEqual(self.titles(), ["A"])
+
+        cache = json.loads(RequirerCharm.dashboards_cache_path.read_text())
+        self.assertEqual(list(cache), [self.dashboards[0].digest])
+
+    def test_corrupt_cache_is_rebuilt(self):
+        RequirerCharm.dashboards_cache_path.write_text("{not json")
+        self.relate(dashboards=self.dashboards)
+        self.assertEqual(self.titles(), ["A", "B"])
+        self.assertEqual(len(json.loads(RequirerCharm.dashboards_cache_path.read_text())), 2)
+
+
+class TestRequirerDataChanged(RequirerTestCase):
+    RULES = {"groups": [{"name": "up", "rules": [{"alert": "Down", "expr": "up == 0"}]}]}
+    JOBS = [{"job_name": "observed_0", "path": "/metrics", "port": 8080}]
+
+    def test_first_data_changes_every_category(self):
+        self.relate(metrics_alert_rules=self.RULES)
+        self.assertEqual(
+            self.harness.charm.changes,
+            [
+                {
+                    "observed": [
+                        "dashboards",
+                        "log_alert_rules",
+                        "log_files",
+                        "log_slots",
+                        "metrics_alert_rules",
+                        "metrics_recording_rules",
+                        "metrics_scrape_jobs",
+                    ]
+                }
+            ],
+        )
+
+    def test_unchanged_data_emits_nothing(self):
+        self.relate(metrics_alert_rules=self.RULES, metrics_scrape_jobs=self.JOBS)
+        self.harness.charm.changes.clear()
+
+        self.harness.charm.on.config_changed.emit()
+        self.relate(metrics_alert_rules=self.RULES, metrics_scrape_jobs=self.JOBS)
+        self.assertEqual(self.harness.charm.changes, [])
+
+    def test_only_changed_categories_are_emitted(self):
+        self.relate(metrics_alert_rules=self.RULES)
+        self.harness.charm.changes.clear()
+
+        self.relate(metrics_alert_rules=self.RULES, metrics_scrape_jobs=self.JOBS)
+        self.relate(metrics_scrape_jobs=self.JOBS)
+        self.assertEqual(
+            self.harness.charm.changes,
+            [{"observed": ["metrics_scrape_jobs"]}, {"observed": ["metrics_alert_rules"]}],
+        )
+
+    def test_deferred_event_keeps_its_changes(self):
+        event = COSAgentDataChanged(None, {"observed": ["dashboards"]})
+        restored = COSAgentDataChanged(None)
+        restored.restore(event.snapshot())
+        self.assertEqual(restored.changes, {"observed": ["dashboards"]})
+        self.assertEqual(restored.apps, {"observed"})
+        self.assertEqual(restored.categories, {"dashboards"})
+
+
+class TestRequirerRecordingRules(RequirerTestCase):
+    ALERTS = {"groups": [{"name": "up", "rules": [{"alert": "Down", "expr": "up == 0"}]}]}
+    RECORDS = {"groups": [{"name": "up", "rules": [{"record": "job:up:sum", "expr": "sum(up)"}]}]}
+
+    def test_recording_rules_by_identifier(self):
+        self.relate(metrics_alert_rules=self.ALERTS, metrics_recording_rules=self.RECORDS)
+        cos = self.harness.charm.cos
+        self.assertEqual(list(cos.metrics_recording_rules.values()), [self.RECORDS])
+        self.assertEqual(cos.metrics_recording_rules.keys(), cos.metrics_alerts.keys())
+
+    def test_provider_without_recording_rules(self):
+        # As sent by providers using charms.grafana_agent.v0.cos_agent.
+        data = {
+            "metrics_alert_rules": self.ALERTS,
+            "log_alert_rules": {},
+            "dashboards": [],
+            "metrics_scrape_jobs": [],
+            "log_slots": [],
+        }
+        relation_id = self.harness.add_relation("cos-agent", "observed")
+        self.harness.add_relation_unit(relation_id, "observed/0")
+        self.harness.update_relation_data(
+            relation_id, "observed/0", {CosAgentProviderUnitData.KEY: json.dumps(data)}
+        )
+        self.assertEqual(self.harness.charm.cos.metrics_recording_rules, {})
+        self.assertEqual(list(self.harness.charm.cos.metrics_alerts.values()), [self.ALERTS])
+
+
+class TestConfigRenderer(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name) / "agent.yaml"
+        RequirerCharm.dashboards_cache_path = Path(tmp.name) / "dashboards.json"
+        self.harness = Harness(RequirerCharm, meta=REQUIRER_METADATA)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
+        self.reloads = 0
+        self.reload_error = None
+        self.renderer = COSAgentConfigRenderer(
+            self.harness.charm.cos, self.path, reload=self.reload
+        )
+
+    def reload(self):
+        self.reloads += 1
+        if self.reload_error:
+            raise self.reload_error
+
+    def test_unchanged_config_is_not_reloaded(self):
+        self.assertTrue(self.renderer.update())
+        self.assertFalse(self.renderer.update())
+        self.assertEqual(self.reloads, 1)
+
+    def test_failed_reload_is_retried(self):
+        self.path.write_text("old: config\n")
+        self.reload_error = RuntimeError("reload failed")
+        with self.assertRaises(RuntimeError):
+            self.renderer.update()
+        self.assertEqual(self.path.read_text(), "old: config\n")
+
+        self.reload_error = None
+        self.assertTrue(self.renderer.update())
+        self.assertEqual(self.reloads, 2)
+        self.assertEqual(self.path.read_text(), self.renderer.render())
+
+    def test_failed_first_reload_removes_the_config(self):
+        self.reload_error = RuntimeError("reload failed")
+        with self.assertRaises(RuntimeError):
+            self.renderer.update()
+        self.assertFalse(self.path.exists())
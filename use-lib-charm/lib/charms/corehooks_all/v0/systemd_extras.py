@@ -0,0 +1,916 @@
+# Copyright 2023 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""Extensions to the systemd library, for running and observing workloads next to each other.
+
+These build on `charms.operator_libs_linux.v1.systemd` (fetch it with
+`charmcraft fetch-lib charms.operator_libs_linux.v1.systemd`), which they don't change: its
+`SystemdError` is raised for every error, and its `daemon_reload()` and `service_*()` functions
+are used together with these.
+
+This library is not published on Charmhub. corehooks-all owns it; the charms using it carry a
+copy of this file, copied by hand, which must stay identical to the one in corehooks-all.
+
+Heavy work, like package installs, can be run in a transient scope with a low CPU and IO
+priority, so that it does not cause latency spikes in the workload running next to it:
+
+```python
+from charms.corehooks_all.v0.systemd_extras import LOW_PRIORITY_SCOPE, run_in_scope
+
+# Run a command
+run_in_scope(["apt-get", "install", "-y", "hello"], **LOW_PRIORITY_SCOPE)
+
+# Run a callable, in a forked child process, with other limits
+run_in_scope(lambda: apt.add_package("zsh"), cpu_weight=50, memory_high="512M")
+```
+
+Resource limits of a service are persisted in a drop-in, and applied to the running
+service without a restart where systemd allows it. They can be given directly, or by the
+charm config options in `RESOURCE_LIMIT_OPTIONS` (cpu_quota, memory_max, ...):
+
+```python
+from charms.corehooks_all.v0.systemd_extras import (
+    resource_limits_from_config, service_set_resource_limits
+)
+from charms.operator_libs_linux.v1.systemd import service_restart
+
+if service_set_resource_limits("mysql", {"CPUQuota": "200%", "LimitNOFILE": "65536"}):
+    # Some limits, like LimitNOFILE, only apply to newly started processes.
+    service_restart("mysql")
+
+service_set_resource_limits("mysql", resource_limits_from_config(self.config))
+```
+
+The resource usage of a service is read directly from its cgroup (v2 only), which is cheap
+enough to do in every hook:
+
+```python
+from charms.corehooks_all.v0.systemd_extras import CgroupStats, service_cgroup_stats
+
+sample = service_cgroup_stats("mysql")
+logger.info("mysql uses %d bytes of memory", sample.memory_current)
+
+# Rates need a previous sample, e.g. kept in StoredState with `CgroupStats.as_dict()`.
+rates = sample.rates(CgroupStats.from_dict(previous))
+logger.info("mysql uses %.1f%% CPU", rates["cpu_percent"])
+```
+
+The journal of a service can be read incrementally, keeping the cursor between hooks, so
+every hook only reads the entries logged since the previous one:
+
+```python
+from charms.corehooks_all.v0.systemd_extras import JournalReader
+
+reader = JournalReader("mysql", cursor=self._stored.cursor, max_entries=50)
+reader.read()
+self._stored.cursor = reader.cursor
+if reader.errors:
+    self.unit.status = ActiveStatus(f"{reader.errors} errors since last check")
+```
+
+Services can be socket activated: systemd holds the listening socket, starts the service on
+the first connection and keeps queueing connections while the service restarts. Services
+which can't take a socket from systemd are put behind `systemd-socket-proxyd`:
+
+```python
+from charms.corehooks_all.v0.systemd_extras import (
+    install_unit, render_socket_proxy_unit, render_socket_unit
+)
+from charms.operator_libs_linux.v1.systemd import daemon_reload, service_enable
+
+changed = install_unit("myapp-proxy.socket", render_socket_unit("8080", description="myapp"))
+changed |= install_unit(
+    "myapp-proxy.service",
+    render_socket_proxy_unit("127.0.0.1:18080", description="myapp", requires="myapp.service"),
+)
+if changed:
+    daemon_reload()
+service_enable("--now", "myapp-proxy.socket")
+```
+"""
+
+__all__ = [
+    "CgroupStats",
+    "JournalReader",
+    "install_unit",
+    "remove_unit",
+    "render_socket_proxy_unit",
+    "render_socket_unit",
+    "resource_limits_from_config",
+    "run_in_scope",
+    "service_cgroup_path",
+    "service_cgroup_stats",
+    "services_running",
+    "service_set_resource_limits",
+]
+
+import json
+import logging
+import os
+import pickle
+import re
+import shlex
+import signal
+import subprocess
+import time
+import uuid
+from collections import deque
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Union
+
+from charms.operator_libs_linux.v1.systemd import SystemdError, daemon_reload
+
+logger = logging.getLogger(__name__)
+
+# Not published on Charmhub, so there is no LIBID. Increment LIBPATCH on every change, and
+# copy the file to the charms using it.
+LIBAPI = 0
+LIBPATCH = 4
+
+
+def _systemctl(*args: str) -> None:
+    """Run systemctl, like the systemd library does with check=True.
+
+    Raises:
+        SystemdError: Raised if systemctl returns a non-zero returncode.
+    """
+    cmd = ["systemctl", *args]
+    logger.debug(f"Executing command: {cmd}")
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if proc.returncode != 0:
+        raise SystemdError(
+            f"Command {cmd} failed with returncode {proc.returncode}. systemctl output:\n"
+            f"{proc.stdout}"
+        )
+
+
+def services_running(*service_names: str) -> Dict[str, bool]:
+    """Report whether each of a number of system services is running, with one systemctl call.
+
+    This is cheaper than calling `service_running` for each service, e.g. for all the
+    instances of a template unit.
+
+    Args:
+        *service_names: The names of the services to check.
+
+    Returns:
+        A mapping of service name to True if it is running/active; False if not.
+    """
+    if not service_names:
+        return {}
+    cmd = ["systemctl", "is-active", *service_names]
+    logger.debug(f"Executing command: {cmd}")
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    # One line per service, in order, e.g. "active", "inactive" or "failed".
+    states = proc.stdout.splitlines()
+    return {name: state == "active" for name, state in zip(service_names, states)}
+
+
+# Resource control properties which `systemctl set-property` can change on a running unit.
+LIVE_RESOURCE_PROPERTIES = ("CPUQuota", "CPUWeight", "IOWeight", "MemoryMax", "TasksMax")
+# Process limits which only apply to processes started after the change.
+RESTART_RESOURCE_PROPERTIES = ("LimitNOFILE",)
+
+# Charm config options, and the resource control properties they set. See
+# `resource_limits_from_config`.
+RESOURCE_LIMIT_OPTIONS = {
+    "cpu_quota": "CPUQuota",
+    "cpu_weight": "CPUWeight",
+    "memory_max": "MemoryMax",
+    "io_weight": "IOWeight",
+    "tasks_max": "TasksMax",
+    "limit_nofile": "LimitNOFILE",
+}
+
+RESOURCE_LIMITS_DROPIN = "50-charm-resource-limits.conf"
+# Where `systemctl set-property --runtime` writes its drop-ins, one per property.
+SYSTEMD_RUNTIME_CONTROL_DIR = "/run/systemd/system.control"
+
+# The values accepted for each resource limit, a subset of what systemd accepts.
+_SIZE_VALUE = r"\d+(\.\d+)?[KMGTPE]?|\d+(\.\d+)?%|infinity"
+_RESOURCE_VALUES = {
+    "CPUQuota": r"\d+(\.\d+)?%",
+    "CPUWeight": r"\d+|idle",
+    "IOWeight": r"\d+",
+    "MemoryMax": _SIZE_VALUE,
+    "TasksMax": r"\d+|\d+(\.\d+)?%|infinity",
+    "LimitNOFILE": r"(\d+|infinity)(:(\d+|infinity))?",
+}
+# Weights are relative to the default of 100.
+_WEIGHT_RANGE = range(1, 10001)
+
+
+def _unit_name(service_name: str) -> str:
+    """Return the full unit name of a service, e.g. "mysql" -> "mysql.service"."""
+    return service_name if "." in service_name else f"{service_name}.service"
+
+
+def _read_dropin(path: str) -> Dict[str, str]:
+    """Parse the key=value settings of a drop-in file written by this library."""
+    settings = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, sep, value = line.strip().partition("=")
+                if sep:
+                    settings[key] = value
+    except FileNotFoundError:
+        pass
+    return settings
+
+
+def _write_dropin(path: str, settings: Dict[str, str]) -> None:
+    """Write the key=value settings of a drop-in, or remove it if there are none."""
+    if not settings:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("# Managed by the charm, do not edit.\n[Service]\n")
+        f.writelines(f"{name}={value}\n" for name, value in settings.items())
+
+
+def resource_limits_from_config(config: Mapping[str, Any]) -> Dict[str, str]:
+    """Return the resource limits set by the options of a charm config.
+
+    The options are those of `RESOURCE_LIMIT_OPTIONS`. Options which are missing or empty are
+    left out, so that `service_set_resource_limits` resets their properties.
+    """
+    return {
+        prop: str(config[option])
+        for option, prop in RESOURCE_LIMIT_OPTIONS.items()
+        if config.get(option)
+    }
+
+
+def _invalid_resource_limits(limits: Dict[str, str]) -> List[str]:
+    """Return the names of the limits whose value systemd would not accept."""
+    invalid = []
+    for name, value in limits.items():
+        if not re.fullmatch(_RESOURCE_VALUES[name], value):
+            invalid.append(name)
+        elif name.endswith("Weight") and value.isdigit() and int(value) not in _WEIGHT_RANGE:
+            invalid.append(name)
+    return invalid
+
+
+def service_set_resource_limits(
+    service_name: str,
+    limits: Dict[str, str],
+    dropin_name: str = RESOURCE_LIMITS_DROPIN,
+    instances: Sequence[str] = (),
+) -> bool:
+    """Set the resource limits of a system service.
+
+    The limits are written to a drop-in, `/etc/systemd/system/<unit>.d/<dropin_name>`, so they
+    survive restarts and reboots. Changed resource control properties (see
+    `LIVE_RESOURCE_PROPERTIES`) are also applied to the running service with
+    `systemctl set-property --runtime`, which does not need a restart. Limits which are
+    removed are reset to the systemd defaults. Nothing is done if the limits are unchanged.
+
+    The values are checked before anything is written, and the previous drop-in is restored
+    if `set-property` fails, so that a failed call is retried, and fails again, with the
+    same limits.
+
+    For a template unit, e.g. "worker@.service", the drop-in applies to all its instances, and
+    the running instances given in `instances` are changed live.
+
+    The runtime drop-ins of `set-property --runtime` take precedence over the drop-in in
+    /etc. Those of changed properties are removed from the service (or instances) that is not
+    running, so the new limits apply when it starts again.
+
+    Args:
+        service_name: The name of the service to limit.
+        limits: Mapping of property name to value, e.g. {"CPUQuota": "50%"}. An empty mapping
+            removes the drop-in.
+        dropin_name: The file name of the drop-in.
+        instances: The instances of a template unit to change live, e.g. ["worker@1.service"].
+
+    Returns:
+        True if the running service (or instances) needs a restart for all the limits to
+        apply; False if not.
+
+    Raises:
+        SystemdError: Raised if a property is not supported, a value is invalid, or
+            `systemctl` returns a non-zero returncode.
+    """
+    supported = LIVE_RESOURCE_PROPERTIES + RESTART_RESOURCE_PROPERTIES
+    if unsupported := set(limits) - set(supported):
+        raise SystemdError(f"Unsupported resource limits: {sorted(unsupported)}")
+
+    wanted = {name: str(limits[name]).strip() for name in supported if name in limits}
+    if invalid := _invalid_resource_limits(wanted):
+        raise SystemdError(
+            f"Invalid resource limits: {', '.join(f'{n}={wanted[n]!r}' for n in invalid)}"
+        )
+
+    unit = _unit_name(service_name)
+    path = _unit_path(unit, dropin_name)
+    current = _read_dropin(path)
+    if current == wanted:
+        logger.debug(f"Resource limits of {unit} unchanged: {wanted}")
+        return False
+
+    _write_dropin(path, wanted)
+    daemon_reload()
+
+    changed = {name for name in supported if current.get(name) != wanted.get(name)}
+    live_changed = [name for name in LIVE_RESOURCE_PROPERTIES if name in changed]
+    targets = services_running(*(instances or [unit]))
+    running = [name for name, up in targets.items() if up]
+
+    # An empty assignment resets a property to its default.
+    live = [f"{name}={wanted.get(name, '')}" for name in live_changed]
+    try:
+        for running_unit in running if live else ():
+            _systemctl("set-property", "--runtime", running_unit, *live)
+    except SystemdError:
+        _write_dropin(path, current)
+        daemon_reload()
+        raise
+
+    stale = [
+        path
+        for name, up in targets.items()
+        if not up
+        for prop in live_changed
+        if os.path.exists(path := _runtime_control_path(name, prop))
+    ]
+    for path in stale:
+        os.remove(path)
+    if stale:
+        daemon_reload()
+
+    return bool(running) and bool(changed.intersection(RESTART_RESOURCE_PROPERTIES))
+
+
+def _runtime_control_path(unit_name: str, prop: str) -> str:
+    """Return the path of the drop-in `systemctl set-property --runtime` writes for a property."""
+    return os.path.join(SYSTEMD_RUNTIME_CONTROL_DIR, f"{unit_name}.d", f"50-{prop}.conf")
+
+
+# The limits of a scope for heavy work next to a live workload, e.g. installs: a fifth of the
+# default CPU and IO weights, and memory reclaimed above 1G.
+LOW_PRIORITY_SCOPE = {"cpu_weight": 20, "io_weight": 20, "memory_high": "1G"}
+
+_SIZE_SUFFIXES = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+_SCOPE_TIMEOUT = 5.0
+
+
+def _size_to_bytes(size: Union[int, str]) -> int:
+    """Convert a systemd style size, e.g. 512M, to a number of bytes."""
+    if isinstance(size, int):
+        return size
+    if size.strip() == "infinity":
+        return 2**64 - 1
+    match = re.fullmatch(r"(\d+)([KMGT]?)", size.strip().upper())
+    if not match:
+        raise SystemdError(f"Invalid size {size!r}, expected e.g. 1073741824, 512M or 1G.")
+    return int(match.group(1)) * _SIZE_SUFFIXES[match.group(2)]
+
+
+def _scope_properties(
+    cpu_weight: Optional[int], io_weight: Optional[int], memory_high: Optional[Union[int, str]]
+) -> Dict[str, int]:
+    """Return the resource control properties of a transient scope."""
+    properties = {}
+    if cpu_weight is not None:
+        properties["CPUWeight"] = cpu_weight
+    if io_weight is not None:
+        properties["IOWeight"] = io_weight
+    if memory_high is not None:
+        properties["MemoryHigh"] = _size_to_bytes(memory_high)
+    return properties
+
+
+def _start_transient_scope(unit_name: str, pid: int, properties: Dict[str, int]) -> None:
+    """Move an existing process into a new transient scope, like `systemd-run --scope` does.
+
+    Raises:
+        SystemdError: Raised if the scope could not be created or the process was not moved.
+    """
+    args: List[str] = ["PIDs", "au", "1", str(pid)]
+    for name, value in properties.items():
+        args.extend((name, "t", str(value)))
+    cmd = [
+        "busctl",
+        "call",
+        "org.freedesktop.systemd1",
+        "/org/freedesktop/systemd1",
+        "org.freedesktop.systemd1.Manager",
+        "StartTransientUnit",
+        "ssa(sv)a(sa(sv))",
+        unit_name,
+        "fail",
+        str(1 + len(properties)),
+        *args,
+        "0",
+    ]
+    logger.debug(f"Executing command: {cmd}")
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if proc.returncode != 0:
+        raise SystemdError(f"Could not create transient scope {unit_name}:\n{proc.stdout}")
+
+    # The job is started asynchronously, wait until the process has been moved.
+    deadline = time.monotonic() + _SCOPE_TIMEOUT
+    while time.monotonic() < deadline:
+        with open(f"/proc/{pid}/cgroup") as f:
+            if f"/{unit_name}" in f.read():
+                return
+        time.sleep(0.05)
+    raise SystemdError(f"Process {pid} was not moved into transient scope {unit_name}.")
+
+
+def _run_callable_in_scope(
+    func: Callable[[], Any], unit_name: str, properties: Dict[str, int]
+) -> Any:
+    """Run a callable in a forked child process, which is placed in a transient scope."""
+    result_r, result_w = os.pipe()
+    go_r, go_w = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover (child)
+        os.close(result_r)
+        os.close(go_w)
+        # Wait for the parent to move this process into the scope, or to give up.
+        if os.read(go_r, 1) == b"1":
+            try:
+                result = (True, func())
+            except BaseException as e:
+                result = (False, e)
+            try:
+                payload = pickle.dumps(result)
+            except Exception as e:
+                payload = pickle.dumps((False, SystemdError(f"Unpicklable result: {e}")))
+            with os.fdopen(result_w, "wb") as f:
+                f.write(payload)
+        os._exit(0)
+
+    os.close(result_w)
+    os.close(go_r)
+    try:
+        _start_transient_scope(unit_name, pid, properties)
+    except SystemdError:
+        os.write(go_w, b"0")
+        os.close(go_w)
+        os.close(result_r)
+        os.waitpid(pid, 0)
+        raise
+    except BaseException:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        raise
+
+    os.write(go_w, b"1")
+    os.close(go_w)
+    with os.fdopen(result_r, "rb") as f:
+        payload = f.read()
+    os.waitpid(pid, 0)
+
+    if not payload:
+        raise SystemdError(f"Process {pid} in transient scope {unit_name} died unexpectedly.")
+    success, value = pickle.loads(payload)
+    if not success:
+        raise value
+    return value
+
+
+def run_in_scope(
+    command: Union[str, Sequence[str], Callable[[], Any]],
+    *,
+    cpu_weight: Optional[int] = None,
+    io_weight: Optional[int] = None,
+    memory_high: Optional[Union[int, str]] = None,
+    unit_name: Optional[str] = None,
+) -> Any:
+    """Run a command or a callable in a transient scope with resource limits.
+
+    Commands are run with `systemd-run --scope`. Callables are run in a forked child
+    process which is moved into a new transient scope, so they must not use the charm's
+    model, and their return value (or exception) must be picklable.
+
+    Args:
+        command: A command, as a string or a list of arguments, or a callable.
+        cpu_weight: The CPUWeight of the scope (1-10000, the systemd default is 100).
+        io_weight: The IOWeight of the scope (1-10000, the systemd default is 100).
+        memory_high: The MemoryHigh of the scope, in bytes or as a size like "512M".
+        unit_name: The name of the scope. Default: a generated `charm-run-*.scope` name.
+
+    Returns:
+        The output of the command, or the return value of the callable.
+
+    Raises:
+        SystemdError: Raised if the scope could not be created, or the command returns a
+            non-zero returncode. Exceptions raised by a callable are re-raised.
+    """
+    unit_name = unit_name or f"charm-run-{uuid.uuid4().hex[:12]}.scope"
+    properties = _scope_properties(cpu_weight, io_weight, memory_high)
+
+    if callable(command):
+        return _run_callable_in_scope(command, unit_name, properties)
+
+    args = shlex.split(command) if isinstance(command, str) else list(command)
+    cmd = ["systemd-run", "--scope", "--quiet", f"--unit={unit_name}"]
+    for name, value in properties.items():
+        cmd.append(f"--property={name}={value}")
+    cmd.extend(("--", *args))
+    logger.debug(f"Executing command: {cmd}")
+    proc = subprocess.run(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        encoding="utf-8",
+    )
+    if proc.returncode != 0:
+        raise SystemdError(
+            f"Command {args} failed with returncode {proc.returncode}. Output:\n{proc.stdout}"
+        )
+    return proc.stdout
+
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+_cgroup_paths: Dict[str, str] = {}
+
+
+def service_cgroup_path(service_name: str) -> str:
+    """Return the cgroup v2 directory of a system service, without calling systemctl.
+
+    Services are looked up in `system.slice` first, then in the rest of the cgroup tree.
+
+    Args:
+        service_name: The name of the service.
+
+    Returns:
+        The absolute path of the service's cgroup directory.
+
+    Raises:
+        SystemdError: Raised if cgroup v2 is not mounted, or the service has no cgroup, e.g.
+            because it is not running.
+    """
+    unit = _unit_name(service_name)
+    path = _cgroup_paths.get(unit)
+    if path and os.path.isdir(path):
+        return path
+
+    if not os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+        raise SystemdError(f"No cgroup v2 hierarchy mounted on {CGROUP_ROOT}.")
+
+    path = os.path.join(CGROUP_ROOT, "system.slice", unit)
+    if not os.path.isdir(path):
+        path = next(
+            (os.path.join(d, unit) for d, dirs, _ in os.walk(CGROUP_ROOT) if unit in dirs), ""
+        )
+    if not path:
+        raise SystemdError(f"No cgroup found for {unit!r}, is it running?")
+
+    _cgroup_paths[unit] = path
+    return path
+
+
+def _read_flat_keyed(path: str) -> Dict[str, int]:
+    """Read a cgroup file of "key value" lines, e.g. cpu.stat or memory.stat."""
+    try:
+        with open(path) as f:
+            return {key: int(value) for key, value in (line.split() for line in f)}
+    except FileNotFoundError:
+        return {}
+
+
+def _read_io_stat(path: str) -> Dict[str, int]:
+    """Read io.stat, summing the "key=value" counters of all devices."""
+    totals: Dict[str, int] = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                for field in line.split()[1:]:
+                    key, _, value = field.partition("=")
+                    totals[key] = totals.get(key, 0) + int(value)
+    except FileNotFoundError:
+        pass
+    return totals
+
+
+class CgroupStats:
+    """A sample of the resource usage of a service, read from its cgroup.
+
+    Counters (CPU time, IO bytes) are cumulative; use `rates()` with an earlier sample to
+    turn them into rates.
+    """
+
+    def __init__(
+        self,
+        service_name: str,
+        timestamp: float,
+        cpu_usage_usec: int,
+        memory_current: int,
+        memory_stat: Dict[str, int],
+        io_read_bytes: int,
+        io_write_bytes: int,
+    ):
+        self.service_name = service_name
+        self.timestamp = timestamp
+        self.cpu_usage_usec = cpu_usage_usec
+        self.memory_current = memory_current
+        self.memory_stat = memory_stat
+        self.io_read_bytes = io_read_bytes
+        self.io_write_bytes = io_write_bytes
+
+    def __repr__(self):
+        """Represent the sample."""
+        return "<{}.{}: {}>".format(self.__module__, self.__class__.__name__, self.__dict__)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return the sample as a dict, e.g. to keep it in StoredState until the next hook."""
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "CgroupStats":
+        """Create a sample from the output of `as_dict()`."""
+        return cls(**data)
+
+    def rates(self, previous: "CgroupStats") -> Dict[str, float]:
+        """Return the CPU and IO rates between an earlier sample and this one.
+
+        Args:
+            previous: An earlier sample of the same service.
+
+        Returns:
+            A dict with "cpu_percent" (100 is one fully used core), "io_read_bytes_per_sec"
+            and "io_write_bytes_per_sec". The rates are 0 if there is no elapsed time, or the
+            counters went backwards because the service was restarted.
+        """
+        elapsed = self.timestamp - previous.timestamp
+
+        def rate(now: int, before: int) -> float:
+            return max(0, now - before) / elapsed if elapsed > 0 else 0.0
+
+        return {
+            "cpu_percent": rate(self.cpu_usage_usec, previous.cpu_usage_usec) / 1e6 * 100,
+            "io_read_bytes_per_sec": rate(self.io_read_bytes, previous.io_read_bytes),
+            "io_write_bytes_per_sec": rate(self.io_write_bytes, previous.io_write_bytes),
+        }
+
+
+def service_cgroup_stats(service_name: str) -> CgroupStats:
+    """Read the CPU, memory and IO usage of a system service from its cgroup.
+
+    Only files under /sys/fs/cgroup are read, no processes are spawned. Counters of cgroup
+    controllers which are not enabled for the service are reported as 0.
+
+    Args:
+        service_name: The name of the service.
+
+    Returns:
+        A `CgroupStats` sample.
+
+    Raises:
+        SystemdError: Raised if the cgroup of the service can't be found.
+    """
+    path = service_cgroup_path(service_name)
+    timestamp = time.time()
+    cpu_stat = _read_flat_keyed(os.path.join(path, "cpu.stat"))
+    memory_stat = _read_flat_keyed(os.path.join(path, "memory.stat"))
+    io_stat = _read_io_stat(os.path.join(path, "io.stat"))
+    try:
+        with open(os.path.join(path, "memory.current")) as f:
+            memory_current = int(f.read())
+    except FileNotFoundError:
+        memory_current = 0
+
+    return CgroupStats(
+        service_name=_unit_name(service_name),
+        timestamp=timestamp,
+        cpu_usage_usec=cpu_stat.get("usage_usec", 0),
+        memory_current=memory_current,
+        memory_stat=memory_stat,
+        io_read_bytes=io_stat.get("rbytes", 0),
+        io_write_bytes=io_stat.get("wbytes", 0),
+    )
+
+
+# syslog priorities, as used by the journal: 0 (emerg) to 7 (debug).
+PRIORITY_ERR = 3
+PRIORITY_INFO = 6
+
+
+class JournalReader:
+    """Read the journal of a system service incrementally.
+
+    Each `read()` streams only the entries after the current cursor from `journalctl -o json`,
+    one line at a time. Memory is bounded: only the last `max_entries` entries are kept, and
+    all entries read after a cursor are counted by priority. Keep `cursor` between hooks (e.g.
+    in StoredState) to continue where the previous hook stopped.
+    """
+
+    def __init__(self, service_name: str, cursor: Optional[str] = None, max_entries: int = 100):
+        """Create a JournalReader.
+
+        Args:
+            service_name: The name of the service.
+            cursor: The journal cursor to read after. Without one, the first `read()` reads
+                the last `max_entries` entries into `entries`, as history: they are not
+                counted in `priority_counts`, only the entries of later reads are.
+            max_entries: The number of most recent entries to keep in `entries`.
+        """
+        self.service_name = service_name
+        self.cursor = cursor
+        self.entries: deque = deque(maxlen=max_entries)
+        self.priority_counts: Dict[int, int] = {}
+
+    @property
+    def errors(self) -> int:
+        """Return the number of entries read with priority error or more severe."""
+        return sum(n for priority, n in self.priority_counts.items() if priority <= PRIORITY_ERR)
+
+    @staticmethod
+    def _message(entry: Dict[str, Any]) -> str:
+        message = entry.get("MESSAGE", "")
+        # Non-UTF-8 messages are exported as a list of byte values.
+        if isinstance(message, list):
+            return bytes(message).decode("utf-8", errors="replace")
+        return message or ""
+
+    def read(self) -> int:
+        """Read the entries after the cursor, updating `cursor`, `entries` and `priority_counts`.
+
+        Without a cursor, the last entries are read as history and not counted. If the service
+        has not logged anything yet, the cursor is set to the end of the journal instead.
+
+        Returns:
+            The number of entries read.
+
+        Raises:
+            SystemdError: Raised if `journalctl` returns a non-zero returncode.
+        """
+        history = not self.cursor
+        cmd = ["journalctl", f"--unit={_unit_name(self.service_name)}", "--output=json"]
+        if self.cursor:
+            cmd.append(f"--after-cursor={self.cursor}")
+        else:
+            cmd.append(f"--lines={self.entries.maxlen}")
+        logger.debug(f"Executing command: {cmd}")
+
+        count = 0
+        with subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding="utf-8"
+        ) as proc:
+            assert proc.stdout is not None
+            for line in proc.stdout:
+                entry = json.loads(line)
+                priority = int(entry.get("PRIORITY", PRIORITY_INFO))
+                if not history:
+                    self.priority_counts[priority] = self.priority_counts.get(priority, 0) + 1
+                self.entries.append(
+                    {
+                        "timestamp": int(entry.get("__REALTIME_TIMESTAMP", 0)) / 1e6,
+                        "priority": priority,
+                        "message": self._message(entry),
+                    }
+                )
+                self.cursor = entry["__CURSOR"]
+                count += 1
+            stderr = proc.stderr.read() if proc.stderr else ""
+
+        if proc.returncode != 0:
+            raise SystemdError(
+                f"Command {cmd} failed with returncode {proc.returncode}. Output:\n{stderr}"
+            )
+        if history and not self.cursor:
+            self.cursor = self._journal_end_cursor()
+        return count
+
+    @staticmethod
+    def _journal_end_cursor() -> Optional[str]:
+        """Return the cursor of the last entry of the whole journal, if there is one."""
+        cmd = ["journalctl", "--lines=1", "--output=json"]
+        logger.debug(f"Executing command: {cmd}")
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise SystemdError(
+                f"Command {cmd} failed with returncode {proc.returncode}. Output:\n{proc.stderr}"
+            )
+        lines = proc.stdout.splitlines()
+        return json.loads(lines[-1])["__CURSOR"] if lines else None
+
+
+SYSTEMD_UNIT_DIR = "/etc/systemd/system"
+SOCKET_PROXYD = "/lib/systemd/systemd-socket-proxyd"
+
+
+def _unit_path(unit_name: str, dropin: Optional[str] = None) -> str:
+    if dropin:
+        return os.path.join(SYSTEMD_UNIT_DIR, f"{unit_name}.d", dropin)
+    return os.path.join(SYSTEMD_UNIT_DIR, unit_name)
+
+
+def install_unit(unit_name: str, content: str, dropin: Optional[str] = None) -> bool:
+    """Install a unit file, or a drop-in for a unit, in /etc/systemd/system.
+
+    The file is only written if its content changed. Call `daemon_reload()` if it did.
+
+    Args:
+        unit_name: The full name of the unit, e.g. "myapp.socket".
+        content: The content of the unit file.
+        dropin: The file name of a drop-in for the unit, instead of the unit file itself.
+
+    Returns:
+        True if the file was written; False if it was already up to date.
+    """
+    path = _unit_path(unit_name, dropin)
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    logger.debug(f"Writing {path}")
+    with open(path, "w") as f:
+        f.write(content)
+    return True
+
+
+def remove_unit(unit_name: str, dropin: Optional[str] = None) -> bool:
+    """Remove a unit file, or a drop-in for a unit, from /etc/systemd/system.
+
+    Call `daemon_reload()` if it was removed.
+
+    Returns:
+        True if the file was removed; False if it did not exist.
+    """
+    try:
+        os.remove(_unit_path(unit_name, dropin))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def render_socket_unit(
+    listen: str,
+    *,
+    description: str,
+    accept: bool = False,
+    service: Optional[str] = None,
+    backlog: Optional[int] = None,
+) -> str:
+    """Render a .socket unit listening on a TCP port.
+
+    Args:
+        listen: The port, or address and port, to listen on, e.g. "8080" or "10.0.0.1:8080".
+        description: The description of the socket.
+        accept: Start an instance of the "<socket name>@.service" template per connection,
+            instead of handing the listening socket to a single service.
+        service: The service to activate, if it is not named like the socket.
+        backlog: The length of the queue of not yet accepted connections.
+
+    Returns:
+        The content of the unit file.
+    """
+    lines = [
+        "# Managed by the charm, do not edit.",
+        "[Unit]",
+        f"Description={description} socket",
+        "",
+        "[Socket]",
+        f"ListenStream={listen}",
+        f"Accept={'yes' if accept else 'no'}",
+    ]
+    if service:
+        lines.append(f"Service={service}")
+    if backlog:
+        lines.append(f"Backlog={backlog}")
+    lines.extend(("", "[Install]", "WantedBy=sockets.target", ""))
+    return "\n".join(lines)
+
+
+def render_socket_proxy_unit(target: str, *, description: str, requires: str) -> str:
+    """Render a service proxying a socket activated connection to a service's own port.
+
+    This puts a service which can't take over a listening socket from systemd behind
+    socket activation: the socket is held by systemd, and `systemd-socket-proxyd` forwards
+    connections to `target`. `requires` is started (and restarted) together with the proxy,
+    and connections are queued in the socket until it is up.
+
+    Args:
+        target: The address and port of the service, e.g. "127.0.0.1:18080".
+        description: The description of the proxy.
+        requires: The unit of the service behind the proxy.
+
+    Returns:
+        The content of the unit file.
+    """
+    return "\n".join(
+        (
+            "# Managed by the charm, do not edit.",
+            "[Unit]",
+            f"Description={description} socket proxy",
+            f"Requires={requires}",
+            f"After={requires}",
+            "",
+            "[Service]",
+            f"ExecStart={SOCKET_PROXYD} {target}",
+            "",
+        )
+    )
@@ -9,6 +9,7 @@ import logging
 import ops
 import charms.operator_libs_linux.v0.apt as apt
 import charms.operator_libs_linux.v1.systemd as systemd
+import charms.corehooks_all.v0.systemd_extras as systemd_extras
 from charms.operator_libs_linux.v0.apt import PackageNotFoundError, PackageError
 import sys
 
@@ -26,14 +27,24 @@ class UseLibCharmCharm(ops.CharmBase):
     def _on_install(self, event: ops.InstallEvent):
         """Handle install event."""
         try:
-            apt.update()
-            apt.add_package("apt-cacher-ng")
+            systemd_extras.run_in_scope(
+                self._install_packages, **systemd_extras.LOW_PRIORITY_SCOPE
+            )
         except PackageNotFoundError:
             logger.error("a specified package not found in package cache or on system")
             sys.exit(1)
         except PackageError as e:
             logger.error("could not install package. Reason: %s", e.message)
             sys.exit(1)
+        except systemd.SystemdError as e:
+            logger.error("could not install package in a transient scope. Reason: %s", e)
+            sys.exit(1)
+
+    @staticmethod
+    def _install_packages():
+        """Install apt-cacher-ng, run in a transient scope by the install hook."""
+        apt.update()
+        apt.add_package("apt-cacher-ng")
 
 
     def _on_start(self, event: ops.StartEvent):